@@ -0,0 +1,304 @@
+"""保存済みの位置情報ログを TrainDetector で判定し直すバッチ処理（DB・server1 には接続しない）
+
+路線データや判定距離（TRAIN_MAX_DISTANCE_KM）を変えたあとに、過去の位置情報に路線・区間を付け直すために使う。
+入力（CSV / JSONL / Parquet）を chunk_size 行ずつ読み、判定をプロセスプールで並列に行い、
+入力と同じ順番で元の列に line / section_id 列を足して書き出す。同時に処理中のチャンクは
+ワーカー数の2倍までなので、入力の大きさによらずメモリ使用量は一定。
+
+    python backfill.py pings.csv -o result.csv
+    python backfill.py logs/2024-*.parquet -o result.parquet --workers 8 --max-distance-km 0.5
+    TRAIN_NETWORK_PATH=network.bin python backfill.py pings.jsonl -o result.jsonl
+
+形式は拡張子（.csv / .jsonl / .parquet）で決める。Parquet を使うには pyarrow が必要。
+緯度・経度が読めない行は line / section_id を空にして書き出す。
+"""
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from railway_network import load_network
+from train_detector import TrainDetector
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "jsonl", "parquet")
+# detect_batch は全線分との距離を計算するので、線分がこれより多い路線網では1件ずつ（グリッドインデックス）判定する
+BATCH_MAX_SEGMENTS = 500
+
+# 列名 -> 値のリスト（チャンク内の行の順）
+Columns = Dict[str, list]
+
+# ワーカープロセスごとの判定器
+_detector: Optional[TrainDetector] = None
+
+
+def _format_of(path: str) -> str:
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension not in FORMATS:
+        raise ValueError(f"{path}: unsupported format (expected .csv, .jsonl or .parquet)")
+    return extension
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Parquet files need pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def read_chunks(path: str, chunk_size: int) -> Iterator[Columns]:
+    """ファイルを chunk_size 行ずつ列ごとのリストにして返す"""
+    file_format = _format_of(path)
+    if file_format == "parquet":
+        pyarrow = _require_pyarrow()
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pydict()
+        return
+
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = csv.DictReader(f) if file_format == "csv" else (json.loads(line) for line in f if line.strip())
+        chunk: List[dict] = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield _to_columns(chunk)
+                chunk = []
+        if chunk:
+            yield _to_columns(chunk)
+
+
+def _to_columns(rows: List[dict]) -> Columns:
+    # JSONL の行ごとにキーが違っても、チャンク内に出てきた順に列を揃える
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    return {name: [row.get(name) for row in rows] for name in names}
+
+
+def _coordinates(values: list) -> np.ndarray:
+    """数値に変換できない値（空欄・None など）は NaN にする（NaN・無限大の地点はどの路線にも判定されない）"""
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    coordinates = np.empty(len(values), dtype=np.float64)
+    for i, value in enumerate(values):
+        try:
+            coordinates[i] = float(value)
+        except (TypeError, ValueError):
+            coordinates[i] = np.nan
+    return coordinates
+
+
+class ResultWriter:
+    """元の列に line / section_id を足して1チャンクずつ書き出す。列は最初のチャンクで決める"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.format = _format_of(path)
+        self.columns: Optional[List[str]] = None
+        self._file = None
+        self._csv = None
+        self._parquet = None
+        self._schema = None
+        if self.format == "parquet":
+            self._pyarrow = _require_pyarrow()
+        else:
+            self._file = open(path, "w", newline="", encoding="utf-8")
+
+    def write(self, columns: Columns, lines: List[Optional[str]], section_ids: List[Optional[str]]):
+        if self.columns is None:
+            self.columns = [name for name in columns if name not in ("line", "section_id")] + ["line", "section_id"]
+        columns = dict(columns, line=lines, section_id=section_ids)
+        size = len(lines)
+        values = [columns.get(name) or [None] * size for name in self.columns]
+
+        if self.format == "parquet":
+            pyarrow = self._pyarrow
+            if self._parquet is None:
+                table = pyarrow.table(dict(zip(self.columns, values)))
+                self._schema = table.schema
+                self._parquet = pyarrow.parquet.ParquetWriter(self.path, self._schema)
+            else:
+                try:
+                    table = pyarrow.table(dict(zip(self.columns, values)), schema=self._schema)
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as e:
+                    raise SystemExit(f"{self.path}: rows do not match the column types of the first chunk ({e})")
+            self._parquet.write_table(table)
+        elif self.format == "csv":
+            if self._csv is None:
+                self._csv = csv.writer(self._file)
+                self._csv.writerow(self.columns)
+            self._csv.writerows(zip(*values))
+        else:
+            self._file.writelines(
+                json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + "\n" for row in zip(*values)
+            )
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def _init_worker(network_path: Optional[str], max_distance_from_line: Optional[float]):
+    global _detector
+    # fork なら親で作った判定器をそのまま使う
+    if _detector is None:
+        _detector = _build_detector(network_path, max_distance_from_line)
+
+
+def _build_detector(network_path: Optional[str], max_distance_from_line: Optional[float]) -> TrainDetector:
+    network = load_network(network_path, cache_path=os.getenv("TRAIN_NETWORK_CACHE")) if network_path else None
+    return TrainDetector(network, max_distance_from_line)
+
+
+def detect_chunk(lats: np.ndarray, lons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """チャンクの各地点の路線番号・区間番号（detect_batch と同じく判定なしは -1）"""
+    detector = _detector
+    if len(detector._segments) <= BATCH_MAX_SEGMENTS:
+        return detector.detect_batch(lats, lons)
+
+    line_numbers = {name: i for i, name in enumerate(detector.line_names)}
+    section_numbers = {section_id: i for i, section_id in enumerate(detector.section_ids)}
+    line_indices = np.full(len(lats), -1, dtype=np.int32)
+    section_indices = np.full(len(lats), -1, dtype=np.int32)
+    for i, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+        # NaN・無限大は detect_batch と同じく判定なし
+        if not (math.isfinite(lat) and math.isfinite(lon)):
+            continue
+        line, section_id = detector.detect_train(lat, lon)
+        if line is not None:
+            line_indices[i] = line_numbers[line]
+            # 閾値ちょうどの "<路線>_unknown" は detect_batch と同じく区間なし
+            section_indices[i] = section_numbers.get(section_id, -1)
+    return line_indices, section_indices
+
+
+class Progress:
+    def __init__(self, interval: float = 10.0):
+        self.interval = interval
+        self.started = time.monotonic()
+        self.rows = 0
+        self.matched = 0
+        self.invalid = 0
+        self._last_report = self.started
+
+    def add(self, rows: int, matched: int, invalid: int):
+        self.rows += rows
+        self.matched += matched
+        self.invalid += invalid
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self.started
+
+    def report(self, done: bool = False):
+        seconds = self.seconds
+        rate = self.rows / seconds if seconds > 0 else 0.0
+        matched = self.matched / self.rows if self.rows else 0.0
+        logger.info(f"{'Done' if done else 'Progress'}: {self.rows} rows in {seconds:.1f}s ({rate:.0f} rows/s), "
+                    f"{matched:.1%} on a line, {self.invalid} without coordinates")
+
+
+def backfill(inputs: List[str], output: str, workers: int, chunk_size: int,
+             network_path: Optional[str] = None, max_distance_from_line: Optional[float] = None,
+             lat_column: str = "latitude", lon_column: str = "longitude",
+             progress_interval: float = 10.0) -> Progress:
+    """inputs を順に判定して output に書き出す。workers=0 ならこのプロセスで判定する"""
+    global _detector
+    # fork するワーカーは親で作った判定器（索引を含む）を引き継ぐ
+    _detector = _build_detector(network_path, max_distance_from_line)
+    line_names = np.array(_detector.line_names + [None], dtype=object)
+    section_ids = np.array(_detector.section_ids + [None], dtype=object)
+    logger.info(f"Detector: {len(_detector.line_names)} lines, {len(_detector._segments)} segments, "
+                f"max distance {_detector.max_distance_from_line} km, workers {workers}")
+
+    progress = Progress(progress_interval)
+    writer = ResultWriter(output)
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                               initargs=(network_path, max_distance_from_line)) if workers > 0 else None
+    # 書き出し待ちのチャンク（入力の順）。先頭が終わったものから書き出す
+    pending: "deque[Tuple[Columns, np.ndarray, Future]]" = deque()
+    max_pending = max(1, workers * 2)
+
+    def write_next():
+        columns, invalid, future = pending.popleft()
+        line_indices, section_indices = future.result()
+        # -1（判定なし）は None になる
+        writer.write(columns, line_names[line_indices].tolist(), section_ids[section_indices].tolist())
+        progress.add(len(line_indices), int((line_indices >= 0).sum()), int(invalid.sum()))
+
+    try:
+        for path in inputs:
+            logger.info(f"Reading {path}")
+            for columns in read_chunks(path, chunk_size):
+                if lat_column not in columns or lon_column not in columns:
+                    raise SystemExit(f"{path}: columns {lat_column!r} and {lon_column!r} are required")
+                lats = _coordinates(columns[lat_column])
+                lons = _coordinates(columns[lon_column])
+                invalid = ~(np.isfinite(lats) & np.isfinite(lons))
+                if pool is None:
+                    future = Future()
+                    future.set_result(detect_chunk(lats, lons))
+                else:
+                    future = pool.submit(detect_chunk, lats, lons)
+                pending.append((columns, invalid, future))
+                while len(pending) >= max_pending or (pending and pending[0][2].done()):
+                    write_next()
+        while pending:
+            write_next()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        writer.close()
+
+    progress.report(done=True)
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-run train detection over stored location logs")
+    parser.add_argument("inputs", nargs="+", help=".csv / .jsonl / .parquet files, processed in order")
+    parser.add_argument("-o", "--output", required=True, help="output file (.csv / .jsonl / .parquet)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="detector processes (0 = detect in this process)")
+    parser.add_argument("--chunk-size", type=int, default=50_000, help="rows per chunk")
+    parser.add_argument("--network", help="railway network to use (default: TRAIN_NETWORK_PATH or built-in)")
+    parser.add_argument("--max-distance-km", type=float, help="default: TRAIN_MAX_DISTANCE_KM")
+    parser.add_argument("--lat-column", default="latitude")
+    parser.add_argument("--lon-column", default="longitude")
+    parser.add_argument("--progress-interval", type=float, default=10.0, help="seconds between progress logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    for path in args.inputs + [args.output]:
+        try:
+            _format_of(path)
+        except ValueError as e:
+            parser.error(str(e))
+    if os.path.abspath(args.output) in {os.path.abspath(path) for path in args.inputs}:
+        parser.error("output must not be one of the inputs")
+
+    backfill(
+        args.inputs, args.output, args.workers, args.chunk_size, args.network, args.max_distance_km,
+        args.lat_column, args.lon_column, args.progress_interval,
+    )
+
+
+if __name__ == "__main__":
+    main()
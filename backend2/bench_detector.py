@@ -0,0 +1,338 @@
+"""TrainDetector のオフライン再生ベンチマーク（DB・サーバー不要）
+
+路線に沿った合成GPS軌跡（または記録した軌跡ファイル）を判定器に直接流し、
+判定経路ごとに処理速度（fixes/sec）・レイテンシ（p50/p99）・メモリ・区間の正解率を表示する。
+
+    python bench_detector.py
+    python bench_detector.py --traces traces.csv --json result.json
+    python bench_detector.py --baseline result.json   # 処理速度が基準より落ちたら終了コード1
+
+軌跡ファイルは CSV または JSONL で、列は trace_id, timestamp, latitude, longitude,
+speed, direction, section_id（正解。路線外は空）。speed 以降は省略できる。
+"""
+import argparse
+import csv
+import json
+import logging
+import math
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from map_matcher import TrajectoryMatcher
+from session_store import RiderSession
+from train_detector import TrainDetector
+
+KM_PER_DEG_LAT = 110.574
+KM_PER_DEG_LON_EQUATOR = 111.320
+
+
+class Fix(NamedTuple):
+    trace_id: str
+    timestamp: float
+    latitude: float
+    longitude: float
+    speed: Optional[float]
+    direction: Optional[float]
+    # 正解の区間（路線外なら None）
+    section_id: Optional[str]
+
+
+class BenchResult(NamedTuple):
+    name: str
+    fixes: int
+    seconds: float
+    p50_ms: float
+    p99_ms: float
+    peak_kb: float
+    accuracy: float
+
+    @property
+    def fixes_per_sec(self) -> float:
+        return self.fixes / self.seconds if self.seconds > 0 else 0.0
+
+
+def synthetic_traces(detector: TrainDetector, trips_per_line: int = 5, spacing_km: float = 0.05,
+                     noise_km: float = 0.02, off_line_ratio: float = 0.05,
+                     interval_seconds: float = 5.0, seed: int = 0) -> List[Fix]:
+    """各路線を端から端まで走る軌跡を作る。位置にはGPS誤差を、一部には路線から遠い位置を混ぜる"""
+    rng = random.Random(seed)
+    fixes = []
+    segments_by_line: Dict[str, list] = {}
+    for segment in detector._segments:
+        segments_by_line.setdefault(segment.line, []).append(segment)
+
+    for line, segments in segments_by_line.items():
+        for trip in range(trips_per_line):
+            trace_id = f"{line}#{trip}"
+            # 上りと下りを交互に走る
+            ordered = segments if trip % 2 == 0 else list(reversed(segments))
+            timestamp = 0.0
+            for segment in ordered:
+                lat1, lon1, lat2, lon2 = segment.lat1, segment.lon1, segment.lat2, segment.lon2
+                bearing = segment.bearing
+                if trip % 2 == 1:
+                    lat1, lon1, lat2, lon2 = lat2, lon2, lat1, lon1
+                    bearing = (bearing + 180) % 360
+
+                length = detector._calculate_distance(lat1, lon1, lat2, lon2)
+                steps = max(1, int(length / spacing_km))
+                speed = spacing_km / interval_seconds * 3600
+                for step in range(steps):
+                    t = step / steps
+                    lat = lat1 + (lat2 - lat1) * t
+                    lon = lon1 + (lon2 - lon1) * t
+                    section_id = segment.section_id
+                    if rng.random() < off_line_ratio:
+                        # 路線から数km離れた位置（正解は判定なし）
+                        offset_km = detector.max_distance_from_line * 3 + rng.random() * 5
+                        noise = (rng.choice((-1, 1)) * offset_km, rng.choice((-1, 1)) * offset_km)
+                        section_id = None
+                    else:
+                        noise = (rng.gauss(0, noise_km), rng.gauss(0, noise_km))
+                    lat += noise[0] / KM_PER_DEG_LAT
+                    lon += noise[1] / (KM_PER_DEG_LON_EQUATOR * math.cos(math.radians(lat)))
+                    direction = (bearing + rng.gauss(0, 10)) % 360
+                    fixes.append(Fix(trace_id, timestamp, lat, lon, speed, direction, section_id))
+                    timestamp += interval_seconds
+    return fixes
+
+
+def _optional_float(value) -> Optional[float]:
+    return float(value) if value not in (None, "") else None
+
+
+def load_traces(path: str) -> List[Fix]:
+    """記録した軌跡を CSV / JSONL から読む"""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    return [
+        Fix(
+            str(row.get("trace_id", "")),
+            float(row.get("timestamp") or index),
+            float(row["latitude"]),
+            float(row["longitude"]),
+            _optional_float(row.get("speed")),
+            _optional_float(row.get("direction")),
+            row.get("section_id") or None,
+        )
+        for index, row in enumerate(rows)
+    ]
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _accuracy(fixes: List[Fix], predicted: List[Optional[str]]) -> float:
+    if not fixes:
+        return 0.0
+    return sum(1 for fix, section_id in zip(fixes, predicted) if fix.section_id == section_id) / len(fixes)
+
+
+def _peak_memory_kb(run: Callable[[], object]) -> float:
+    # tracemalloc 自体が遅いので、時間計測とは別にもう一度流して測る
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+
+def bench_scalar(detector: TrainDetector, fixes: List[Fix], measure_memory: bool = True) -> BenchResult:
+    def run(latencies: Optional[List[float]] = None) -> List[Optional[str]]:
+        predicted = []
+        for fix in fixes:
+            start = time.perf_counter()
+            _, section_id = detector.detect_train(fix.latitude, fix.longitude, fix.speed, fix.direction)
+            if latencies is not None:
+                latencies.append(time.perf_counter() - start)
+            predicted.append(section_id)
+        return predicted
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    predicted = run(latencies)
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return BenchResult(
+        "scalar", len(fixes), seconds,
+        _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.99) * 1000,
+        _peak_memory_kb(run) if measure_memory else 0.0,
+        _accuracy(fixes, predicted),
+    )
+
+
+def bench_batch(detector: TrainDetector, fixes: List[Fix], batch_size: int = 1000,
+                measure_memory: bool = True) -> BenchResult:
+    """detect_batch をまとめて呼ぶ。レイテンシは1バッチあたり"""
+    def run(latencies: Optional[List[float]] = None) -> List[Optional[str]]:
+        predicted = []
+        for offset in range(0, len(fixes), batch_size):
+            chunk = fixes[offset:offset + batch_size]
+            start = time.perf_counter()
+            _, section_indices = detector.detect_batch(
+                [fix.latitude for fix in chunk], [fix.longitude for fix in chunk]
+            )
+            if latencies is not None:
+                latencies.append(time.perf_counter() - start)
+            predicted.extend(
+                detector.section_ids[index] if index >= 0 else None for index in section_indices.tolist()
+            )
+        return predicted
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    predicted = run(latencies)
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return BenchResult(
+        f"batch[{batch_size}]", len(fixes), seconds,
+        _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.99) * 1000,
+        _peak_memory_kb(run) if measure_memory else 0.0,
+        _accuracy(fixes, predicted),
+    )
+
+
+def bench_matcher(detector: TrainDetector, fixes: List[Fix], measure_memory: bool = True) -> BenchResult:
+    """軌跡ごとにセッションを作り、TrajectoryMatcher（索引を使う候補探索＋HMM）で判定する"""
+    matcher = TrajectoryMatcher(detector)
+
+    def run(latencies: Optional[List[float]] = None) -> List[Optional[str]]:
+        sessions: Dict[str, RiderSession] = {}
+        predicted = []
+        for fix in fixes:
+            session = sessions.get(fix.trace_id)
+            if session is None:
+                session = sessions[fix.trace_id] = RiderSession(len(sessions))
+            start = time.perf_counter()
+            _, section_id = matcher.update(
+                session, fix.latitude, fix.longitude, fix.speed, fix.direction, fix.timestamp
+            )
+            if latencies is not None:
+                latencies.append(time.perf_counter() - start)
+            predicted.append(section_id)
+        return predicted
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    predicted = run(latencies)
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return BenchResult(
+        "matcher", len(fixes), seconds,
+        _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.99) * 1000,
+        _peak_memory_kb(run) if measure_memory else 0.0,
+        _accuracy(fixes, predicted),
+    )
+
+
+def print_results(results: List[BenchResult]):
+    print(f"{'path':<14}{'fixes':>9}{'fixes/sec':>13}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>11}{'accuracy':>10}")
+    for r in results:
+        print(f"{r.name:<14}{r.fixes:>9}{r.fixes_per_sec:>13.0f}{r.p50_ms:>10.4f}{r.p99_ms:>10.4f}"
+              f"{r.peak_kb:>11.1f}{r.accuracy:>10.3f}")
+
+
+def compare_baseline(results: List[BenchResult], baseline_path: str, tolerance: float) -> bool:
+    """基準の fixes/sec から tolerance 以上落ちた経路があれば False"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)["results"]}
+
+    ok = True
+    for r in results:
+        base = baseline.get(r.name)
+        if base is None:
+            continue
+        ratio = r.fixes_per_sec / base["fixes_per_sec"] if base["fixes_per_sec"] else 1.0
+        status = "ok"
+        if ratio < 1 - tolerance:
+            status = "REGRESSION"
+            ok = False
+        if r.accuracy < base["accuracy"] - 0.01:
+            status = "ACCURACY DROP"
+            ok = False
+        print(f"{r.name:<14} {ratio:6.2f}x baseline  {status}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay GPS traces through TrainDetector and report performance")
+    parser.add_argument("--traces", help="recorded traces (.csv or .jsonl); synthetic traces if omitted")
+    parser.add_argument("--trips-per-line", type=int, default=5)
+    parser.add_argument("--spacing-km", type=float, default=0.05)
+    parser.add_argument("--noise-km", type=float, default=0.02)
+    parser.add_argument("--off-line-ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--paths", default="scalar,batch,matcher", help="comma separated: scalar,batch,matcher")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--no-cache", action="store_true", help="disable the geocell detection cache")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json result")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop vs baseline")
+    args = parser.parse_args()
+
+    # 判定ごとのログ出力を計測に含めない
+    logging.basicConfig(level=logging.WARNING)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    detector = TrainDetector(cache_size=0 if args.no_cache else None)
+    build_seconds = time.perf_counter() - start
+    _, build_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"detector: {len(detector.train_lines)} lines, {len(detector._segments)} segments, "
+          f"built in {build_seconds * 1000:.1f} ms, peak {build_peak / 1024:.1f} KB")
+
+    if args.traces:
+        fixes = load_traces(args.traces)
+    else:
+        fixes = synthetic_traces(detector, args.trips_per_line, args.spacing_km, args.noise_km,
+                                 args.off_line_ratio, seed=args.seed)
+    print(f"traces: {len({fix.trace_id for fix in fixes})}, fixes: {len(fixes)}")
+
+    measure_memory = not args.no_memory
+    results = []
+    for path in args.paths.split(","):
+        path = path.strip()
+        # 前の経路で温まったキャッシュを使わない
+        if detector.cell_cache is not None:
+            detector.cell_cache.clear()
+        if path == "scalar":
+            results.append(bench_scalar(detector, fixes, measure_memory))
+        elif path == "batch":
+            results.append(bench_batch(detector, fixes, args.batch_size, measure_memory))
+        elif path == "matcher":
+            results.append(bench_matcher(detector, fixes, measure_memory))
+        else:
+            parser.error(f"unknown path: {path}")
+
+    print_results(results)
+    if detector.cell_cache is not None:
+        print("detection cache:", detector.cell_cache.stats())
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "fixes": len(fixes),
+                "build_ms": build_seconds * 1000,
+                "results": [dict(r._asdict(), fixes_per_sec=r.fixes_per_sec) for r in results],
+            }, f, indent=2)
+
+    if args.baseline and not compare_baseline(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,345 @@
-import mysql.connector
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-def check_schema():
-    try:
-        connection = mysql.connector.connect(
-            host=os.getenv('DATABASE_HOST'),
-            port=int(os.getenv('DATABASE_PORT', 3306)),
-            user=os.getenv('DATABASE_USER'),
-            password=os.getenv('DATABASE_PASSWORD'),
-            database=os.getenv('DATABASE_NAME')
-        )
-        
-        cursor = connection.cursor()
-        
-        print("Tables in database:")
-        cursor.execute("SHOW TABLES")
-        tables = cursor.fetchall()
-        for table in tables:
-            print(f"- {table[0]}")
-        
-        print("\n" + "="*80)
-        print("USERS table schema:")
-        cursor.execute("DESCRIBE USERS")
-        columns = cursor.fetchall()
-        for col in columns:
-            print(f"  {col[0]:<20} {col[1]:<15} {col[2]:<5} {col[3]:<5} {col[4] or '':<10} {col[5] or ''}")
-        
-        print("\n" + "="*80)
-        print("Current data in USERS:")
-        cursor.execute("SELECT * FROM USERS")
-        users = cursor.fetchall()
-        if users:
-            for user in users:
-                print(f"  {user}")
+"""DBのスキーマ・インデックスの確認と、よく実行するクエリのためのインデックス追加
+
+    python check_schema.py                 # テーブル・列・インデックスを表示し、ホットなクエリを EXPLAIN する
+    python check_schema.py --strict        # フルスキャンが残っていれば終了コード1
+    python check_schema.py migrate --dry-run
+    python check_schema.py migrate         # 足りないインデックスを作る（何度実行してもよい）
+    python check_schema.py bench           # ローカルのSQLiteにデータを作り、インデックス追加前後の時間を比べる
+
+接続先は DATABASE_URL（なければ DATABASE_HOST などから作るMySQLのURL）か --database-url。
+テーブル名は server1（Sequelize）に合わせて users / rooms だが、大文字小文字の違う名前（ROOMS など）でも見つける。
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Engine
+
+
+class HotQuery(NamedTuple):
+    name: str
+    # {users} / {rooms} は実際のテーブル名に置き換える
+    sql: str
+
+
+class WantedIndex(NamedTuple):
+    name: str
+    table: str
+    columns: tuple
+    reason: str
+
+
+HOT_QUERIES = [
+    # backend2 の verify_token / verify_token_async
+    HotQuery("verify_token", """
+        SELECT * FROM {users}
+        WHERE token = :token AND (token_expired_at IS NULL OR token_expired_at > :now)
+        LIMIT 1
+    """),
+    # server1 の POST /api/train/join で同じ区間の相手を探すクエリ（NOW() は :now にしている）
+    HotQuery("server1_match", """
+        SELECT * FROM {users}
+        WHERE id <> :user_id
+          AND section_id = :section_id
+          AND section_id_expired_at > :now
+          AND id NOT IN (
+            SELECT user_id_1 FROM {rooms} WHERE expired_at > :now
+            UNION
+            SELECT user_id_2 FROM {rooms} WHERE expired_at > :now
+          )
+        LIMIT 1
+    """),
+]
+
+# 既存のインデックスの先頭の列がこれと同じなら作らない（token は一意制約のインデックスがあればそれで足りる）
+WANTED_INDEXES = [
+    WantedIndex("idx_users_token", "users", ("token",),
+                "verify_token: token で1行に絞る"),
+    WantedIndex("idx_users_section_id_expired_at", "users", ("section_id", "section_id_expired_at"),
+                "server1_match: 同じ区間で期限内のユーザーだけを読む"),
+    WantedIndex("idx_rooms_expired_at_user_id_1", "rooms", ("expired_at", "user_id_1"),
+                "server1_match: 有効な部屋の user_id_1 をインデックスだけで読む"),
+    WantedIndex("idx_rooms_expired_at_user_id_2", "rooms", ("expired_at", "user_id_2"),
+                "server1_match: 有効な部屋の user_id_2 をインデックスだけで読む"),
+]
+
+EXPLAIN_PARAMS = {"token": "x", "section_id": "x", "user_id": 0}
+
+
+def connect(database_url: Optional[str]) -> Engine:
+    if database_url is None:
+        from database import DATABASE_URL
+        database_url = DATABASE_URL
+    return create_engine(database_url)
+
+
+def resolve_tables(engine: Engine) -> Dict[str, str]:
+    """users / rooms を実際のテーブル名（大文字小文字を含む）に対応づける"""
+    actual = {name.lower(): name for name in inspect(engine).get_table_names()}
+    missing = [name for name in ("users", "rooms") if name not in actual]
+    if missing:
+        raise SystemExit(f"Tables not found: {', '.join(missing)}")
+    return {name: actual[name] for name in ("users", "rooms")}
+
+
+def _index_columns(engine: Engine, table: str) -> List[tuple]:
+    """主キー・一意制約を含む、テーブルの各インデックスの列（小文字）"""
+    if engine.dialect.name == "sqlite":
+        # 列定義の UNIQUE で作られるインデックス（sqlite_autoindex_*）は get_indexes() に出てこない
+        with engine.connect() as conn:
+            names = [row[1] for row in conn.execute(text(f"PRAGMA index_list({table})"))]
+            return [
+                tuple(row[2].lower() for row in conn.execute(text(f"PRAGMA index_info({name})")))
+                for name in names
+            ]
+
+    inspector = inspect(engine)
+    indexes = [tuple(c.lower() for c in index["column_names"] if c) for index in inspector.get_indexes(table)]
+    indexes += [tuple(c.lower() for c in unique["column_names"]) for unique in inspector.get_unique_constraints(table)]
+    primary_key = inspector.get_pk_constraint(table).get("constrained_columns")
+    if primary_key:
+        indexes.append(tuple(c.lower() for c in primary_key))
+    return indexes
+
+
+def missing_indexes(engine: Engine, tables: Dict[str, str]) -> List[WantedIndex]:
+    missing = []
+    for wanted in WANTED_INDEXES:
+        existing = _index_columns(engine, tables[wanted.table])
+        if not any(columns[:len(wanted.columns)] == wanted.columns for columns in existing):
+            missing.append(wanted)
+    return missing
+
+
+def explain(engine: Engine, query: HotQuery, tables: Dict[str, str]) -> List[str]:
+    """クエリの実行計画を1行ずつの文字列で返す。フルスキャンの行は先頭に "FULL SCAN" を付ける"""
+    sql = query.sql.format(**tables)
+    params = dict(EXPLAIN_PARAMS, now=datetime.now())
+    lines = []
+    with engine.connect() as conn:
+        if engine.dialect.name == "sqlite":
+            for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql), params):
+                detail = row[-1]
+                # "SCAN users" や "SCAN rooms USING COVERING INDEX ..." はテーブル（インデックス）全体を読む
+                words = detail.split()
+                full_scan = words[0] == "SCAN" and len(words) > 1 and words[1].lower() in tables
+                lines.append(("FULL SCAN  " if full_scan else "           ") + detail)
         else:
-            print("  No data found")
-        
-        # サンプルデータの数を確認
-        for table_name in ['users', 'USERS']:
-            try:
-                cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-                count = cursor.fetchone()[0]
-                print(f"\nCount in {table_name}: {count}")
-            except:
-                print(f"\nTable {table_name} not accessible")
-        
-        cursor.close()
-        connection.close()
-        
-    except mysql.connector.Error as e:
-        print(f"Error: {e}")
+            for row in conn.execute(text("EXPLAIN " + sql), params).mappings():
+                # type=ALL はテーブル全体、index はインデックス全体を読む。
+                # <union2,3> や <subquery2> は UNION の結果・実体化したサブクエリ（一時テーブル）で常に type=ALL なので、
+                # 実際のテーブルの行だけで判断する
+                table = row["table"] or ""
+                full_scan = not table.startswith("<") and row["type"] in ("ALL", "index")
+                lines.append(
+                    ("FULL SCAN  " if full_scan else "           ")
+                    + f"table={row['table']} type={row['type']} key={row['key']} rows={row['rows']} "
+                    + f"extra={row.get('Extra') or ''}"
+                )
+    return lines
+
+
+def check(engine: Engine, strict: bool = False) -> bool:
+    """スキーマとホットなクエリの実行計画を表示する。フルスキャンがなければ True"""
+    tables = resolve_tables(engine)
+    inspector = inspect(engine)
+
+    print("Tables in database:")
+    for table in inspector.get_table_names():
+        print(f"- {table}")
+
+    with engine.connect() as conn:
+        for table in tables.values():
+            print("\n" + "=" * 80)
+            count = conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+            print(f"{table} ({count} rows)")
+            for column in inspector.get_columns(table):
+                print(f"  {column['name']:<24} {str(column['type']):<15} {'NULL' if column['nullable'] else 'NOT NULL'}")
+            print("  indexes:")
+            for index in inspector.get_indexes(table):
+                unique = " UNIQUE" if index.get("unique") else ""
+                print(f"    {index['name']:<36} ({', '.join(c for c in index['column_names'] if c)}){unique}")
+
+    ok = True
+    for query in HOT_QUERIES:
+        print("\n" + "=" * 80)
+        print(f"EXPLAIN {query.name}")
+        for line in explain(engine, query, tables):
+            print("  " + line)
+            if line.startswith("FULL SCAN"):
+                ok = False
+
+    missing = missing_indexes(engine, tables)
+    print("\n" + "=" * 80)
+    if missing:
+        print("Missing indexes (apply with: python check_schema.py migrate):")
+        for wanted in missing:
+            print(f"  {wanted.name} ON {tables[wanted.table]} ({', '.join(wanted.columns)})  -- {wanted.reason}")
+    else:
+        print("All recommended indexes exist")
+    if not ok:
+        print("Full scans found in hot queries" + (" (failing because of --strict)" if strict else ""))
+    return ok
+
+
+def migrate(engine: Engine, dry_run: bool = False) -> List[str]:
+    """足りないインデックスを作る。既にあるもの（同じ列で始まるインデックス）は飛ばすので何度実行してもよい
+
+    MySQL (InnoDB) のセカンダリインデックスの追加はオンラインDDLで行われ、テーブルへの書き込みを止めない。
+    """
+    tables = resolve_tables(engine)
+    preparer = engine.dialect.identifier_preparer
+    statements = [
+        f"CREATE INDEX {preparer.quote(wanted.name)} ON {preparer.quote(tables[wanted.table])} "
+        f"({', '.join(preparer.quote(column) for column in wanted.columns)})"
+        for wanted in missing_indexes(engine, tables)
+    ]
+    for statement in statements:
+        print(("-- " if dry_run else "") + statement)
+        if not dry_run:
+            with engine.begin() as conn:
+                conn.execute(text(statement))
+    if not statements:
+        print("Nothing to do: all recommended indexes exist")
+    return statements
+
+
+# bench で作るテーブル（server1 の Sequelize のモデルと同じ列・制約）
+BENCH_SCHEMA = [
+    """CREATE TABLE users (
+        id BIGINT PRIMARY KEY,
+        email VARCHAR(255) NOT NULL UNIQUE,
+        password VARCHAR(64) NOT NULL,
+        token VARCHAR(255) UNIQUE,
+        token_expired_at DATETIME,
+        section_id VARCHAR(255),
+        section_id_expired_at DATETIME
+    )""",
+    """CREATE TABLE rooms (
+        id INTEGER PRIMARY KEY,
+        user_id_1 BIGINT NOT NULL REFERENCES users (id),
+        user_id_2 BIGINT NOT NULL REFERENCES users (id),
+        expired_at DATETIME NOT NULL
+    )""",
+]
+
+
+def seed(engine: Engine, users: int, sections: int, seed_value: int = 0):
+    """ユーザーを users 人作る。半分ほどが区間に乗っていて、そのうち一部は部屋に入っている（一部は期限切れ）"""
+    rng = random.Random(seed_value)
+    now = datetime.now()
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS rooms"))
+        conn.execute(text("DROP TABLE IF EXISTS users"))
+        for statement in BENCH_SCHEMA:
+            conn.execute(text(statement))
+
+        rows = []
+        for i in range(users):
+            riding = rng.random() < 0.5
+            rows.append({
+                "id": i + 1,
+                "email": f"bench-{i}@example.com",
+                "password": "x",
+                "token": f"bench-token-{i}",
+                "token_expired_at": now + timedelta(hours=rng.uniform(-24, 24)),
+                "section_id": f"section-{rng.randrange(sections)}" if riding else None,
+                "section_id_expired_at": now + timedelta(hours=rng.uniform(-3, 3)) if riding else None,
+            })
+        conn.execute(text(
+            "INSERT INTO users (id, email, password, token, token_expired_at, section_id, section_id_expired_at) "
+            "VALUES (:id, :email, :password, :token, :token_expired_at, :section_id, :section_id_expired_at)"
+        ), rows)
+
+        rooms = [
+            {
+                "id": i + 1,
+                "user_id_1": rng.randrange(users) + 1,
+                "user_id_2": rng.randrange(users) + 1,
+                "expired_at": now + timedelta(hours=rng.uniform(-72, 24)),
+            }
+            for i in range(users // 4)
+        ]
+        conn.execute(text(
+            "INSERT INTO rooms (id, user_id_1, user_id_2, expired_at) VALUES (:id, :user_id_1, :user_id_2, :expired_at)"
+        ), rooms)
+
+
+def time_queries(engine: Engine, users: int, sections: int, repeat: int) -> Dict[str, float]:
+    """ホットなクエリを repeat 回ずつ実行し、1回あたりの平均時間(ms)を返す"""
+    tables = resolve_tables(engine)
+    rng = random.Random(1)
+    timings = {}
+    with engine.connect() as conn:
+        for query in HOT_QUERIES:
+            statement = text(query.sql.format(**tables))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(statement, {
+                    "token": f"bench-token-{rng.randrange(users)}",
+                    "section_id": f"section-{rng.randrange(sections)}",
+                    "user_id": rng.randrange(users) + 1,
+                    "now": datetime.now(),
+                }).fetchall()
+            timings[query.name] = (time.perf_counter() - start) / repeat * 1000
+    return timings
+
+
+def bench(database_url: str, users: int, sections: int, repeat: int):
+    """database_url のDBに users / rooms を作り直し、インデックスを追加する前後でホットなクエリの時間を比べる"""
+    engine = create_engine(database_url)
+    print(f"Seeding {users} users and {users // 4} rooms into {engine.url.render_as_string(hide_password=True)} ...")
+    seed(engine, users, sections)
+    before = time_queries(engine, users, sections, repeat)
+    print("\nBefore:")
+    check(engine)
+
+    print("\nMigrating:")
+    migrate(engine)
+    after = time_queries(engine, users, sections, repeat)
+    print("\nAfter:")
+    check(engine)
+
+    print("\n" + "=" * 80)
+    print(f"{'query':<16}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name in before:
+        speedup = before[name] / after[name] if after[name] > 0 else float("inf")
+        print(f"{name:<16}{before[name]:>12.3f}{after[name]:>12.3f}{speedup:>9.1f}x")
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the schema and index the hot queries")
+    parser.add_argument("--database-url", help="SQLAlchemy URL (default: DATABASE_URL or the DATABASE_* settings)")
+    parser.add_argument("--strict", action="store_true", help="exit with 1 if a hot query does a full scan")
+    commands = parser.add_subparsers(dest="command")
+    migrate_parser = commands.add_parser("migrate", help="create the missing indexes")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="only print the statements")
+    bench_parser = commands.add_parser(
+        "bench", help="seed a scratch database and time the hot queries before and after migrating"
+    )
+    # 既存のテーブルを作り直すので、既定では --database-url を無視してローカルのSQLiteを使う
+    bench_parser.add_argument("--bench-database-url", default="sqlite:///schema_bench.db",
+                              help="scratch database; its users / rooms tables are dropped and recreated")
+    bench_parser.add_argument("--users", type=int, default=200_000)
+    bench_parser.add_argument("--sections", type=int, default=500)
+    bench_parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        bench(args.bench_database_url, args.users, args.sections, args.repeat)
+        return
+
+    engine = connect(args.database_url)
+    if args.command == "migrate":
+        migrate(engine, args.dry_run)
+    elif not check(engine, args.strict) and args.strict:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
-    check_schema()
\ No newline at end of file
+    main()
@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine, Column, BigInteger, String, DateTime, Integer, Text, ForeignKey
+from sqlalchemy import create_engine, select, Column, BigInteger, String, DateTime, Integer, Text, ForeignKey
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
 from datetime import datetime
@@ -7,11 +8,29 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-DATABASE_URL = f"mysql+mysqlconnector://{os.getenv('DATABASE_USER')}:{os.getenv('DATABASE_PASSWORD')}@{os.getenv('DATABASE_HOST')}:{os.getenv('DATABASE_PORT')}/{os.getenv('DATABASE_NAME')}"
+# DATABASE_URL / ASYNC_DATABASE_URL を指定すれば、負荷試験などでSQLiteなど別のDBに差し替えられる
+DATABASE_URL = os.getenv("DATABASE_URL") or f"mysql+mysqlconnector://{os.getenv('DATABASE_USER')}:{os.getenv('DATABASE_PASSWORD')}@{os.getenv('DATABASE_HOST')}:{os.getenv('DATABASE_PORT')}/{os.getenv('DATABASE_NAME')}"
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or f"mysql+aiomysql://{os.getenv('DATABASE_USER')}:{os.getenv('DATABASE_PASSWORD')}@{os.getenv('DATABASE_HOST')}:{os.getenv('DATABASE_PORT')}/{os.getenv('DATABASE_NAME')}"
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# コネクションプールの設定（ワーカープロセスごと）
+POOL_OPTIONS = {
+    "pool_pre_ping": True,
+    "pool_size": int(os.getenv("DATABASE_POOL_SIZE", "10")),
+    "max_overflow": int(os.getenv("DATABASE_MAX_OVERFLOW", "20")),
+    "pool_recycle": int(os.getenv("DATABASE_POOL_RECYCLE", "1800")),
+    "pool_timeout": float(os.getenv("DATABASE_POOL_TIMEOUT", "10")),
+}
+
+def pool_options(url: str) -> dict:
+    # SQLiteはプールの大きさを指定できない（接続を使い回さない）ので、プールの設定は渡さない
+    return {} if url.startswith("sqlite") else POOL_OPTIONS
+
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 class UserDB(Base):
@@ -50,9 +69,22 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def verify_token(db: Session, token: str):
     user = db.query(UserDB).filter(
         UserDB.token == token,
         (UserDB.token_expired_at == None) | (UserDB.token_expired_at > datetime.now())
     ).first()
-    return user
\ No newline at end of file
+    return user
+
+async def verify_token_async(db: AsyncSession, token: str):
+    result = await db.execute(
+        select(UserDB).where(
+            UserDB.token == token,
+            (UserDB.token_expired_at == None) | (UserDB.token_expired_at > datetime.now())
+        ).limit(1)
+    )
+    return result.scalars().first()
\ No newline at end of file
@@ -0,0 +1,98 @@
+import math
+import os
+from collections import OrderedDict
+from typing import Generic, List, Optional, Tuple, TypeVar
+
+# 地球半径6371kmでの緯度1度あたりの距離
+KM_PER_DEG = 6371 * math.pi / 180
+
+T = TypeVar("T")
+
+
+class GeocellCache(Generic[T]):
+    """位置を一定の大きさのセル（cell_size_m 四方）に量子化し、セルごとの判定結果を持つLRUキャッシュ
+
+    経度方向のセル幅は reference_lat での長さが cell_size_m になるように決める。
+    何を入れるか（セル内のどこでも結果が変わらないか）は呼び出し側が bounds() / half_diagonal_km() を
+    使って判断する。路線データを読み直したら clear() する。
+    ヒットしても結果を使えず計算し直した場合は bypass() で数え、hit_rate から除く（hit_rate はキャッシュで答えた割合）。
+    """
+
+    def __init__(self, cell_size_m: float = 15.0, max_size: int = 50_000, reference_lat: float = 35.0):
+        self.cell_size_m = cell_size_m
+        self.max_size = max_size
+        self.cell_lat = cell_size_m / 1000 / KM_PER_DEG
+        self.cell_lon = cell_size_m / 1000 / (KM_PER_DEG * math.cos(math.radians(reference_lat)))
+        self._entries: "OrderedDict[Tuple[int, int], T]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls, reference_lat: float, max_size: Optional[int] = None) -> Optional["GeocellCache"]:
+        """DETECTION_CACHE_SIZE=0 なら None（キャッシュしない）"""
+        if max_size is None:
+            max_size = int(os.getenv("DETECTION_CACHE_SIZE", "50000"))
+        if max_size <= 0:
+            return None
+        return cls(
+            cell_size_m=float(os.getenv("DETECTION_CACHE_CELL_METERS", "15")),
+            max_size=max_size,
+            reference_lat=reference_lat,
+        )
+
+    def cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_lat), math.floor(lon / self.cell_lon))
+
+    def bounds(self, cell: Tuple[int, int]) -> Tuple[float, float, float, float]:
+        """セルの (南端の緯度, 西端の経度, 北端の緯度, 東端の経度)"""
+        row, col = cell
+        return (row * self.cell_lat, col * self.cell_lon, (row + 1) * self.cell_lat, (col + 1) * self.cell_lon)
+
+    def corners(self, cell: Tuple[int, int]) -> List[Tuple[float, float]]:
+        south, west, north, east = self.bounds(cell)
+        return [(south, west), (south, east), (north, west), (north, east)]
+
+    def half_diagonal_km(self, cell: Tuple[int, int]) -> float:
+        """セルの中心からセル内のどの点までの距離もこれ以下（赤道側の cos で少し大きめに見積もる）"""
+        south, _, north, _ = self.bounds(cell)
+        height = self.cell_lat * KM_PER_DEG
+        width = self.cell_lon * KM_PER_DEG * math.cos(math.radians(min(abs(south), abs(north))))
+        return math.hypot(height, width) / 2
+
+    def get(self, cell: Tuple[int, int]) -> Optional[T]:
+        entry = self._entries.get(cell)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(cell)
+        self.hits += 1
+        return entry
+
+    def put(self, cell: Tuple[int, int], entry: T):
+        self._entries[cell] = entry
+        self._entries.move_to_end(cell)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def bypass(self):
+        self.bypasses += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": (self.hits - self.bypasses) / total if total else 0.0,
+        }
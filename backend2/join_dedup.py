@@ -0,0 +1,36 @@
+import os
+import time
+from typing import Optional
+
+from session_store import RiderSession
+
+# server1の section_id_expired_at（join から3時間）に合わせる
+SECTION_TTL_SECONDS = 3 * 60 * 60
+
+
+class JoinDeduplicator:
+    """セッションに記録した最後の通知区間と比べ、変化がないserver1への通知を間引く
+
+    区間が変わったとき、またはserver1側の区間の有効期限が近づいたときだけ通知する。
+    記録は通知に成功した後にセッションストアの mark_joined で行うので、失敗した通知は次の位置情報で再送される。
+    """
+
+    def __init__(self, ttl_seconds: float = SECTION_TTL_SECONDS,
+                 refresh_before_seconds: float = 600):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_before_seconds = refresh_before_seconds
+
+    @classmethod
+    def from_env(cls) -> "JoinDeduplicator":
+        return cls(
+            ttl_seconds=float(os.getenv("SECTION_JOIN_TTL_SECONDS", str(SECTION_TTL_SECONDS))),
+            refresh_before_seconds=float(os.getenv("SECTION_JOIN_REFRESH_SECONDS", "600")),
+        )
+
+    def should_forward(self, session: RiderSession, section_id: str, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        if session.joined_section_id != section_id:
+            return True
+
+        # 有効期限の refresh_before_seconds 前になったら延長のために再通知する
+        return now >= session.joined_at + self.ttl_seconds - self.refresh_before_seconds
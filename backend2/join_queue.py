@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import random
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class JoinJob:
+    """server1への区間通知1件"""
+    __slots__ = ("user_id", "token", "line", "section_id", "attempts")
+
+    def __init__(self, user_id: int, token: str, line: str, section_id: str):
+        self.user_id = user_id
+        self.token = token
+        self.line = line
+        self.section_id = section_id
+        self.attempts = 0
+
+
+class JoinQueue:
+    """検出処理とserver1への通知を切り離す、上限つきの非同期キュー
+
+    - ユーザーごとに未送信の通知は1件だけ持ち、新しい区間が来たら置き換える（まとめ送り）
+    - 未送信のユーザー数が max_pending に達したら受け付けず False を返す（バックプレッシャー）
+    - 送信に失敗した通知は、より新しい通知がなければジッター付きの指数バックオフで再送する
+    - send_batch があれば、batch_window_seconds の間に積まれた通知（最大 max_batch_size 件）を
+      まとめて1回で送る。同時に送るまとまりは workers 個まで。結果は1件ごとに再送するかを決める
+    """
+
+    def __init__(self, send: Callable[[JoinJob], Awaitable[bool]],
+                 workers: int = 8,
+                 max_pending: int = 10_000,
+                 max_attempts: int = 5,
+                 retry_base_seconds: float = 0.5,
+                 retry_max_seconds: float = 30.0,
+                 send_batch: Optional[Callable[[List[JoinJob]], Awaitable[List[bool]]]] = None,
+                 batch_window_seconds: float = 0.05,
+                 max_batch_size: int = 200):
+        self.send = send
+        self.send_batch = send_batch
+        self.batch_window_seconds = batch_window_seconds
+        self.max_batch_size = max_batch_size
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+
+        self._pending: Dict[int, JoinJob] = {}
+        self._in_flight: Dict[int, str] = {}
+        # 再送待ちの通知。新しい通知が積まれたら取り消す
+        self._retrying: Dict[int, JoinJob] = {}
+        # 同じユーザーの通知の送信が終わってから送る通知
+        self._deferred: Set[int] = set()
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._batch_tasks: Set[asyncio.Task] = set()
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.batches = 0
+
+    @classmethod
+    def from_env(cls, send: Callable[[JoinJob], Awaitable[bool]],
+                 send_batch: Optional[Callable[[List[JoinJob]], Awaitable[List[bool]]]] = None) -> "JoinQueue":
+        """JOIN_BATCH_WINDOW_MS=0 なら send_batch があっても1件ずつ送る"""
+        batch_window_seconds = float(os.getenv("JOIN_BATCH_WINDOW_MS", "50")) / 1000
+        return cls(
+            send,
+            workers=int(os.getenv("JOIN_QUEUE_WORKERS", "8")),
+            max_pending=int(os.getenv("JOIN_QUEUE_MAX_PENDING", "10000")),
+            max_attempts=int(os.getenv("JOIN_QUEUE_MAX_ATTEMPTS", "5")),
+            retry_base_seconds=float(os.getenv("JOIN_QUEUE_RETRY_BASE_SECONDS", "0.5")),
+            retry_max_seconds=float(os.getenv("JOIN_QUEUE_RETRY_MAX_SECONDS", "30")),
+            send_batch=send_batch if batch_window_seconds > 0 else None,
+            batch_window_seconds=batch_window_seconds,
+            max_batch_size=int(os.getenv("JOIN_BATCH_MAX_SIZE", "200")),
+        )
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        if self.send_batch is not None:
+            self._tasks = [asyncio.create_task(self._batcher())]
+        else:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5.0):
+        """未送信の通知を timeout 秒まで送り切ってからワーカーを止める"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {len(self._pending)} pending joins on shutdown")
+        tasks = self._tasks + list(self._batch_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job: JoinJob) -> bool:
+        """通知を積む。キューが満杯で受け付けられなければ False"""
+        self._retrying.pop(job.user_id, None)
+        pending = self._pending.get(job.user_id)
+        if pending is not None:
+            # 未送信の通知は最新のものだけ送ればよい
+            self._pending[job.user_id] = job
+            self.coalesced += 1
+            return True
+
+        if self._in_flight.get(job.user_id) == job.section_id:
+            # 同じ区間の通知を送信中
+            self.coalesced += 1
+            return True
+
+        if len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            return False
+
+        self._pending[job.user_id] = job
+        self._ready.put_nowait(job.user_id)
+        self.submitted += 1
+        return True
+
+    def _schedule_retry(self, job: JoinJob):
+        job.attempts += 1
+        if job.attempts >= self.max_attempts:
+            self.dropped += 1
+            logger.error(f"Giving up join for user {job.user_id}, section {job.section_id}")
+            return
+
+        # フルジッター: 0〜バックオフ上限の一様乱数だけ待つ
+        delay = random.uniform(0, min(self.retry_max_seconds, self.retry_base_seconds * (2 ** job.attempts)))
+        self.retried += 1
+        self._retrying[job.user_id] = job
+        asyncio.get_running_loop().call_later(delay, self._resubmit, job)
+
+    def _resubmit(self, job: JoinJob):
+        # 待っている間に新しい通知が積まれていれば、そちらを優先する
+        if self._retrying.get(job.user_id) is not job:
+            return
+        del self._retrying[job.user_id]
+        if job.user_id in self._pending or job.user_id in self._in_flight:
+            return
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending[job.user_id] = job
+        self._ready.put_nowait(job.user_id)
+
+    def _take(self, user_id: int) -> Optional[JoinJob]:
+        """送る通知を取り出す。同じユーザーの通知を送信中なら、順番が入れ替わらないよう終わるまで残しておく"""
+        if user_id in self._in_flight:
+            if user_id in self._pending:
+                self._deferred.add(user_id)
+            return None
+        job = self._pending.pop(user_id, None)
+        if job is not None:
+            self._in_flight[user_id] = job.section_id
+        return job
+
+    def _finish(self, job: JoinJob, ok: bool):
+        self._in_flight.pop(job.user_id, None)
+        if ok:
+            self.sent += 1
+        elif job.user_id in self._pending:
+            # 送信中に新しい通知が積まれていれば、失敗したものは送り直さない
+            self.coalesced += 1
+        else:
+            self._schedule_retry(job)
+        if job.user_id in self._deferred:
+            self._deferred.discard(job.user_id)
+            self._ready.put_nowait(job.user_id)
+
+    async def _worker(self):
+        while True:
+            user_id = await self._ready.get()
+            job = self._take(user_id)
+            if job is None:
+                self._ready.task_done()
+                continue
+
+            ok = False
+            try:
+                ok = await self.send(job)
+            except Exception as e:
+                logger.error(f"Unexpected error sending join: {e}")
+            finally:
+                self._finish(job, ok)
+                self._ready.task_done()
+
+    async def _batcher(self):
+        """通知を batch_window_seconds ずつ集め、まとめて送るタスクを workers 個まで同時に走らせる"""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            # 送信中のまとまりが多い間は集めるのを待つ（その間に積まれた通知は次のまとまりに入る）
+            await slots.acquire()
+            user_ids = [await self._ready.get()]
+            deadline = loop.time() + self.batch_window_seconds
+            while len(user_ids) < self.max_batch_size:
+                if not self._ready.empty():
+                    user_ids.append(self._ready.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    user_ids.append(await asyncio.wait_for(self._ready.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._send_batch(user_ids))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _send_batch(self, user_ids: List[int]):
+        jobs = [job for job in map(self._take, user_ids) if job is not None]
+        results = [False] * len(jobs)
+        try:
+            if jobs:
+                self.batches += 1
+                results = await self.send_batch(jobs)
+        except Exception as e:
+            logger.error(f"Unexpected error sending {len(jobs)} joins: {e}")
+        finally:
+            for job, ok in zip(jobs, results):
+                self._finish(job, ok)
+            for _ in user_ids:
+                self._ready.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "retrying": len(self._retrying),
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
@@ -0,0 +1,304 @@
+"""/api/set-location の負荷試験
+
+ローカルのSQLite（または --database-url で指定したDB）にテスト用ユーザーを作り、
+server1モック（mock_server1.py）と backend2 をワーカー数を変えて起動して、
+路線に沿って動く多数の乗客が一定間隔で位置を送ったときの処理量・レイテンシ・エラー率を表示する。
+
+    python loadtest.py --riders 2000 --ping-interval 5 --duration 30 --workers 1,2,4 --server1-latency-ms 50
+
+既に起動している backend2 に対して負荷だけをかける場合は --target http://host:port を指定する
+（ユーザーは --token-prefix で始まるトークンで作成済みであること）。
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+from sqlalchemy import create_engine, delete
+
+from bench_detector import Fix, synthetic_traces
+from train_detector import TrainDetector
+
+BACKEND2_DIR = os.path.dirname(os.path.abspath(__file__))
+# 実ユーザーとぶつからないよう、テスト用ユーザーのIDはこの値から振る
+LOADTEST_USER_ID_BASE = 900_000_000
+# server1モックの /api/train/join/bulk 用（--server1-bulk）
+LOADTEST_SERVICE_TOKEN = "loadtest-service-token"
+
+
+class LoadResult(NamedTuple):
+    workers: Optional[int]
+    riders: int
+    seconds: float
+    requests: int
+    errors: int
+    offered_rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+
+def seed_users(database_url: str, riders: int, token_prefix: str):
+    """loadtest 用のユーザーを作り直す"""
+    from database import UserDB
+
+    engine = create_engine(database_url)
+    UserDB.__table__.create(engine, checkfirst=True)
+    expires = datetime.now() + timedelta(days=1)
+    with engine.begin() as conn:
+        conn.execute(delete(UserDB.__table__).where(UserDB.email.like("loadtest-%")))
+        conn.execute(UserDB.__table__.insert(), [
+            {
+                "id": LOADTEST_USER_ID_BASE + i,
+                "email": f"loadtest-{i}@example.com",
+                "password": "x",
+                "token": f"{token_prefix}{i}",
+                "token_expired_at": expires,
+            }
+            for i in range(riders)
+        ])
+    engine.dispose()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def rider_routes(detector: TrainDetector) -> List[List[Fix]]:
+    traces: Dict[str, List[Fix]] = {}
+    for fix in synthetic_traces(detector, trips_per_line=2, off_line_ratio=0.0):
+        traces.setdefault(fix.trace_id, []).append(fix)
+    return list(traces.values())
+
+
+# httpx のコネクションプールは接続数が多いと1リクエストあたりの管理コストが増えるので、
+# 小さなクライアントに分けて使う
+CONNECTIONS_PER_CLIENT = 10
+
+
+async def run_riders(target: str, routes: List[List[Fix]], rider_ids: range, token_prefix: str,
+                     ping_interval: float, duration: float, max_connections: int,
+                     timeout: float) -> Tuple[List[float], int, float]:
+    """乗客ごとに ping_interval 秒おきに位置を送る（前の応答が遅れればその分あとにずれる）"""
+    latencies: List[float] = []
+    errors = 0
+    per_client = min(CONNECTIONS_PER_CLIENT, max_connections)
+    limits = httpx.Limits(max_connections=per_client, max_keepalive_connections=per_client)
+    clients = [
+        httpx.AsyncClient(base_url=target, limits=limits, timeout=timeout)
+        for _ in range(max(1, max_connections // per_client))
+    ]
+    deadline = time.monotonic() + duration
+
+    async def rider(index: int):
+        nonlocal errors
+        rng = random.Random(index)
+        client = clients[index % len(clients)]
+        route = routes[index % len(routes)]
+        position = rng.randrange(len(route))
+        # 送信時刻が揃わないよう最初の送信をずらす
+        await asyncio.sleep(rng.uniform(0, min(ping_interval, duration)))
+        while time.monotonic() < deadline:
+            fix = route[position % len(route)]
+            position += 1
+            payload = {
+                "token": f"{token_prefix}{index}",
+                "latitude": fix.latitude,
+                "longitude": fix.longitude,
+                "speed": fix.speed,
+                "direction": fix.direction,
+            }
+            start = time.perf_counter()
+            try:
+                response = await client.post("/api/set-location", json=payload)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+            wait = ping_interval * rng.uniform(0.9, 1.1) - (time.perf_counter() - start)
+            await asyncio.sleep(max(0.0, min(wait, deadline - time.monotonic())))
+
+    try:
+        started = time.monotonic()
+        await asyncio.gather(*(rider(i) for i in rider_ids))
+        seconds = time.monotonic() - started
+    finally:
+        for client in clients:
+            await client.aclose()
+    return latencies, errors, seconds
+
+
+def _run_riders_process(args) -> Tuple[List[float], int, float]:
+    return asyncio.run(run_riders(*args))
+
+
+def run_load(target: str, routes: List[List[Fix]], riders: int, token_prefix: str,
+             ping_interval: float, duration: float, max_connections: int,
+             timeout: float, processes: int = 1) -> LoadResult:
+    """乗客を processes 個の負荷生成プロセスに分けて走らせ、結果を集計する"""
+    shards = [
+        (target, routes, range(i, riders, processes), token_prefix, ping_interval, duration,
+         max(1, max_connections // processes), timeout)
+        for i in range(processes)
+    ]
+    if processes == 1:
+        outputs = [_run_riders_process(shards[0])]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            outputs = pool.map(_run_riders_process, shards)
+
+    latencies = sorted(latency for output in outputs for latency in output[0])
+    errors = sum(output[1] for output in outputs)
+    seconds = max(output[2] for output in outputs)
+
+    def percentile(q: float) -> float:
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+
+    return LoadResult(
+        None, riders, seconds, len(latencies), errors, riders / ping_interval,
+        percentile(0.5), percentile(0.95), percentile(0.99), latencies[-1] * 1000 if latencies else 0.0,
+    )
+
+
+def print_results(results: List[LoadResult]):
+    print(f"{'workers':>8}{'riders':>8}{'offered/s':>11}{'req/s':>9}{'errors':>9}{'p50 ms':>9}"
+          f"{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for r in results:
+        workers = "-" if r.workers is None else str(r.workers)
+        print(f"{workers:>8}{r.riders:>8}{r.offered_rps:>11.0f}{r.throughput:>9.0f}{r.error_rate:>9.2%}"
+              f"{r.p50_ms:>9.1f}{r.p95_ms:>9.1f}{r.p99_ms:>9.1f}{r.max_ms:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /api/set-location with simulated riders")
+    parser.add_argument("--riders", type=int, default=1000)
+    parser.add_argument("--ping-interval", type=float, default=5.0, help="seconds between fixes per rider")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--workers", default="1,2,4", help="comma separated backend2 worker counts")
+    parser.add_argument("--server1-latency-ms", type=float, default=50.0)
+    parser.add_argument("--server1-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--server1-error-rate", type=float, default=0.0)
+    parser.add_argument("--server1-bulk", action="store_true",
+                        help="send joins through /api/train/join/bulk (sets SERVER1_SERVICE_TOKEN)")
+    parser.add_argument("--database-url", help="sync SQLAlchemy URL of the stand-in DB (default: local SQLite)")
+    parser.add_argument("--async-database-url", help="async URL of the same DB")
+    parser.add_argument("--target", help="load an already running backend2 instead of starting one")
+    parser.add_argument("--token-prefix", default="loadtest-token-")
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--client-processes", type=int, default=1,
+                        help="load generator processes (one is CPU bound at roughly 1-2k req/s)")
+    parser.add_argument("--server-log", help="append backend2 / mock logs to this file (discarded by default)")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    detector = TrainDetector()
+    routes = rider_routes(detector)
+
+    def load() -> LoadResult:
+        return run_load(
+            target, routes, args.riders, args.token_prefix, args.ping_interval,
+            args.duration, args.max_connections, args.timeout, args.client_processes,
+        )
+
+    results = []
+    if args.target:
+        target = args.target
+        results.append(load())
+    else:
+        database_url = args.database_url or f"sqlite:///{os.path.join(BACKEND2_DIR, 'loadtest.db')}"
+        async_database_url = args.async_database_url or database_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+        os.environ.setdefault("DATABASE_URL", database_url)
+        os.environ.setdefault("ASYNC_DATABASE_URL", async_database_url)
+        seed_users(database_url, args.riders, args.token_prefix)
+        server_log = open(args.server_log, "a") if args.server_log else subprocess.DEVNULL
+
+        server1_port = free_port()
+        mock = subprocess.Popen([
+            sys.executable, "mock_server1.py", "--port", str(server1_port),
+            "--latency-ms", str(args.server1_latency_ms),
+            "--jitter-ms", str(args.server1_jitter_ms),
+            "--error-rate", str(args.server1_error_rate),
+            "--service-token", LOADTEST_SERVICE_TOKEN,
+        ], cwd=BACKEND2_DIR, stderr=server_log)
+        try:
+            wait_until_up(f"http://127.0.0.1:{server1_port}/stats", mock)
+            env = dict(
+                os.environ,
+                DATABASE_URL=database_url,
+                ASYNC_DATABASE_URL=async_database_url,
+                SERVER1_URL=f"http://127.0.0.1:{server1_port}",
+            )
+            if args.server1_bulk:
+                env["SERVER1_SERVICE_TOKEN"] = LOADTEST_SERVICE_TOKEN
+            else:
+                env.pop("SERVER1_SERVICE_TOKEN", None)
+            for workers in (int(value) for value in args.workers.split(",")):
+                port = free_port()
+                target = f"http://127.0.0.1:{port}"
+                server = subprocess.Popen([
+                    sys.executable, "-m", "uvicorn", "main:app",
+                    "--port", str(port), "--workers", str(workers), "--log-level", "warning", "--no-access-log",
+                ], cwd=BACKEND2_DIR, env=env, stderr=server_log)
+                try:
+                    wait_until_up(f"{target}/health", server)
+                    print(f"running {args.riders} riders against {workers} worker(s) for {args.duration:.0f}s ...")
+                    results.append(load()._replace(workers=workers))
+                finally:
+                    stop(server)
+            print("server1 mock:", httpx.get(f"http://127.0.0.1:{server1_port}/stats").json())
+        finally:
+            stop(mock)
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump([dict(r._asdict(), throughput=r.throughput, error_rate=r.error_rate) for r in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,32 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional
-import requests
-import os
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from datetime import datetime
+import hmac
+import json
 import logging
+import math
+import os
+import time
 
-from database import get_db, verify_token
-from models import LocationData, LineResponse, SectionQueueRequest
+from database import AsyncSessionLocal, async_engine, get_async_db
+from join_dedup import JoinDeduplicator
+from join_queue import JoinJob, JoinQueue
+from map_matcher import TrajectoryMatcher
+from metrics import CONTENT_TYPE, REGISTRY, CallbackMetric, Counter, Histogram
+from models import (
+    LocationData, LocationBatchData, LineResponse, LineBatchResponse, SectionQueueRequest, User,
+    OccupancyResponse, SectionOccupancyResponse,
+)
+from occupancy import SectionOccupancy
+from profiler import MODES as PROFILE_MODES, PipelineProfiler
+from server1_client import Server1Client, room_created, room_partner
+from session_store import RiderSession, create_session_store
+from token_cache import TokenVerifier
 from train_detector import TrainDetector
 
 load_dotenv()
@@ -17,7 +34,35 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Team SNS Backend 2")
+server1_client = Server1Client.from_env()
+join_deduplicator = JoinDeduplicator.from_env()
+session_store = create_session_store()
+token_verifier = TokenVerifier.from_env()
+occupancy = SectionOccupancy.from_env()
+profiler = PipelineProfiler.from_env()
+# 管理用エンドポイント（X-Admin-Token ヘッダー）のトークン。未設定なら管理用エンドポイントは使えない
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# 位置情報の処理の各段階にかかった時間と判定結果
+STAGE_SECONDS = Histogram("backend2_stage_seconds", "Time spent in each stage of the location pipeline", ["stage"])
+REQUEST_SECONDS = Histogram("backend2_request_seconds", "Total time to handle a location request", ["endpoint"])
+DETECTIONS = Counter("backend2_detections_total", "Processed fixes by detection result (miss: no line within max_distance_from_line)", ["result"])
+JOIN_FAILURES = Counter("backend2_server1_join_failures_total", "Joins to server1 that failed after client retries")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await server1_client.start()
+    await join_queue.start()
+    if os.getenv("PROFILE_MODE"):
+        profiler.start(os.getenv("PROFILE_MODE"), seconds=float(os.getenv("PROFILE_SECONDS", "0")) or None)
+    yield
+    profiler.stop()
+    await join_queue.stop()
+    await server1_client.close()
+    await session_store.close()
+    await async_engine.dispose()
+
+app = FastAPI(title="Team SNS Backend 2", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,66 +73,355 @@ app.add_middleware(
 )
 
 train_detector = TrainDetector()
+trajectory_matcher = TrajectoryMatcher.from_env(train_detector)
+
+async def joined(job: JoinJob, result: Optional[dict]) -> bool:
+    """server1 の応答（失敗ならNone）をセッション・乗車状況に反映し、送れたかを返す"""
+    if result is None:
+        JOIN_FAILURES.inc()
+        return False
+    if room_created(result):
+        # 通知した本人と、相手に選ばれたユーザーの両方がルームに入った
+        occupancy.mark_matched(job.user_id)
+        partner = room_partner(result, job.user_id)
+        if partner is not None:
+            occupancy.mark_matched(partner)
+
+    # セッション全体を書き戻すと、同じユーザーの位置の処理と競合して通知済みの記録が消えるので、通知した区間だけを書く
+    await session_store.mark_joined(job.user_id, job.section_id, time.time())
+    return True
+
+async def send_join(job: JoinJob) -> bool:
+    """キューのワーカーから呼ばれ、server1に区間を通知する"""
+    queue_data = SectionQueueRequest(
+        user_id=job.user_id,
+        line=job.line,
+        section_id=job.section_id,
+        retry=job.attempts > 0
+    )
+    with STAGE_SECONDS.time(stage="server1_join"):
+        result = await server1_client.join(job.token, queue_data)
+    return await joined(job, result)
+
+async def send_join_batch(jobs: List[JoinJob]) -> List[bool]:
+    """SERVER1_SERVICE_TOKEN があれば、キューに集まった複数ユーザーの区間を1回のリクエストで通知する"""
+    joins = [
+        SectionQueueRequest(user_id=job.user_id, line=job.line, section_id=job.section_id, retry=job.attempts > 0)
+        for job in jobs
+    ]
+    with STAGE_SECONDS.time(stage="server1_join_batch"):
+        results = await server1_client.bulk_join(joins)
+    if results is None:
+        results = [None] * len(jobs)
+    return [await joined(job, result) for job, result in zip(jobs, results)]
+
+join_queue = JoinQueue.from_env(send_join, send_join_batch if server1_client.service_token else None)
+
+def db_pool_connections() -> dict:
+    pool = async_engine.pool
+    # SQLiteなどプールを持たない場合は出さない
+    if not hasattr(pool, "checkedout"):
+        return {}
+    return {
+        ("checked_out",): pool.checkedout(),
+        ("idle",): pool.checkedin(),
+        ("overflow",): max(0, pool.overflow()),
+    }
+
+def stats_by_key(stats: dict, keys) -> dict:
+    return {(key,): stats[key] for key in keys}
+
+CallbackMetric("backend2_db_pool_connections", "Async DB pool connections by state", "gauge",
+               db_pool_connections, ["state"])
+CallbackMetric("backend2_token_cache_size", "Cached token verification results", "gauge",
+               lambda: token_verifier.cache.stats()["size"])
+CallbackMetric("backend2_token_cache_events_total", "Token cache lookups and evictions", "counter",
+               lambda: stats_by_key(token_verifier.cache.stats(), ("hits", "negative_hits", "misses", "evictions")),
+               ["event"])
+CallbackMetric("backend2_join_queue_jobs", "Join jobs currently queued, in flight or waiting to retry", "gauge",
+               lambda: stats_by_key(join_queue.stats(), ("pending", "in_flight", "retrying")), ["state"])
+CallbackMetric("backend2_join_queue_events_total", "Join queue events", "counter",
+               lambda: stats_by_key(join_queue.stats(), ("submitted", "coalesced", "rejected", "sent", "retried", "dropped", "batches")),
+               ["event"])
+CallbackMetric("backend2_active_sessions", "Rider sessions held in the session store", "gauge",
+               lambda: len(session_store))
+CallbackMetric("backend2_riders_in_sections", "Riders currently placed in a section", "gauge",
+               lambda: len(occupancy))
+if train_detector.cell_cache is not None:
+    CallbackMetric("backend2_detection_cache_size", "Geocells held in the detection cache", "gauge",
+                   lambda: train_detector.cell_cache.stats()["size"])
+    CallbackMetric("backend2_detection_cache_events_total", "Detection cache lookups, evictions and invalidations",
+                   "counter",
+                   lambda: stats_by_key(train_detector.cell_cache.stats(),
+                                        ("hits", "misses", "bypasses", "evictions", "invalidations")),
+                   ["event"])
+
+async def verify_user(db: AsyncSession, token: str) -> Optional[User]:
+    with STAGE_SECONDS.time(stage="token_verify"):
+        return await token_verifier.verify(db, token)
+
+def notify_server1(token: str, session: RiderSession, line: str, section_id: str):
+    # 前回通知から区間が変わっておらず、有効期限にも余裕があれば通知しない
+    if not join_deduplicator.should_forward(session, section_id):
+        logger.debug(f"User {session.user_id} is still in section {section_id}, skipping join")
+        return
+
+    # 通知はバックグラウンドのワーカーが送る。満杯で積めなければ次の位置情報で再度試みる
+    if not join_queue.submit(JoinJob(session.user_id, token, line, section_id)):
+        logger.warning(f"Join queue is full, deferring join for user {session.user_id}")
+
+def build_line_response(line: Optional[str], section_id: Optional[str]) -> LineResponse:
+    # descriptionを生成
+    description = None
+    if line and section_id:
+        # section_idから駅名を抽出 (例: "御堂筋線_中津_梅田" -> ["中津", "梅田"])
+        parts = section_id.split("_")
+        if len(parts) >= 3:
+            station1 = parts[1]
+            station2 = parts[2]
+            description = f"あなたは{line}の{station1}駅と{station2}駅の間にいます"
+
+    return LineResponse(line=line, description=description)
+
+async def process_location(token: str, user_id: int, latitude: float, longitude: float,
+                           speed: Optional[float] = None,
+                           direction: Optional[float] = None):
+    session = await session_store.get_or_create(user_id)
+    # プロファイリング中は一部のリクエストだけ cProfile で計測する
+    if profiler.should_sample():
+        result = profiler.call(locate, token, session, latitude, longitude, speed, direction)
+    else:
+        result = locate(token, session, latitude, longitude, speed, direction)
+    await session_store.put(session)
+    return result
+
+def locate(token: str, session: RiderSession, latitude: float, longitude: float,
+           speed: Optional[float], direction: Optional[float]):
+    """位置1件を判定して通知を積む（await を含まない同期処理。セッションの読み書きは呼び出し側で行う）"""
+
+    # 直近の軌跡と速度・進行方向を踏まえて区間を判定する（路線と区間は候補探索1回で同時に決まる）
+    with STAGE_SECONDS.time(stage="detection"):
+        line, section_id = trajectory_matcher.update(session, latitude, longitude, speed, direction)
+    DETECTIONS.inc(result="section" if section_id else "miss")
+    occupancy.update(session.user_id, line, section_id)
+
+    if line and section_id:
+        notify_server1(token, session, line, section_id)
+
+    return line, section_id
 
 @app.post("/api/set-location", response_model=LineResponse)
-async def set_location(location_data: LocationData):
-    db = next(get_db())
+async def set_location(location_data: LocationData, db: AsyncSession = Depends(get_async_db)):
+    with REQUEST_SECONDS.time(endpoint="set-location"):
+        user = await verify_user(db, location_data.token)
+        if not user:
+            raise HTTPException(status_code=401, detail="Invalid token")
+
+        try:
+            line, section_id = await process_location(
+                location_data.token,
+                user.id,
+                location_data.latitude,
+                location_data.longitude,
+                location_data.speed,
+                location_data.direction
+            )
 
-    user = verify_token(db, location_data.token)
+            return build_line_response(line, section_id)
+
+        except Exception as e:
+            logger.error(f"Error in set_location: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/set-location/batch", response_model=LineBatchResponse)
+async def set_location_batch(batch_data: LocationBatchData, db: AsyncSession = Depends(get_async_db)):
+    """端末でバッファした位置情報をまとめて受け取り、最後に確定した区間だけをserver1に通知する"""
+    with REQUEST_SECONDS.time(endpoint="set-location-batch"):
+        user = await verify_user(db, batch_data.token)
+        if not user:
+            raise HTTPException(status_code=401, detail="Invalid token")
+
+        try:
+            fixes = sorted(batch_data.fixes, key=lambda fix: fix.timestamp)
+            session = await session_store.get_or_create(user.id)
+            # 端末の時刻をサーバーの時計に直す。sent_at があれば送信時刻とのずれから、なければ最後の位置を受信時刻とみなす
+            received_at = time.time()
+            clock_offset = received_at - (batch_data.sent_at or fixes[-1].timestamp).timestamp()
+            # 古い位置は個別の判定だけを返し、軌跡・区間には反映しない（遅れて届いたオフラインのバッファで現在の区間を巻き戻さない）。
+            # 前のバッチとは端末の時刻で、ライブの位置（サーバーの時計）とは sent_at があるときだけサーバーの時計で比べる
+            last_client_time = session.client_fix_time
+            last_fix_time = session.fix_time if batch_data.sent_at is not None else 0.0
+            line, section_id = session.line, session.section_id
+            replayed = False
+
+            results = []
+            misses = 0
+            with STAGE_SECONDS.time(stage="batch_detection"):
+                for fix in fixes:
+                    # 候補区間の探索は1件につき1回だけ行い、個別の判定と軌跡の判定の両方に使う
+                    candidates = train_detector.find_candidate_sections(fix.latitude, fix.longitude)
+                    nearest = candidates[0] if candidates else None
+                    if nearest is None:
+                        misses += 1
+                    results.append(build_line_response(
+                        nearest.line if nearest else None, nearest.section_id if nearest else None
+                    ))
+
+                    client_time = fix.timestamp.timestamp()
+                    fix_time = min(client_time + clock_offset, received_at)
+                    if client_time <= last_client_time or fix_time <= last_fix_time:
+                        continue
+                    # 軌跡を順にたどって最後に確定した区間を求める
+                    line, section_id = trajectory_matcher.update(
+                        session, fix.latitude, fix.longitude, fix.speed, fix.direction, fix_time, candidates
+                    )
+                    session.client_fix_time = client_time
+                    replayed = True
+            DETECTIONS.inc(len(fixes) - misses, result="section")
+            DETECTIONS.inc(misses, result="miss")
+
+            # 通知は最大1回だけ行う
+            if replayed:
+                occupancy.update(user.id, line, section_id)
+                if line and section_id:
+                    notify_server1(batch_data.token, session, line, section_id)
+                await session_store.put(session)
+
+            settled = build_line_response(line, section_id)
+            return LineBatchResponse(line=settled.line, description=settled.description, results=results)
+
+        except Exception as e:
+            logger.error(f"Error in set_location_batch: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+# WebSocketのクローズコード（4000番台はアプリケーション定義）
+WS_CLOSE_INVALID_TOKEN = 4401
+
+def parse_compact_fix(message: str):
+    """[lat, lon] または [lat, lon, speed, direction] 形式の位置を読む"""
+    values = json.loads(message)
+    if not isinstance(values, list) or not 2 <= len(values) <= 4:
+        raise ValueError("fix must be [lat, lon, speed?, direction?]")
+    latitude, longitude = float(values[0]), float(values[1])
+    speed = float(values[2]) if len(values) > 2 and values[2] is not None else None
+    direction = float(values[3]) if len(values) > 3 and values[3] is not None else None
+    # "nan" / "inf" などの文字列も float() で読めてしまうので弾く
+    if not all(math.isfinite(value) for value in (latitude, longitude, speed, direction) if value is not None):
+        raise ValueError("fix values must be finite numbers")
+    return latitude, longitude, speed, direction
+
+def token_expired(user: User) -> bool:
+    return user.token_expired_at is not None and datetime.now() >= user.token_expired_at
+
+@app.websocket("/ws/location")
+async def location_stream(websocket: WebSocket, token: str):
+    """接続時に1回だけ認証し、以降は軽量な位置を受け取り続ける。路線か区間が変わったときだけ結果を返す"""
+    async with AsyncSessionLocal() as db:
+        user = await verify_user(db, token)
     if not user:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        await websocket.close(code=WS_CLOSE_INVALID_TOKEN)
+        return
 
+    await websocket.accept()
+    last_result = None
     try:
-        
-        line, section_id = train_detector.detect_train(
-            location_data.latitude,
-            location_data.longitude,
-            location_data.speed,
-            location_data.direction
-        )
-
-        if line and section_id:
-            server1_url = os.getenv("SERVER1_URL", "http://localhost:3000")
-            queue_data = SectionQueueRequest(
-                user_id=user.id,
-                line=line,
-                section_id=section_id
-            )
-            queue_header = {
-                "Authorization": "Bearer " + location_data.token,
-                "Content-Type": "application/json",
-            }
-            
+        while True:
+            message = await websocket.receive_text()
+            if token_expired(user):
+                await websocket.close(code=WS_CLOSE_INVALID_TOKEN)
+                return
+
+            try:
+                latitude, longitude, speed, direction = parse_compact_fix(message)
+            except (ValueError, TypeError) as e:
+                await websocket.send_json({"error": str(e)})
+                continue
+
+            # 1件の処理に失敗しても接続は切らず、その位置だけエラーを返す
             try:
-                response = requests.post(
-                    f"{server1_url}/api/train/join",
-                    headers=queue_header,
-                    json=queue_data.dict(),
-                )
-                response.raise_for_status()
-                logger.info(f"User {user.id} added to queue for line {line}, section {section_id}")
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Failed to notify server1: {e}")
-        
-        # descriptionを生成
-        description = None
-        if line and section_id:
-            # section_idから駅名を抽出 (例: "御堂筋線_中津_梅田" -> ["中津", "梅田"])
-            parts = section_id.split("_")
-            if len(parts) >= 3:
-                station1 = parts[1]
-                station2 = parts[2]
-                description = f"あなたは{line}の{station1}駅と{station2}駅の間にいます"
-
-        return LineResponse(line=line, description=description)
-
-    except Exception as e:
-        logger.error(f"Error in set_location: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+                result = await process_location(token, user.id, latitude, longitude, speed, direction)
+            except Exception as e:
+                logger.error(f"Error in location_stream: {e}")
+                await websocket.send_json({"error": "failed to process fix"})
+                continue
+            if result != last_result:
+                last_result = result
+                await websocket.send_json(build_line_response(*result).model_dump())
+    except WebSocketDisconnect:
+        pass
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+# どのユーザーがどの区間に乗っているかが分かるので、管理用トークンで守る
+@app.get("/api/occupancy", response_model=OccupancyResponse, dependencies=[Depends(require_admin)])
+async def get_occupancy():
+    """区間・路線ごとの乗車中ユーザー数と、server1でまだマッチしていないユーザー数"""
+    occupancy.expire()
+    return OccupancyResponse(
+        total=len(occupancy),
+        lines=occupancy.line_counts(),
+        sections=occupancy.section_counts(),
+        waiting=occupancy.waiting_counts(),
+    )
+
+@app.get("/api/occupancy/{section_id}", response_model=SectionOccupancyResponse, dependencies=[Depends(require_admin)])
+async def get_section_occupancy(section_id: str):
+    occupancy.expire()
+    return SectionOccupancyResponse(
+        section_id=section_id,
+        riders=occupancy.section_count(section_id),
+        waiting_user_ids=occupancy.waiting_users(section_id),
+    )
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus形式のメトリクス（ワーカープロセスごとの値）"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@app.post("/admin/profile/start", dependencies=[Depends(require_admin)])
+async def start_profile(mode: str = "both", sample_rate: Optional[float] = None, seconds: Optional[float] = 60):
+    """プロファイリングを始める（seconds 秒で自動的に止まる。このワーカーだけが対象）"""
+    if mode not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {PROFILE_MODES}")
+    profiler.start(mode, sample_rate, seconds)
+    return profiler.status()
+
+@app.post("/admin/profile/stop", dependencies=[Depends(require_admin)])
+async def stop_profile():
+    profiler.stop()
+    return profiler.status()
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def profile_status():
+    return profiler.status()
+
+@app.get("/admin/profile/pstats", dependencies=[Depends(require_admin)])
+async def download_pstats(format: str = "binary"):
+    """cProfile の結果。binary は snakeviz などで開ける .prof、text は累積時間順の表"""
+    if format == "text":
+        return Response(profiler.pstats_text(), media_type="text/plain; charset=utf-8")
+    return Response(profiler.pstats_dump(), media_type="application/octet-stream",
+                    headers={"Content-Disposition": "attachment; filename=backend2.prof"})
+
+@app.get("/admin/profile/flamegraph", dependencies=[Depends(require_admin)])
+async def download_flamegraph():
+    """スタックサンプリングの結果（collapsed 形式。flamegraph.pl や speedscope に渡す）"""
+    return Response(profiler.collapsed_stacks(), media_type="text/plain; charset=utf-8",
+                    headers={"Content-Disposition": "attachment; filename=backend2.folded"})
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "token_cache": token_verifier.cache.stats(),
+        "detection_cache": train_detector.cell_cache.stats() if train_detector.cell_cache is not None else None,
+        "active_sessions": len(session_store),
+        "riders_in_sections": len(occupancy),
+        "join_queue": join_queue.stats(),
+    }
 
 if __name__ == "__main__":
     import uvicorn
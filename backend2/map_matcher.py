@@ -0,0 +1,118 @@
+import math
+import os
+import time
+from typing import List, Optional, Tuple
+
+from session_store import RiderSession
+from train_detector import SectionCandidate, TrainDetector
+
+
+class TrajectoryMatcher:
+    """直近の位置の並びから、つじつまの合う駅間区間を選ぶ（HMM/Viterbi方式のマップマッチング）
+
+    隠れ状態は判定距離内の候補区間で、観測ごとに
+    - 放出: 区間までの距離（ガウス分布）と、一定速度以上なら進行方向と線路の方位のずれ
+    - 遷移: 同じ区間に留まるのが最も尤もらしく、同じ路線で離れた区間ほど、別路線へはさらに起こりにくい
+    として前回のスコアから最大値を更新する。候補数は max_candidates 以下なので、
+    1回の更新は O(候補数^2)。状態は RiderSession の match_scores に候補数までしか持たない。
+    駅や分岐の近くでGPSが揺れても、区間の切り替わりは線路から十分離れてからになる。
+    既定値では、駅を過ぎて次の区間の線路上を約45m進むと隣の区間に切り替わる
+    （bench_detector.py の合成軌跡で、GPS誤差が小さくても1件ずつの判定より正解率が下がらないように決めた）。
+    """
+
+    def __init__(self, detector: TrainDetector,
+                 state_ttl_seconds: float = 300,
+                 max_candidates: int = 8,
+                 distance_sigma_km: float = 0.1,
+                 heading_sigma_deg: float = 30.0,
+                 section_change_cost: float = 0.1,
+                 line_change_cost: float = 4.0):
+        self.detector = detector
+        self.state_ttl_seconds = state_ttl_seconds
+        self.max_candidates = max_candidates
+        self.distance_sigma_km = distance_sigma_km
+        self.heading_sigma_deg = heading_sigma_deg
+        self.section_change_cost = section_change_cost
+        self.line_change_cost = line_change_cost
+
+    @classmethod
+    def from_env(cls, detector: TrainDetector) -> "TrajectoryMatcher":
+        return cls(
+            detector,
+            state_ttl_seconds=float(os.getenv("MATCHER_STATE_TTL_SECONDS", "300")),
+            distance_sigma_km=float(os.getenv("MATCHER_DISTANCE_SIGMA_KM", "0.1")),
+            heading_sigma_deg=float(os.getenv("MATCHER_HEADING_SIGMA_DEG", "30")),
+            section_change_cost=float(os.getenv("MATCHER_SECTION_CHANGE_COST", "0.1")),
+            line_change_cost=float(os.getenv("MATCHER_LINE_CHANGE_COST", "4")),
+        )
+
+    def _emission(self, candidate: SectionCandidate,
+                  speed: Optional[float], direction: Optional[float]) -> float:
+        score = -0.5 * (candidate.distance / self.distance_sigma_km) ** 2
+
+        # 停車中や低速時の方位は当てにならないので、一定速度以上のときだけ使う
+        if direction is not None and speed is not None and speed >= self.detector.speed_threshold:
+            diff = abs((direction - candidate.bearing + 180) % 360 - 180)
+            # 上り・下りのどちらでもよいので、線路の向きとのずれは0〜90度
+            diff = min(diff, 180 - diff)
+            score -= 0.5 * (diff / self.heading_sigma_deg) ** 2
+
+        return score
+
+    def _transition(self, line: str, segment_index: int, candidate: SectionCandidate) -> float:
+        if line != candidate.line:
+            return -self.line_change_cost
+        return -self.section_change_cost * abs(segment_index - candidate.segment_index)
+
+    def update(self, session: RiderSession, latitude: float, longitude: float,
+               speed: Optional[float] = None,
+               direction: Optional[float] = None,
+               timestamp: Optional[float] = None,
+               candidates: Optional[List[SectionCandidate]] = None) -> Tuple[Optional[str], Optional[str]]:
+        """セッションに位置を1つ追加し、軌跡全体として最も尤もらしい (路線名, section_id) を返す
+
+        candidates は find_candidate_sections の結果（呼び出し側で求め済みなら渡す）。
+        """
+        now = time.time() if timestamp is None else timestamp
+        if candidates is None:
+            candidates = self.detector.find_candidate_sections(latitude, longitude)
+        candidates = candidates[:self.max_candidates]
+
+        # 間が空きすぎた軌跡は引き継がない
+        previous = None
+        if session.match_scores and abs(now - session.fix_time) <= self.state_ttl_seconds:
+            previous = session.match_scores.values()
+
+        session.latitude = latitude
+        session.longitude = longitude
+        session.fix_time = now
+
+        if not candidates:
+            session.match_scores = {}
+            session.line = None
+            session.section_id = None
+            session.confidence = 0.0
+            return None, None
+
+        scores = {}
+        for candidate in candidates:
+            score = self._emission(candidate, speed, direction)
+            if previous:
+                score += max(
+                    prev_score + self._transition(line, segment_index, candidate)
+                    for prev_score, line, segment_index in previous
+                )
+            scores[candidate.section_id] = (score, candidate.line, candidate.segment_index)
+
+        # 値が発散しないよう最大値を0にそろえる
+        best_section_id, (best_score, best_line, _) = max(scores.items(), key=lambda item: item[1][0])
+        session.match_scores = {
+            section_id: (score - best_score, line, segment_index)
+            for section_id, (score, line, segment_index) in scores.items()
+        }
+        session.line = best_line
+        session.section_id = best_section_id
+        # 候補の中での最良区間の事後確率
+        session.confidence = 1.0 / sum(math.exp(score) for score, _, _ in session.match_scores.values())
+
+        return best_line, best_section_id
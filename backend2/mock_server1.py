@@ -0,0 +1,155 @@
+"""負荷試験・ローカル開発用のserver1モック
+
+server1 の POST /api/train/join と同じ形のレスポンスを返す。応答までの遅延とエラー率を指定でき、
+同じ区間に相手待ちのユーザーがいればマッチさせる（ルーム作成）。DBは使わずメモリ上で持つ。
+まとめて通知する POST /api/train/join/bulk（docs/server1_bulk_join.md）も持つ。
+遅延とエラーはどちらもリクエスト1回ごとにかかる。
+
+    python mock_server1.py --port 3000 --latency-ms 50 --jitter-ms 20 --error-rate 0.01 --service-token secret
+"""
+import argparse
+import asyncio
+import hmac
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse
+
+from models import BulkJoinRequest, SectionQueueRequest
+from server1_client import ROOM_CREATED_MESSAGE
+
+SECTION_TTL = timedelta(hours=3)
+# server1 の duration_hours の既定値
+ROOM_TTL = timedelta(hours=24)
+# /api/train/join/bulk で1回に受け付ける件数の上限
+MAX_BULK_JOINS = 500
+
+
+class MockServer1:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 service_token: Optional[str] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        # None なら bulk はどの Bearer トークンでも受け付ける
+        self.service_token = service_token
+        # section_id -> 相手待ちのユーザーID
+        self.waiting: Dict[str, int] = {}
+        self.matched: Dict[int, int] = {}
+        self.joins = 0
+        self.bulk_requests = 0
+        self.rooms = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls) -> "MockServer1":
+        return cls(
+            latency_ms=float(os.getenv("MOCK_SERVER1_LATENCY_MS", "0")),
+            jitter_ms=float(os.getenv("MOCK_SERVER1_JITTER_MS", "0")),
+            error_rate=float(os.getenv("MOCK_SERVER1_ERROR_RATE", "0")),
+            service_token=os.getenv("MOCK_SERVER1_SERVICE_TOKEN") or None,
+        )
+
+    async def delay(self):
+        latency = max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) if self.jitter_ms else self.latency_ms
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    def fail(self) -> bool:
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def join(self, user_id: int, section_id: str) -> dict:
+        """server1 と同じく、同じ区間の未マッチのユーザーがいればルームを作る"""
+        self.joins += 1
+        expired_at = datetime.now() + SECTION_TTL
+        result = {"message": "Successfully joined train", "section_id": section_id, "expired_at": expired_at.isoformat()}
+
+        partner = self.waiting.get(section_id)
+        if user_id not in self.matched and partner is not None and partner != user_id:
+            del self.waiting[section_id]
+            self.matched[user_id] = partner
+            self.matched[partner] = user_id
+            self.rooms += 1
+            result["message"] = ROOM_CREATED_MESSAGE
+            result["room"] = {
+                "id": self.rooms, "user_id_1": user_id, "user_id_2": partner,
+                "expired_at": (datetime.now() + ROOM_TTL).isoformat(),
+            }
+        elif user_id not in self.matched:
+            self.waiting[section_id] = user_id
+
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "joins": self.joins,
+            "bulk_requests": self.bulk_requests,
+            "rooms": self.rooms,
+            "errors": self.errors,
+            "waiting_sections": len(self.waiting),
+        }
+
+
+def create_app(mock: Optional[MockServer1] = None) -> FastAPI:
+    mock = mock or MockServer1.from_env()
+    app = FastAPI(title="server1 mock")
+    app.state.mock = mock
+
+    @app.post("/api/train/join")
+    async def train_join(queue_data: SectionQueueRequest, authorization: str = Header(None)):
+        if not authorization or not authorization.startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="Access token required")
+        await mock.delay()
+        if mock.fail():
+            return JSONResponse(status_code=503, content={"error": "Service unavailable"})
+        return mock.join(queue_data.user_id, queue_data.section_id)
+
+    @app.post("/api/train/join/bulk")
+    async def train_join_bulk(request: BulkJoinRequest, authorization: str = Header(None)):
+        if not authorization or not authorization.startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="Service token required")
+        if mock.service_token is not None and not hmac.compare_digest(authorization[len("Bearer "):], mock.service_token):
+            raise HTTPException(status_code=403, detail="Invalid service token")
+        if len(request.joins) > MAX_BULK_JOINS:
+            raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_JOINS} joins per request")
+        await mock.delay()
+        if mock.fail():
+            return JSONResponse(status_code=503, content={"error": "Service unavailable"})
+        mock.bulk_requests += 1
+        # 先頭から順に処理するので、同じリクエスト内の同じ区間のユーザー同士もマッチする
+        return {"results": [
+            dict(mock.join(join.user_id, join.section_id), user_id=join.user_id, status=200)
+            for join in request.joins
+        ]}
+
+    @app.get("/stats")
+    async def stats():
+        return mock.stats()
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock of server1 /api/train/join and /api/train/join/bulk")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--latency-ms", type=float, default=float(os.getenv("MOCK_SERVER1_LATENCY_MS", "0")))
+    parser.add_argument("--jitter-ms", type=float, default=float(os.getenv("MOCK_SERVER1_JITTER_MS", "0")))
+    parser.add_argument("--error-rate", type=float, default=float(os.getenv("MOCK_SERVER1_ERROR_RATE", "0")))
+    parser.add_argument("--service-token", default=os.getenv("MOCK_SERVER1_SERVICE_TOKEN") or None,
+                        help="token required by /api/train/join/bulk (any Bearer token if omitted)")
+    args = parser.parse_args()
+
+    import uvicorn
+    app = create_app(MockServer1(args.latency_ms, args.jitter_ms, args.error_rate, args.service_token))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
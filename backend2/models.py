@@ -1,6 +1,6 @@
-from pydantic import BaseModel
-from typing import Optional
-from datetime import datetime
+from pydantic import BaseModel, Field, field_validator
+from typing import Dict, List, Optional
+from datetime import datetime, timezone
 
 class LocationData(BaseModel):
     token: str
@@ -9,14 +9,85 @@ class LocationData(BaseModel):
     speed: Optional[float] = None
     direction: Optional[float] = None
 
+class TimedLocation(BaseModel):
+    timestamp: datetime
+    latitude: float
+    longitude: float
+    speed: Optional[float] = None
+    direction: Optional[float] = None
+
+    @field_validator("timestamp")
+    @classmethod
+    def to_utc(cls, value: datetime) -> datetime:
+        # タイムゾーンのない時刻はサーバーのローカル時刻とみなし、UTCにそろえる（混在しても並べ替えられるように）
+        return value.astimezone(timezone.utc)
+
+class LocationBatchData(BaseModel):
+    token: str
+    fixes: List[TimedLocation] = Field(..., min_length=1, max_length=1000)
+    # 送信した時点の端末の時刻（端末とサーバーの時計のずれを求めるのに使う）
+    sent_at: Optional[datetime] = None
+
+    @field_validator("sent_at")
+    @classmethod
+    def to_utc(cls, value: Optional[datetime]) -> Optional[datetime]:
+        return value.astimezone(timezone.utc) if value is not None else None
+
 class LineResponse(BaseModel):
     line: Optional[str] = None
     description: Optional[str] = None
 
+class LineBatchResponse(BaseModel):
+    # 軌跡全体から判定した、最後の位置で確定した区間
+    line: Optional[str] = None
+    description: Optional[str] = None
+    # timestamp順に並べた各位置の個別の判定結果
+    results: List[LineResponse]
+
 class SectionQueueRequest(BaseModel):
     user_id: int
     line: str
     section_id: str
+    # 前の通知が失敗・無応答だったときの再送（server1 は本人が有効なルームに入っていればルームを作らない）
+    retry: bool = False
+
+class BulkJoinRequest(BaseModel):
+    """POST /api/train/join/bulk（サービストークンで認証し、複数ユーザーの区間通知をまとめて送る）"""
+    joins: List[SectionQueueRequest]
+
+class JoinRoom(BaseModel):
+    """/api/train/join でマッチしたときに作られたルーム（user_id_1 が通知した本人、user_id_2 が相手）"""
+    id: int
+    user_id_1: int
+    user_id_2: int
+    expired_at: datetime
+
+class BulkJoinResult(BaseModel):
+    """joins の1件ごとの結果。status が200なら /api/train/join のレスポンスと同じ項目を持つ"""
+    user_id: int
+    status: int
+    message: Optional[str] = None
+    section_id: Optional[str] = None
+    expired_at: Optional[datetime] = None
+    room: Optional[JoinRoom] = None
+    error: Optional[str] = None
+
+class BulkJoinResponse(BaseModel):
+    # joins と同じ順番・同じ件数
+    results: List[BulkJoinResult]
+
+class OccupancyResponse(BaseModel):
+    total: int
+    # 路線名 / section_id -> 乗車中のユーザー数
+    lines: Dict[str, int]
+    sections: Dict[str, int]
+    # section_id -> server1でまだマッチしていないユーザー数
+    waiting: Dict[str, int]
+
+class SectionOccupancyResponse(BaseModel):
+    section_id: str
+    riders: int
+    waiting_user_ids: List[int]
 
 class User(BaseModel):
     id: int
@@ -0,0 +1,142 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+
+class Occupant:
+    """区間にいるユーザー1人分の記録"""
+    __slots__ = ("user_id", "line", "section_id", "last_seen", "matched")
+
+    def __init__(self, user_id: int, line: str, section_id: str, last_seen: float, matched: bool = False):
+        self.user_id = user_id
+        self.line = line
+        self.section_id = section_id
+        self.last_seen = last_seen
+        # server1でルームに入った（本人の通知でルームができたか、相手として選ばれた）か。
+        # 区間を移っても引き継ぎ、索引から外れる（降車・期限切れ）まで相手待ちには戻らない
+        self.matched = matched
+
+
+class SectionOccupancy:
+    """section_id ごとに今いるユーザーを持つメモリ上の索引
+
+    位置情報が届くたびに差分で更新し、最後の位置から ttl_seconds を過ぎたユーザーは
+    更新のついでに古い順から取り除く（OrderedDict の先頭だけを見るので償却 O(1)）。
+    区間・路線ごとの人数も差分で数えておくので、読み出しにテーブル走査は要らない。
+    索引はプロセスごとに持つため、複数ワーカーでは各ワーカーが受けたユーザーだけが見える。
+    """
+
+    def __init__(self, ttl_seconds: float = 600, max_entries: int = 100_000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # 最後に位置が届いた順に並ぶ
+        self._occupants: "OrderedDict[int, Occupant]" = OrderedDict()
+        self._sections: Dict[str, Set[int]] = {}
+        # server1でまだマッチしていない（相手待ちの）ユーザー
+        self._waiting: Dict[str, Set[int]] = {}
+        self._line_counts: Dict[str, int] = {}
+        self.expired = 0
+
+    @classmethod
+    def from_env(cls) -> "SectionOccupancy":
+        return cls(
+            ttl_seconds=float(os.getenv("OCCUPANCY_TTL_SECONDS", "600")),
+            max_entries=int(os.getenv("OCCUPANCY_MAX_ENTRIES", "100000")),
+        )
+
+    def update(self, user_id: int, line: Optional[str], section_id: Optional[str],
+               now: Optional[float] = None):
+        """ユーザーの現在の区間を記録する。区間がなければ索引から外す"""
+        now = time.time() if now is None else now
+        occupant = self._occupants.get(user_id)
+
+        if not line or not section_id:
+            if occupant is not None:
+                self._remove(occupant)
+        elif occupant is not None and occupant.section_id == section_id:
+            occupant.last_seen = now
+            self._occupants.move_to_end(user_id)
+        else:
+            matched = False
+            if occupant is not None:
+                matched = occupant.matched
+                self._remove(occupant)
+            self._add(Occupant(user_id, line, section_id, now, matched))
+
+        self.expire(now)
+
+    def mark_matched(self, user_id: int):
+        """server1でルームに入ったユーザー（作った本人と相手の両方）を相手待ちから外す"""
+        occupant = self._occupants.get(user_id)
+        if occupant is None or occupant.matched:
+            return
+        occupant.matched = True
+        self._discard(self._waiting, occupant.section_id, user_id)
+
+    def remove(self, user_id: int):
+        occupant = self._occupants.get(user_id)
+        if occupant is not None:
+            self._remove(occupant)
+
+    def expire(self, now: Optional[float] = None):
+        # 先頭ほど古いので、期限切れと上限超過分を先頭から落とす
+        now = time.time() if now is None else now
+        while self._occupants:
+            occupant = next(iter(self._occupants.values()))
+            if len(self._occupants) <= self.max_entries and now - occupant.last_seen <= self.ttl_seconds:
+                break
+            self._remove(occupant)
+            self.expired += 1
+
+    def _add(self, occupant: Occupant):
+        self._occupants[occupant.user_id] = occupant
+        self._sections.setdefault(occupant.section_id, set()).add(occupant.user_id)
+        if not occupant.matched:
+            self._waiting.setdefault(occupant.section_id, set()).add(occupant.user_id)
+        self._line_counts[occupant.line] = self._line_counts.get(occupant.line, 0) + 1
+
+    def _remove(self, occupant: Occupant):
+        del self._occupants[occupant.user_id]
+        self._discard(self._sections, occupant.section_id, occupant.user_id)
+        self._discard(self._waiting, occupant.section_id, occupant.user_id)
+        count = self._line_counts[occupant.line] - 1
+        if count:
+            self._line_counts[occupant.line] = count
+        else:
+            del self._line_counts[occupant.line]
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[int]], section_id: str, user_id: int):
+        users = index.get(section_id)
+        if users is None:
+            return
+        users.discard(user_id)
+        if not users:
+            del index[section_id]
+
+    def section_count(self, section_id: str) -> int:
+        return len(self._sections.get(section_id, ()))
+
+    def section_counts(self) -> Dict[str, int]:
+        return {section_id: len(users) for section_id, users in self._sections.items()}
+
+    def line_counts(self) -> Dict[str, int]:
+        return dict(self._line_counts)
+
+    def users(self, section_id: str) -> List[int]:
+        return list(self._sections.get(section_id, ()))
+
+    def waiting_users(self, section_id: str, exclude_user_id: Optional[int] = None) -> List[int]:
+        """区間でまだマッチしていないユーザー（マッチング相手の候補）"""
+        return [user_id for user_id in self._waiting.get(section_id, ()) if user_id != exclude_user_id]
+
+    def waiting_counts(self) -> Dict[str, int]:
+        return {section_id: len(users) for section_id, users in self._waiting.items()}
+
+    def section_of(self, user_id: int) -> Optional[str]:
+        occupant = self._occupants.get(user_id)
+        return occupant.section_id if occupant is not None else None
+
+    def __len__(self) -> int:
+        return len(self._occupants)
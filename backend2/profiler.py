@@ -0,0 +1,188 @@
+"""判定処理の一時的なプロファイリング（既定では無効）
+
+- cprofile: 位置情報の判定処理（同期部分）を sample_rate の割合でだけ cProfile で計測し、累積する
+- stack: イベントループのスレッドのスタックを一定間隔で記録し、flamegraph.pl / speedscope で読める
+  collapsed 形式（"関数;関数;関数 回数"）で出力する。トークン検証のDB待ちなども含めて見える
+
+無効の間は should_sample() の属性チェック1回しかかからない。
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cprofile", "stack", "both")
+
+
+class StackSampler:
+    """別スレッドから対象スレッドのスタックを interval 秒ごとに記録する"""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            # イベントループが次のイベントを待っているだけのサンプルは数だけ記録する
+            if frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+                self.idle_samples += 1
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            with self._lock:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+
+class PipelineProfiler:
+    def __init__(self, sample_rate: float = 0.01, stack_interval: float = 0.005):
+        self.sample_rate = sample_rate
+        self.stack_interval = stack_interval
+        self.mode: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.sampled_calls = 0
+        self._profile: Optional[cProfile.Profile] = None
+        self._active_profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[StackSampler] = None
+        self._last_sampler: Optional[StackSampler] = None
+        self._stop_handle: Optional[asyncio.TimerHandle] = None
+
+    @classmethod
+    def from_env(cls) -> "PipelineProfiler":
+        return cls(
+            sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0.01")),
+            stack_interval=float(os.getenv("PROFILE_STACK_INTERVAL_MS", "5")) / 1000,
+        )
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str = "both", sample_rate: Optional[float] = None,
+              seconds: Optional[float] = None):
+        """計測を始める。イベントループのスレッドから呼ぶこと（stack はこのスレッドを記録する）"""
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        self.stop()
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self.mode = mode
+        self.started_at = time.time()
+        self.sampled_calls = 0
+        self._profile = None
+        self._last_sampler = None
+
+        if mode in ("cprofile", "both"):
+            self._profile = cProfile.Profile()
+            self._active_profile = self._profile
+        if mode in ("stack", "both"):
+            self._sampler = StackSampler(threading.get_ident(), self.stack_interval)
+            self._last_sampler = self._sampler
+            self._sampler.start()
+
+        if seconds:
+            self._stop_handle = asyncio.get_running_loop().call_later(seconds, self.stop)
+        logger.warning(f"Profiling started: mode={mode}, sample_rate={self.sample_rate}, seconds={seconds}")
+
+    def stop(self):
+        """計測を止める。結果は次に start() するまで取り出せる"""
+        if self._stop_handle is not None:
+            self._stop_handle.cancel()
+            self._stop_handle = None
+        if self.mode is None:
+            return
+        self._active_profile = None
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        self.mode = None
+        logger.warning("Profiling stopped")
+
+    def should_sample(self) -> bool:
+        return self._active_profile is not None and random.random() < self.sample_rate
+
+    def call(self, function: Callable, *args):
+        """function を cProfile で計測しながら呼ぶ（同期関数のみ。await をまたぐと他のリクエストが混ざる）"""
+        profile = self._active_profile
+        if profile is None:
+            return function(*args)
+        try:
+            profile.enable()
+        except ValueError:
+            # 別のプロファイラが動いている
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            self.sampled_calls += 1
+
+    def _stats(self, stream=None) -> Optional[pstats.Stats]:
+        # まだ1回も計測していなければ Stats を作れない
+        if self._profile is None or not self.sampled_calls:
+            return None
+        return pstats.Stats(self._profile, stream=stream)
+
+    def pstats_dump(self) -> bytes:
+        """pstats 形式（snakeviz や python -m pstats で開ける）"""
+        stats = self._stats()
+        return marshal.dumps(stats.stats) if stats is not None else b""
+
+    def pstats_text(self, limit: int = 50) -> str:
+        out = io.StringIO()
+        stats = self._stats(out)
+        if stats is None:
+            return "no sampled calls\n"
+        stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def collapsed_stacks(self) -> str:
+        return self._last_sampler.collapsed() if self._last_sampler is not None else ""
+
+    def status(self) -> dict:
+        sampler = self._last_sampler
+        return {
+            "running": self.running,
+            "mode": self.mode,
+            "sample_rate": self.sample_rate,
+            "started_at": self.started_at,
+            "sampled_calls": self.sampled_calls,
+            "stack_samples": sampler.samples if sampler is not None else 0,
+            "idle_stack_samples": sampler.idle_samples if sampler is not None else 0,
+        }
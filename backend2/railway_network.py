@@ -0,0 +1,458 @@
+"""路線データ（駅の並びと座標）の読み込みとバイナリキャッシュ
+
+GTFS（routes/trips/stop_times/stops.txt）やGeoJSONから路線データを読み込み、
+駅座標・線路形状のfloat配列と文字列テーブルだけからなるバイナリファイルにコンパイルできる。
+コンパイル済みファイルは mmap で読み込むので、各ワーカーは解析なしで起動し、
+配列部分のページはプロセス間で共有される。ただし TrainDetector の線分・グリッドインデックスは
+この配列からプロセスごとに作る（ヒープに置くので共有されない。serve.py のように fork 前に作れば共有される）。
+
+    python railway_network.py compile path/to/gtfs_dir network.bin
+"""
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"TRNNET"
+FORMAT_VERSION = 2
+# magic(6) + version(2) + 路線数, 駅数, 線路形状の頂点数, 文字列テーブルのバイト数
+HEADER = struct.Struct("<6sHIIII")
+
+# GTFSのroute_typeのうち鉄道として扱うもの（路面電車・地下鉄・鉄道・モノレール）
+RAIL_ROUTE_TYPES = {0, 1, 2, 12}
+
+
+def _align8(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class RailwayNetwork:
+    """路線ごとに順序付けられた駅の列と駅間の線路形状を、連続した配列で保持する
+
+    路線 i の駅は station_lat / station_lon / station_names の
+    [line_offsets[i], line_offsets[i+1]) の範囲に並ぶ。
+    駅 j から次の駅までの途中の頂点（両端の駅を除く）は shape_lat / shape_lon の
+    [shape_offsets[j], shape_offsets[j+1]) の範囲に並ぶ。形状がなければ駅間は直線とみなす。
+    """
+
+    def __init__(self, line_ids: List[str], line_names: List[str],
+                 line_offsets: np.ndarray, station_names: List[str],
+                 station_lat: np.ndarray, station_lon: np.ndarray,
+                 shape_offsets: Optional[np.ndarray] = None,
+                 shape_lat: Optional[np.ndarray] = None,
+                 shape_lon: Optional[np.ndarray] = None):
+        self.line_ids = line_ids
+        self.line_names = line_names
+        self.line_offsets = line_offsets
+        self.station_names = station_names
+        self.station_lat = station_lat
+        self.station_lon = station_lon
+        if shape_offsets is None:
+            shape_offsets = np.zeros(len(station_names) + 1, dtype=np.int32)
+            shape_lat = np.zeros(0, dtype=np.float64)
+            shape_lon = np.zeros(0, dtype=np.float64)
+        self.shape_offsets = shape_offsets
+        self.shape_lat = shape_lat
+        self.shape_lon = shape_lon
+
+    @classmethod
+    def from_train_lines(cls, train_lines: Dict[str, dict]) -> "RailwayNetwork":
+        line_ids, line_names, offsets = [], [], [0]
+        station_names, lats, lons = [], [], []
+        shape_offsets, shape_lats, shape_lons = [0], [], []
+        for line_id, line_data in train_lines.items():
+            line_ids.append(line_id)
+            line_names.append(line_data["name"])
+            shapes = line_data.get("shapes") or []
+            for i, station in enumerate(line_data["stations"]):
+                station_names.append(station["name"])
+                lats.append(station["lat"])
+                lons.append(station["lon"])
+                for lat, lon in (shapes[i] if i < len(shapes) else []):
+                    shape_lats.append(lat)
+                    shape_lons.append(lon)
+                shape_offsets.append(len(shape_lats))
+            offsets.append(len(station_names))
+
+        return cls(
+            line_ids, line_names, np.array(offsets, dtype=np.int32),
+            station_names, np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64),
+            np.array(shape_offsets, dtype=np.int32),
+            np.array(shape_lats, dtype=np.float64), np.array(shape_lons, dtype=np.float64),
+        )
+
+    def section_shape(self, station_index: int) -> List[Tuple[float, float]]:
+        """駅 station_index から次の駅までの途中の頂点 (lat, lon) の一覧"""
+        start, stop = int(self.shape_offsets[station_index]), int(self.shape_offsets[station_index + 1])
+        return list(zip(self.shape_lat[start:stop].tolist(), self.shape_lon[start:stop].tolist()))
+
+    def to_train_lines(self) -> Dict[str, dict]:
+        """TrainDetector._load_train_data と同じ形式の辞書に戻す"""
+        lats = self.station_lat.tolist()
+        lons = self.station_lon.tolist()
+        train_lines = {}
+        for i, line_id in enumerate(self.line_ids):
+            start, stop = int(self.line_offsets[i]), int(self.line_offsets[i + 1])
+            train_lines[line_id] = {
+                "name": self.line_names[i],
+                "stations": [
+                    {"name": self.station_names[j], "lat": lats[j], "lon": lons[j]}
+                    for j in range(start, stop)
+                ],
+            }
+            if self.shape_offsets[stop] > self.shape_offsets[start]:
+                train_lines[line_id]["shapes"] = [
+                    [list(point) for point in self.section_shape(j)] for j in range(start, stop - 1)
+                ]
+        return train_lines
+
+    def save(self, path: str):
+        """バイナリ形式で書き出す（一時ファイルに書いてから置き換える）"""
+        strings = self.line_ids + self.line_names + self.station_names
+        encoded = [s.encode("utf-8") for s in strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=string_offsets[1:])
+        blob = b"".join(encoded)
+
+        arrays = [
+            self.station_lat.astype("<f8"),
+            self.station_lon.astype("<f8"),
+            self.line_offsets.astype("<i4"),
+            self.shape_offsets.astype("<i4"),
+            self.shape_lat.astype("<f8"),
+            self.shape_lon.astype("<f8"),
+            string_offsets.astype("<i8"),
+        ]
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION,
+                len(self.line_ids), len(self.station_names), len(self.shape_lat), len(blob),
+            ))
+            for array in arrays:
+                f.write(b"\0" * (_align8(f.tell()) - f.tell()))
+                f.write(array.tobytes())
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "RailwayNetwork":
+        """バイナリ形式を mmap で読み込む。配列はファイルのページをそのまま参照する"""
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from("<6sH", buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a compiled railway network (version {FORMAT_VERSION})")
+        _, _, n_lines, n_stations, n_shape_points, blob_size = HEADER.unpack_from(buf, 0)
+
+        offset = HEADER.size
+
+        def take(dtype: str, count: int) -> np.ndarray:
+            nonlocal offset
+            offset = _align8(offset)
+            array = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array
+
+        station_lat = take("<f8", n_stations)
+        station_lon = take("<f8", n_stations)
+        line_offsets = take("<i4", n_lines + 1)
+        shape_offsets = take("<i4", n_stations + 1)
+        shape_lat = take("<f8", n_shape_points)
+        shape_lon = take("<f8", n_shape_points)
+        string_offsets = take("<i8", 2 * n_lines + n_stations + 1).tolist()
+        blob = buf[offset:offset + blob_size]
+        strings = [
+            blob[string_offsets[i]:string_offsets[i + 1]].decode("utf-8")
+            for i in range(len(string_offsets) - 1)
+        ]
+
+        return cls(
+            strings[:n_lines], strings[n_lines:2 * n_lines], line_offsets,
+            strings[2 * n_lines:], station_lat, station_lon,
+            shape_offsets, shape_lat, shape_lon,
+        )
+
+
+def load_gtfs(directory: str, route_types=RAIL_ROUTE_TYPES) -> Dict[str, dict]:
+    """GTFSフィードから路線ごとの駅の並びと線路形状を読み込む
+
+    各路線について停車駅数が最も多いtripを代表として、その停車順を駅の並びとする。
+    代表tripに shape_id があれば shapes.txt の形状を駅ごとに分割して駅間の形状とする。
+    stop_times.txt は2回ストリーミングで読むだけで、全体をメモリに載せない。
+    """
+    def rows(name):
+        with open(os.path.join(directory, name), encoding="utf-8-sig", newline="") as f:
+            yield from csv.DictReader(f)
+
+    routes = {}
+    for row in rows("routes.txt"):
+        if route_types is None or int(row.get("route_type") or 2) in route_types:
+            routes[row["route_id"]] = row.get("route_long_name") or row.get("route_short_name") or row["route_id"]
+
+    trip_routes, trip_shapes = {}, {}
+    for row in rows("trips.txt"):
+        if row["route_id"] in routes:
+            trip_routes[row["trip_id"]] = row["route_id"]
+            trip_shapes[row["trip_id"]] = row.get("shape_id") or None
+
+    stop_counts: Dict[str, int] = defaultdict(int)
+    for row in rows("stop_times.txt"):
+        if row["trip_id"] in trip_routes:
+            stop_counts[row["trip_id"]] += 1
+
+    representative = {}
+    for trip_id, count in stop_counts.items():
+        route_id = trip_routes[trip_id]
+        if route_id not in representative or count > stop_counts[representative[route_id]]:
+            representative[route_id] = trip_id
+    representative_trips = set(representative.values())
+
+    trip_stops: Dict[str, list] = defaultdict(list)
+    for row in rows("stop_times.txt"):
+        if row["trip_id"] in representative_trips:
+            trip_stops[row["trip_id"]].append((int(row["stop_sequence"]), row["stop_id"]))
+
+    stops = {row["stop_id"]: row for row in rows("stops.txt")}
+
+    shape_ids = {trip_shapes[trip_id] for trip_id in representative_trips} - {None}
+    shape_points: Dict[str, list] = defaultdict(list)
+    if shape_ids and os.path.exists(os.path.join(directory, "shapes.txt")):
+        for row in rows("shapes.txt"):
+            if row["shape_id"] in shape_ids:
+                shape_points[row["shape_id"]].append(
+                    (int(row["shape_pt_sequence"]), float(row["shape_pt_lat"]), float(row["shape_pt_lon"]))
+                )
+
+    def station_of(stop_id):
+        # ホーム単位のstopは親駅にまとめる
+        stop = stops[stop_id]
+        parent = stop.get("parent_station")
+        if parent and parent in stops:
+            stop = stops[parent]
+        return {"name": stop["stop_name"], "lat": float(stop["stop_lat"]), "lon": float(stop["stop_lon"])}
+
+    train_lines = {}
+    for route_id, trip_id in representative.items():
+        stations = []
+        for _, stop_id in sorted(trip_stops[trip_id]):
+            station = station_of(stop_id)
+            if not stations or stations[-1]["name"] != station["name"]:
+                stations.append(station)
+        if len(stations) < 2:
+            continue
+
+        train_lines[route_id] = {"name": routes[route_id], "stations": stations}
+        points = shape_points.get(trip_shapes[trip_id])
+        if points:
+            train_lines[route_id]["shapes"] = split_shape([(lat, lon) for _, lat, lon in sorted(points)], stations)
+
+    return train_lines
+
+
+def split_shape(points: List[Tuple[float, float]], stations: List[dict]) -> List[List[List[float]]]:
+    """路線全体の形状を駅ごとに区切り、各駅間の途中の頂点の一覧を返す
+
+    各駅に最も近い頂点を、前の駅の位置から先に向かって順に探す。
+    """
+    def dist_sq(point, station):
+        return (point[0] - station["lat"]) ** 2 + (point[1] - station["lon"]) ** 2
+
+    cut_points = []
+    start = 0
+    for station in stations:
+        nearest = min(range(start, len(points)), key=lambda k: dist_sq(points[k], station))
+        cut_points.append(nearest)
+        start = nearest
+
+    return [
+        [list(point) for point in points[cut_points[i] + 1:cut_points[i + 1]]]
+        for i in range(len(stations) - 1)
+    ]
+
+
+def _chain_linestrings(pieces: List[List[Tuple[float, float]]]) -> List[Tuple[float, float]]:
+    """端点を共有する線路の断片をつないで1本の折れ線にする（分岐した断片は捨てる）"""
+    chain = list(pieces[0])
+    remaining = [list(piece) for piece in pieces[1:]]
+    extended = True
+    while remaining and extended:
+        extended = False
+        for piece in remaining:
+            if piece[0] == chain[-1]:
+                chain.extend(piece[1:])
+            elif piece[-1] == chain[-1]:
+                chain.extend(reversed(piece[:-1]))
+            elif piece[-1] == chain[0]:
+                chain[:0] = piece[:-1]
+            elif piece[0] == chain[0]:
+                chain[:0] = reversed(piece[1:])
+            else:
+                continue
+            remaining.remove(piece)
+            extended = True
+            break
+    return chain
+
+
+def _order_stations(stations: List[dict]) -> List[dict]:
+    """順序情報のない駅を、端の駅から最近傍をたどって一列に並べる（分岐のない路線向け）"""
+    def dist_sq(a, b):
+        return (a["lat"] - b["lat"]) ** 2 + (a["lon"] - b["lon"]) ** 2
+
+    remaining = list(stations)
+    # 任意の駅から最も遠い駅を路線の端とみなす
+    current = max(remaining, key=lambda s: dist_sq(s, remaining[0]))
+    ordered = []
+    while remaining:
+        remaining.remove(current)
+        ordered.append(current)
+        if remaining:
+            current = min(remaining, key=lambda s: dist_sq(s, current))
+    return ordered
+
+
+def load_geojson(path: str) -> Dict[str, dict]:
+    """GeoJSONの駅データと線路データから路線ごとの駅の並びと線路形状を読み込む
+
+    駅として次のどちらかの形式の Feature を受け付ける。
+    - Point: properties に line（路線名）, name（駅名）, 任意で seq（路線内の順序）
+    - 国土数値情報 鉄道データ(N02)の駅: properties に N02_003（路線名）, N02_004（運営会社）,
+      N02_005（駅名）。ジオメトリの頂点の平均を駅座標とし、順序は _order_stations で推定する
+    線路形状として次のどちらかの LineString を受け付け、つないだ上で駅ごとに分割する。
+    - properties に line（路線名）と kind: "track"
+    - N02の鉄道区間: properties に N02_003, N02_004 があり N02_005 がないもの
+    """
+    with open(path, encoding="utf-8") as f:
+        collection = json.load(f)
+
+    grouped: Dict[tuple, Dict[str, dict]] = defaultdict(dict)
+    tracks: Dict[tuple, list] = defaultdict(list)
+    for feature in collection.get("features", []):
+        props = feature.get("properties") or {}
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "LineString" and (
+            ("N02_003" in props and "N02_005" not in props) or props.get("kind") == "track"
+        ):
+            if "N02_003" in props:
+                key = (props.get("N02_004", ""), props["N02_003"])
+            else:
+                key = (props.get("line_id", props["line"]), props["line"])
+            tracks[key].append([(p[1], p[0]) for p in geometry["coordinates"]])
+            continue
+
+        if "N02_005" in props:
+            key = (props.get("N02_004", ""), props["N02_003"])
+            name = props["N02_005"]
+            seq = None
+        elif "line" in props and "name" in props:
+            key = (props.get("line_id", props["line"]), props["line"])
+            name = props["name"]
+            seq = props.get("seq")
+        else:
+            continue
+
+        if geometry.get("type") == "Point":
+            points = [geometry["coordinates"]]
+        elif geometry.get("type") == "LineString":
+            points = geometry["coordinates"]
+        else:
+            continue
+
+        station = grouped[key].setdefault(name, {"name": name, "seq": seq, "points": []})
+        station["points"].extend(points)
+
+    train_lines = {}
+    for (line_key, line_name), named_stations in grouped.items():
+        stations = []
+        for station in named_stations.values():
+            lons, lats = zip(*((p[0], p[1]) for p in station["points"]))
+            stations.append({
+                "name": station["name"],
+                "lat": sum(lats) / len(lats),
+                "lon": sum(lons) / len(lons),
+                "seq": station["seq"],
+            })
+
+        if all(s["seq"] is not None for s in stations):
+            stations.sort(key=lambda s: s["seq"])
+        else:
+            stations = _order_stations(stations)
+
+        if len(stations) < 2:
+            continue
+
+        line_id = f"{line_key}_{line_name}" if line_key != line_name else line_name
+        stations = [{k: s[k] for k in ("name", "lat", "lon")} for s in stations]
+        train_lines[line_id] = {"name": line_name, "stations": stations}
+        if tracks.get((line_key, line_name)):
+            track = _chain_linestrings(tracks[(line_key, line_name)])
+            # 線路の向きを駅の並びにそろえる
+            first, last = stations[0], stations[-1]
+            if ((track[0][0] - first["lat"]) ** 2 + (track[0][1] - first["lon"]) ** 2 >
+                    (track[0][0] - last["lat"]) ** 2 + (track[0][1] - last["lon"]) ** 2):
+                track.reverse()
+            train_lines[line_id]["shapes"] = split_shape(track, stations)
+
+    return train_lines
+
+
+def _source_mtime(path: str) -> float:
+    if os.path.isdir(path):
+        return max(os.path.getmtime(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getmtime(path)
+
+
+def load_network(path: str, cache_path: Optional[str] = None) -> RailwayNetwork:
+    """路線データを読み込む
+
+    path はコンパイル済みファイル（.bin）、GTFSディレクトリ、GeoJSONのいずれか。
+    cache_path を指定すると、元データより新しいコンパイル済みファイルがあればそれを使い、
+    なければコンパイルして保存する。
+    """
+    if path.endswith(".bin"):
+        return RailwayNetwork.load(path)
+
+    if cache_path and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= _source_mtime(path):
+        try:
+            return RailwayNetwork.load(cache_path)
+        except ValueError:
+            # 古い形式のキャッシュは作り直す
+            pass
+
+    if os.path.isdir(path):
+        network = RailwayNetwork.from_train_lines(load_gtfs(path))
+    else:
+        network = RailwayNetwork.from_train_lines(load_geojson(path))
+
+    if cache_path:
+        network.save(cache_path)
+        # 保存したファイルを読み直し、以降はmmapしたページを参照する
+        return RailwayNetwork.load(cache_path)
+    return network
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile railway network data into a binary cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser("compile", help="compile GTFS directory or GeoJSON file")
+    compile_parser.add_argument("source")
+    compile_parser.add_argument("output")
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        network = load_network(args.source)
+        network.save(args.output)
+        print(f"Compiled {len(network.line_ids)} lines, {len(network.station_names)} stations -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
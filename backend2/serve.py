@@ -0,0 +1,65 @@
+"""本番用の複数ワーカーサーバー（gunicorn + uvicorn ワーカー）
+
+アプリ（路線データ・セグメントの索引を含む）は親プロセスで1回だけ読み込み（preload_app）、
+gc.freeze() してから fork するので、各ワーカーはそれらをコピーオンライトで共有する。
+HUP シグナルでワーカーを入れ替えても、ワーカーは読み込み済みの親から fork されるので路線データは作り直さない。
+
+    WEB_CONCURRENCY=4 python serve.py
+    kill -HUP <親プロセスのPID>   # ワーカーを順に入れ替える（路線データは読み直さない）
+
+路線データを読み直すときは親プロセスごと再起動する。
+"""
+import gc
+import logging
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+logger = logging.getLogger(__name__)
+
+
+def when_ready(server):
+    # ここまでに読み込んだオブジェクトをGCの対象から外し、ワーカーでGCが共有ページに書き込まないようにする
+    gc.freeze()
+    server.log.info(f"Preloaded app; froze {gc.get_freeze_count()} objects before forking workers")
+
+
+def post_fork(server, worker):
+    # 親から引き継いだDB接続をワーカーで使い回さない（親では接続していないが念のため）
+    from database import async_engine, engine
+
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+
+
+class Backend2Server(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+        return app
+
+
+def options_from_env() -> dict:
+    return {
+        "bind": f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}",
+        "workers": int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count()))),
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        "timeout": int(os.getenv("WORKER_TIMEOUT", "60")),
+        "graceful_timeout": int(os.getenv("WORKER_GRACEFUL_TIMEOUT", "30")),
+        "keepalive": int(os.getenv("WORKER_KEEPALIVE", "5")),
+        "when_ready": when_ready,
+        "post_fork": post_fork,
+    }
+
+
+if __name__ == "__main__":
+    Backend2Server(options_from_env()).run()
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import random
+from typing import List, Optional
+
+import httpx
+
+from models import SectionQueueRequest
+
+logger = logging.getLogger(__name__)
+
+# 再試行する価値のあるステータス（一時的な過負荷・障害）
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+# /api/train/join でマッチが成立しルームが作られたときのメッセージ
+ROOM_CREATED_MESSAGE = "Successfully joined train and a room created"
+
+
+def room_created(result: dict) -> bool:
+    return result.get("message") == ROOM_CREATED_MESSAGE
+
+
+def room_partner(result: dict, user_id: int) -> Optional[int]:
+    """ルームができたときのレスポンスの room から相手のユーザーIDを返す（room のない古いserver1では None）"""
+    room = result.get("room")
+    if not isinstance(room, dict):
+        return None
+    members = {room.get("user_id_1"), room.get("user_id_2")}
+    if user_id not in members:
+        return None
+    members.discard(user_id)
+    partner = members.pop() if members else None
+    return partner if isinstance(partner, int) else None
+
+
+class Server1Client:
+    """server1への非同期HTTPクライアント
+
+    コネクションプール（keep-alive）を共有し、同時リクエスト数を制限した上で
+    一時的なエラーはジッター付きの指数バックオフで再試行する。イベントループをブロックしない。
+    service_token があれば、複数ユーザーの区間通知を bulk_join でまとめて送れる。
+    """
+
+    def __init__(self, base_url: str,
+                 timeout: float = 5.0,
+                 connect_timeout: float = 2.0,
+                 max_connections: int = 100,
+                 max_keepalive_connections: int = 20,
+                 max_concurrency: int = 50,
+                 max_retries: int = 2,
+                 retry_backoff: float = 0.2,
+                 service_token: Optional[str] = None):
+        self.base_url = base_url.rstrip("/")
+        self.service_token = service_token
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_env(cls) -> "Server1Client":
+        return cls(
+            base_url=os.getenv("SERVER1_URL", "http://localhost:3000"),
+            timeout=float(os.getenv("SERVER1_TIMEOUT", "5.0")),
+            connect_timeout=float(os.getenv("SERVER1_CONNECT_TIMEOUT", "2.0")),
+            max_connections=int(os.getenv("SERVER1_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("SERVER1_MAX_KEEPALIVE", "20")),
+            max_concurrency=int(os.getenv("SERVER1_MAX_CONCURRENCY", "50")),
+            max_retries=int(os.getenv("SERVER1_MAX_RETRIES", "2")),
+            retry_backoff=float(os.getenv("SERVER1_RETRY_BACKOFF", "0.2")),
+            service_token=os.getenv("SERVER1_SERVICE_TOKEN") or None,
+        )
+
+    async def start(self):
+        # ワーカープロセス内（イベントループ起動後）で作成する
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._semaphore = None
+
+    async def _post(self, path: str, token: str, payload: dict) -> httpx.Response:
+        await self.start()
+        headers = {
+            "Authorization": "Bearer " + token,
+            "Content-Type": "application/json",
+        }
+
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    response = await self._client.post(path, headers=headers, json=payload)
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+
+            # 再試行が同時に集中しないようジッターを入れる
+            await asyncio.sleep(random.uniform(0.5, 1.0) * self.retry_backoff * (2 ** attempt))
+            attempt += 1
+            # 前の試行が server1 に届いていたかもしれないので、再送であることを伝える
+            headers["X-Retry-Attempt"] = str(attempt)
+
+    async def join(self, token: str, queue_data: SectionQueueRequest) -> Optional[dict]:
+        """/api/train/join に区間を通知し、レスポンスのJSONを返す。失敗時はログを出してNoneを返す"""
+        try:
+            response = await self._post("/api/train/join", token, queue_data.dict())
+            logger.debug(f"User {queue_data.user_id} added to queue for line {queue_data.line}, section {queue_data.section_id}")
+        except httpx.HTTPError as e:
+            logger.error(f"Failed to notify server1: {e}")
+            return None
+
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+    async def bulk_join(self, joins: List[SectionQueueRequest]) -> Optional[List[Optional[dict]]]:
+        """/api/train/join/bulk に複数ユーザーの区間をまとめて通知する
+
+        joins と同じ順番で1件ごとの結果（成功なら join() と同じレスポンスのJSON、失敗ならNone）を返す。
+        リクエスト全体が失敗したときはログを出してNoneを返す。
+        """
+        if not self.service_token:
+            raise RuntimeError("SERVER1_SERVICE_TOKEN is required for bulk joins")
+        payload = {"joins": [join.dict() for join in joins]}
+        try:
+            response = await self._post("/api/train/join/bulk", self.service_token, payload)
+            results = response.json()["results"]
+        except httpx.HTTPError as e:
+            logger.error(f"Failed to notify server1 of {len(joins)} joins: {e}")
+            return None
+        except (ValueError, KeyError, TypeError):
+            logger.error("Invalid bulk join response from server1")
+            return None
+
+        if not isinstance(results, list):
+            logger.error("Invalid bulk join response from server1")
+            return None
+        if len(results) != len(joins):
+            logger.error(f"Bulk join returned {len(results)} results for {len(joins)} joins")
+            return None
+
+        joined: List[Optional[dict]] = []
+        for join, result in zip(joins, results):
+            if not isinstance(result, dict):
+                logger.warning(f"Bulk join returned an invalid result for user {join.user_id}: {result!r}")
+                joined.append(None)
+            elif result.get("user_id") != join.user_id or result.get("status") != 200:
+                logger.warning(f"Bulk join failed for user {join.user_id}: {result.get('status')} {result.get('error')}")
+                joined.append(None)
+            else:
+                joined.append(result)
+        logger.debug(f"Sent {len(joins)} joins to server1 in one request")
+        return joined
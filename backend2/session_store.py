@@ -0,0 +1,183 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class RiderSession:
+    """乗車中ユーザーの状態（最後の位置・判定した区間・server1へ最後に通知した区間）
+
+    10万人規模でもメモリが一定になるよう __slots__ で持ち、軌跡判定のスコアも候補数までに限る。
+    """
+    __slots__ = (
+        "user_id", "latitude", "longitude", "fix_time",
+        "line", "section_id", "confidence", "match_scores",
+        "joined_section_id", "joined_at", "last_seen", "client_fix_time",
+    )
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.latitude: Optional[float] = None
+        self.longitude: Optional[float] = None
+        self.fix_time = 0.0
+        self.line: Optional[str] = None
+        self.section_id: Optional[str] = None
+        self.confidence = 0.0
+        # section_id -> (対数スコア, 路線名, 路線内の区間番号)
+        self.match_scores: Dict[str, Tuple[float, str, int]] = {}
+        self.joined_section_id: Optional[str] = None
+        self.joined_at = 0.0
+        self.last_seen = 0.0
+        # バッチで反映した最後の位置の端末の時刻（fix_time はサーバーの時計なので比べない）
+        self.client_fix_time = 0.0
+
+    def to_json(self) -> str:
+        return json.dumps([getattr(self, name) for name in self.__slots__], ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data: str) -> "RiderSession":
+        values = json.loads(data)
+        session = cls(values[0])
+        for name, value in zip(cls.__slots__, values):
+            setattr(session, name, value)
+        session.match_scores = {key: tuple(value) for key, value in session.match_scores.items()}
+        return session
+
+
+class SessionStore:
+    """プロセス内のセッションストア。最終アクセスから ttl_seconds で期限切れ、max_sessions を超えたら古い順に捨てる
+
+    RedisSessionStore と同じく get / put などは async（Redisと差し替えられるように）。
+    """
+
+    def __init__(self, ttl_seconds: float = 3 * 60 * 60, max_sessions: int = 100_000):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        # 最終アクセス順に並ぶ
+        self._sessions: "OrderedDict[int, RiderSession]" = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, user_id: int) -> Optional[RiderSession]:
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        if time.time() - session.last_seen > self.ttl_seconds:
+            del self._sessions[user_id]
+            return None
+        return session
+
+    async def get_or_create(self, user_id: int) -> RiderSession:
+        session = await self.get(user_id)
+        return session if session is not None else RiderSession(user_id)
+
+    async def put(self, session: RiderSession):
+        now = time.time()
+        session.last_seen = now
+        self._sessions[session.user_id] = session
+        self._sessions.move_to_end(session.user_id)
+        self._evict(now)
+
+    async def mark_joined(self, user_id: int, section_id: str, joined_at: float):
+        """server1 に通知した区間だけを記録する（セッションは同じオブジェクトを共有しているので、ほかの値は書き戻さない）"""
+        session = self._sessions.get(user_id)
+        if session is not None:
+            session.joined_section_id = section_id
+            session.joined_at = joined_at
+
+    async def delete(self, user_id: int):
+        self._sessions.pop(user_id, None)
+
+    async def close(self):
+        pass
+
+    def _evict(self, now: float):
+        # 先頭ほど古いので、期限切れと上限超過分を先頭から落とす
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_seen <= self.ttl_seconds:
+                break
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class RedisSessionStore:
+    """複数ワーカーで共有するためのRedis版セッションストア（期限切れはRedisのTTLに任せる）
+
+    redis.asyncio を使うのでイベントループをブロックしない。セッション数（len）はメトリクスのたびに
+    キーを数えないよう、最終アクセス時刻をスコアにしたソート済み集合で数え、size_refresh_seconds ごとに更新した値を返す。
+    server1 に通知した区間は別のキーに置き、mark_joined でそれだけを書く
+    （位置の処理が読み込んだ古いセッションを put しても、通知済みの記録が消えないように）。
+    """
+
+    def __init__(self, url: str, ttl_seconds: float = 3 * 60 * 60, prefix: str = "backend2:session:",
+                 size_refresh_seconds: float = 10.0):
+        import redis.asyncio
+
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        # user_id -> 最終アクセス時刻（期限切れの分は数えるときに消す）
+        self._index_key = f"{prefix}index"
+        self.size_refresh_seconds = size_refresh_seconds
+        self._size = 0
+        self._size_checked = 0.0
+        self.evictions = 0
+
+    async def get(self, user_id: int) -> Optional[RiderSession]:
+        data, joined = await self._redis.mget(f"{self.prefix}{user_id}", f"{self.prefix}{user_id}:joined")
+        if data is None:
+            return None
+        session = RiderSession.from_json(data)
+        if joined is not None:
+            session.joined_section_id, session.joined_at = json.loads(joined)
+        return session
+
+    async def get_or_create(self, user_id: int) -> RiderSession:
+        session = await self.get(user_id)
+        return session if session is not None else RiderSession(user_id)
+
+    async def put(self, session: RiderSession):
+        now = time.time()
+        session.last_seen = now
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"{self.prefix}{session.user_id}", session.to_json(), ex=int(self.ttl_seconds))
+            pipe.expire(f"{self.prefix}{session.user_id}:joined", int(self.ttl_seconds))
+            pipe.zadd(self._index_key, {str(session.user_id): now})
+            refresh = now - self._size_checked >= self.size_refresh_seconds
+            if refresh:
+                self._size_checked = now
+                pipe.zremrangebyscore(self._index_key, "-inf", now - self.ttl_seconds)
+                pipe.zcard(self._index_key)
+            results = await pipe.execute()
+        if refresh:
+            self._size = results[-1]
+
+    async def mark_joined(self, user_id: int, section_id: str, joined_at: float):
+        await self._redis.set(f"{self.prefix}{user_id}:joined", json.dumps([section_id, joined_at], ensure_ascii=False),
+                              ex=int(self.ttl_seconds))
+
+    async def delete(self, user_id: int):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.delete(f"{self.prefix}{user_id}", f"{self.prefix}{user_id}:joined")
+            pipe.zrem(self._index_key, str(user_id))
+            await pipe.execute()
+
+    async def close(self):
+        await self._redis.aclose()
+
+    def __len__(self) -> int:
+        # 最後に数えた値（全ワーカーの合計。最大 size_refresh_seconds 古い）
+        return self._size
+
+
+def create_session_store():
+    """SESSION_STORE_URL（redis://...）があればRedis版、なければプロセス内のストアを作る"""
+    ttl_seconds = float(os.getenv("SESSION_TTL_SECONDS", str(3 * 60 * 60)))
+    url = os.getenv("SESSION_STORE_URL")
+    if url:
+        return RedisSessionStore(url, ttl_seconds)
+    return SessionStore(ttl_seconds, int(os.getenv("SESSION_MAX_ENTRIES", "100000")))
@@ -0,0 +1,83 @@
+import math
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# 緯度1度あたりの最小距離(km)。マージンを安全側に取るため赤道での値を使う
+KM_PER_DEG_LAT = 110.574
+KM_PER_DEG_LON_EQUATOR = 111.320
+
+
+class SegmentGridIndex:
+    """線分のバウンディングボックスを緯度経度グリッドに登録し、近傍の候補線分だけを返す
+
+    各線分は探索半径(km)ぶん広げたバウンディングボックスが重なるセルすべてに登録される。
+    そのため query() は点が属する1セルを見るだけで、探索半径内にある線分を取りこぼさない。
+    """
+
+    def __init__(self, radius_km: float, cell_size_deg: float = 0.01):
+        self.radius_km = radius_km
+        self.cell_size_deg = cell_size_deg
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_size_deg), math.floor(lon / self.cell_size_deg))
+
+    def insert(self, segment_id: int, lat1: float, lon1: float, lat2: float, lon2: float):
+        lat_margin = self.radius_km / KM_PER_DEG_LAT
+        max_abs_lat = min(max(abs(lat1), abs(lat2)) + lat_margin, 89.0)
+        # 高緯度側のcosを使い、さらに5%余裕を持たせて経度方向のマージンを過小評価しない
+        lon_margin = 1.05 * self.radius_km / (KM_PER_DEG_LON_EQUATOR * math.cos(math.radians(max_abs_lat)))
+
+        min_row, min_col = self._cell(min(lat1, lat2) - lat_margin, min(lon1, lon2) - lon_margin)
+        max_row, max_col = self._cell(max(lat1, lat2) + lat_margin, max(lon1, lon2) + lon_margin)
+
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                self._cells.setdefault((row, col), []).append(segment_id)
+
+    def insert_many(self, lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray,
+                    first_id: int = 0):
+        """線分 first_id, first_id+1, ... をまとめて登録する（結果は insert を順に呼んだ場合と同じ）
+
+        大きな路線網でも起動時間を抑えるため、登録するセルの範囲をNumPyで求め、セルごとの一覧を一度に作る。
+        """
+        if len(lat1) == 0:
+            return
+        lat_margin = self.radius_km / KM_PER_DEG_LAT
+        max_abs_lat = np.minimum(np.maximum(np.abs(lat1), np.abs(lat2)) + lat_margin, 89.0)
+        lon_margin = 1.05 * self.radius_km / (KM_PER_DEG_LON_EQUATOR * np.cos(np.radians(max_abs_lat)))
+
+        min_row = np.floor((np.minimum(lat1, lat2) - lat_margin) / self.cell_size_deg).astype(np.int64)
+        min_col = np.floor((np.minimum(lon1, lon2) - lon_margin) / self.cell_size_deg).astype(np.int64)
+        rows = np.floor((np.maximum(lat1, lat2) + lat_margin) / self.cell_size_deg).astype(np.int64) - min_row + 1
+        cols = np.floor((np.maximum(lon1, lon2) + lon_margin) / self.cell_size_deg).astype(np.int64) - min_col + 1
+
+        # 線分ごとに rows x cols 個の (行, 列, 線分ID) を並べる
+        counts = rows * cols
+        owner = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_rows = min_row[owner] + k // cols[owner]
+        cell_cols = min_col[owner] + k % cols[owner]
+
+        # セルごとにまとめ、セル内は線分IDの順（insert と同じ順）にする
+        order = np.lexsort((owner, cell_cols, cell_rows))
+        cell_rows, cell_cols = cell_rows[order], cell_cols[order]
+        # 同じ線分IDは同じintオブジェクトを共有させる（セルの数だけ別のintを作るとメモリが増える）
+        segment_ids = list(range(first_id, first_id + len(counts)))
+        ids = [segment_ids[i] for i in owner[order].tolist()]
+        starts = np.flatnonzero(np.r_[True, (cell_rows[1:] != cell_rows[:-1]) | (cell_cols[1:] != cell_cols[:-1])])
+        bounds = starts.tolist() + [len(ids)]
+        for i, (row, col) in enumerate(zip(cell_rows[starts].tolist(), cell_cols[starts].tolist())):
+            cell = self._cells.get((row, col))
+            if cell is None:
+                self._cells[(row, col)] = ids[bounds[i]:bounds[i + 1]]
+            else:
+                cell.extend(ids[bounds[i]:bounds[i + 1]])
+
+    def query(self, lat: float, lon: float) -> List[int]:
+        """点から探索半径内にある可能性のある線分IDの一覧を返す"""
+        return self._cells.get(self._cell(lat, lon), [])
+
+    def __len__(self) -> int:
+        return len(self._cells)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# backend2 のモジュールを import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main を import するテストはMySQLではなく一時的なSQLiteに接続する（接続は使うときまで張らない）
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("ASYNC_DATABASE_URL", "sqlite+aiosqlite:///:memory:")
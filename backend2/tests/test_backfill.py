@@ -0,0 +1,29 @@
+import csv
+
+import pytest
+
+import backfill
+
+
+@pytest.mark.parametrize("batch_max_segments", [0, 10_000], ids=["scalar", "batch"])
+def test_non_finite_coordinates_are_written_without_a_section(tmp_path, monkeypatch, batch_max_segments):
+    monkeypatch.setattr(backfill, "BATCH_MAX_SEGMENTS", batch_max_segments)
+    source = tmp_path / "pings.csv"
+    source.write_text(
+        "id,latitude,longitude\n"
+        "1,34.6697,135.5015\n"
+        "2,inf,135.5015\n"
+        "3,34.6697,-inf\n"
+        "4,nan,135.5015\n"
+        "5,,135.5015\n",
+        encoding="utf-8",
+    )
+    output = tmp_path / "result.csv"
+
+    progress = backfill.backfill([str(source)], str(output), workers=0, chunk_size=2)
+
+    with open(output, encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["section_id"] for row in rows] == ["御堂筋線_なんば_心斎橋", "", "", "", ""]
+    assert progress.rows == 5
+    assert progress.invalid == 4
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import check_schema
+
+
+class FakeMySQL:
+    """EXPLAIN の結果だけを返すMySQLの代わり"""
+
+    dialect = SimpleNamespace(name="mysql")
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, params):
+        return SimpleNamespace(mappings=lambda: self.rows)
+
+
+def plan(table, type_, key=None):
+    return {"table": table, "type": type_, "key": key, "rows": 1, "Extra": ""}
+
+
+def test_mysql_derived_tables_are_not_reported_as_full_scans():
+    engine = FakeMySQL([
+        plan("users", "ref", "idx_users_section_id_expired_at"),
+        plan("<subquery2>", "ALL"),
+        plan("rooms", "range", "idx_rooms_expired_at_user_id_1"),
+        plan("rooms", "range", "idx_rooms_expired_at_user_id_2"),
+        plan("<union2,3>", "ALL"),
+    ])
+    lines = check_schema.explain(engine, check_schema.HOT_QUERIES[1], {"users": "users", "rooms": "rooms"})
+    assert not any(line.startswith("FULL SCAN") for line in lines)
+
+
+def test_mysql_full_scans_of_real_tables_are_reported():
+    engine = FakeMySQL([plan("users", "ALL"), plan("<union2,3>", "ALL"), plan("rooms", "index", "PRIMARY")])
+    lines = check_schema.explain(engine, check_schema.HOT_QUERIES[1], {"users": "users", "rooms": "rooms"})
+    assert [line.startswith("FULL SCAN") for line in lines] == [True, False, True]
@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+from railway_network import RailwayNetwork
+from train_detector import TrainDetector
+
+
+def parallel_lines_network() -> RailwayNetwork:
+    """0.8km 間隔で並ぶ折れ線の路線（判定距離の境界・2つの路線の中間にかかるセルを多く作る）"""
+    train_lines = {}
+    for i in range(3):
+        stations, shapes = [], []
+        for j in range(6):
+            stations.append({"name": f"駅{i}-{j}", "lat": 34.60 + 0.0072 * i, "lon": 135.50 + 0.01 * j})
+            shapes.append([[34.60 + 0.0072 * i + 0.001 * (-1) ** k, 135.50 + 0.01 * j + 0.0025 * k] for k in (1, 2, 3)])
+        train_lines[f"line{i}"] = {"name": f"路線{i}", "stations": stations, "shapes": shapes[:-1]}
+    return RailwayNetwork.from_train_lines(train_lines)
+
+
+def sample_points(count: int, seed: int = 0):
+    random.seed(seed)
+    points = [(random.uniform(34.585, 34.63), random.uniform(135.49, 135.56)) for _ in range(count)]
+    # セルは2回目に来たときに判定するので、同じ点と同じセル内の近くの点をもう一度通す
+    return points + points + [(lat + random.uniform(-5e-5, 5e-5), lon + random.uniform(-5e-5, 5e-5))
+                              for lat, lon in points]
+
+
+@pytest.fixture(scope="module")
+def detectors():
+    network = parallel_lines_network()
+    return (TrainDetector(network, max_distance_from_line=0.5, cache_size=100_000),
+            TrainDetector(network, max_distance_from_line=0.5, cache_size=0))
+
+
+def test_cached_detect_train_matches_uncached(detectors):
+    cached, uncached = detectors
+    points = sample_points(4000)
+    assert [cached.detect_train(*point) for point in points] == [uncached.detect_train(*point) for point in points]
+    stats = cached.cell_cache.stats()
+    # キャッシュで答えたセルと、境界にかかるので計算し直したセルの両方がある
+    assert stats["hits"] > stats["bypasses"] > 0
+
+
+def test_cached_candidate_sections_match_uncached(detectors):
+    cached, uncached = detectors
+    for point in sample_points(4000, seed=1):
+        assert cached.find_candidate_sections(*point) == uncached.find_candidate_sections(*point)
+
+
+def test_reload_clears_the_cache():
+    detector = TrainDetector(parallel_lines_network(), max_distance_from_line=0.5, cache_size=1000)
+    point = (34.60, 135.52)
+    for _ in range(3):
+        assert detector.detect_train(*point)[0] == "路線0"
+    assert detector.cell_cache.stats()["size"] > 0
+
+    # 路線を別の場所に移した路線網に読み直すと、キャッシュした判定結果は使わない
+    moved = RailwayNetwork.from_train_lines({"far": {"name": "遠い路線", "stations": [
+        {"name": "A", "lat": 35.0, "lon": 136.0}, {"name": "B", "lat": 35.01, "lon": 136.01},
+    ]}})
+    detector.reload(moved)
+    stats = detector.cell_cache.stats()
+    assert stats["size"] == 0
+    assert stats["invalidations"] == 1
+    assert detector.detect_train(*point) == (None, None)
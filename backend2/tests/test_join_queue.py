@@ -0,0 +1,191 @@
+import asyncio
+
+import join_queue
+from join_queue import JoinJob, JoinQueue
+
+
+def job(user_id, section_id):
+    return JoinJob(user_id, f"token-{user_id}", "御堂筋線", section_id)
+
+
+async def wait_until(condition, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.001)
+
+
+class Recorder:
+    """送った通知を記録する send。release() するまで送信中のまま止めておける"""
+
+    def __init__(self, results=None, block=False):
+        self.sent = []
+        self.results = results
+        self._gate = asyncio.Event()
+        if not block:
+            self._gate.set()
+
+    def release(self):
+        self._gate.set()
+
+    async def __call__(self, job):
+        self.sent.append((job.user_id, job.section_id))
+        await self._gate.wait()
+        return True if self.results is None else self.results(job)
+
+
+def test_superseded_sections_are_coalesced():
+    async def run():
+        send = Recorder()
+        queue = JoinQueue(send, workers=1)
+        await queue.start()
+        # ワーカーが取り出す前に同じユーザーの区間が3回変わる
+        for section_id in ("a", "b", "c"):
+            assert queue.submit(job(1, section_id))
+        queue.submit(job(2, "x"))
+        await queue.stop()
+        return send.sent, queue.stats()
+
+    sent, stats = asyncio.run(run())
+    assert sent == [(1, "c"), (2, "x")]
+    assert stats["coalesced"] == 2
+    assert stats["sent"] == 2
+
+
+def test_same_section_while_in_flight_is_not_sent_twice():
+    async def run():
+        send = Recorder(block=True)
+        queue = JoinQueue(send, workers=2)
+        await queue.start()
+        queue.submit(job(1, "a"))
+        await wait_until(lambda: send.sent)
+        queue.submit(job(1, "a"))
+        send.release()
+        await queue.stop()
+        return send.sent
+
+    assert asyncio.run(run()) == [(1, "a")]
+
+
+def test_jobs_for_one_user_are_sent_in_order():
+    async def run():
+        send = Recorder(block=True)
+        queue = JoinQueue(send, workers=4)
+        await queue.start()
+        queue.submit(job(1, "a"))
+        await wait_until(lambda: send.sent)
+        # 1件目の送信中に積まれた通知は、他のワーカーが空いていても1件目が終わるまで送らない
+        queue.submit(job(1, "b"))
+        queue.submit(job(2, "x"))
+        await wait_until(lambda: (2, "x") in send.sent)
+        assert (1, "b") not in send.sent
+        send.release()
+        await queue.stop()
+        return send.sent
+
+    sent = asyncio.run(run())
+    assert [entry for entry in sent if entry[0] == 1] == [(1, "a"), (1, "b")]
+
+
+def test_failed_job_is_not_retried_when_a_newer_one_is_pending():
+    async def run():
+        send = Recorder(block=True, results=lambda job: job.section_id != "a")
+        queue = JoinQueue(send, workers=1, retry_base_seconds=0.001)
+        await queue.start()
+        queue.submit(job(1, "a"))
+        await wait_until(lambda: send.sent)
+        queue.submit(job(1, "b"))
+        send.release()
+        await queue.stop()
+        return send.sent, queue.stats()
+
+    sent, stats = asyncio.run(run())
+    assert sent == [(1, "a"), (1, "b")]
+    assert stats["retried"] == 0
+
+
+def test_retries_back_off_with_jitter_until_max_attempts(monkeypatch):
+    bounds = []
+
+    def uniform(low, high):
+        bounds.append(high)
+        return 0.0
+
+    monkeypatch.setattr(join_queue.random, "uniform", uniform)
+
+    async def run():
+        send = Recorder(results=lambda job: False)
+        queue = JoinQueue(send, workers=1, max_attempts=4, retry_base_seconds=0.1, retry_max_seconds=0.5)
+        await queue.start()
+        queue.submit(job(1, "a"))
+        await wait_until(lambda: queue.dropped == 1)
+        await queue.stop()
+        return send.sent, queue.stats()
+
+    sent, stats = asyncio.run(run())
+    assert sent == [(1, "a")] * 4
+    # 上限は 0.1 * 2^attempts で、retry_max_seconds で頭打ちになる
+    assert bounds == [0.2, 0.4, 0.5]
+    assert stats["retried"] == 3
+    assert stats["dropped"] == 1
+    assert stats["retrying"] == 0
+
+
+def test_batches_collect_jobs_from_many_users():
+    async def run():
+        batches = []
+
+        async def send_batch(jobs):
+            batches.append([(job.user_id, job.section_id) for job in jobs])
+            return [True] * len(jobs)
+
+        queue = JoinQueue(Recorder(), send_batch=send_batch, batch_window_seconds=0.05, max_batch_size=3)
+        await queue.start()
+        for user_id in range(5):
+            queue.submit(job(user_id, "a"))
+        await queue.stop()
+        return batches, queue.stats()
+
+    batches, stats = asyncio.run(run())
+    assert batches == [[(0, "a"), (1, "a"), (2, "a")], [(3, "a"), (4, "a")]]
+    assert stats["batches"] == 2
+    assert stats["sent"] == 5
+
+
+def test_batch_failures_are_retried_per_job():
+    async def run():
+        attempts = []
+
+        async def send_batch(jobs):
+            attempts.append([job.user_id for job in jobs])
+            return [job.user_id != 1 or len(attempts) > 1 for job in jobs]
+
+        queue = JoinQueue(Recorder(), send_batch=send_batch, batch_window_seconds=0.01, retry_base_seconds=0.001)
+        await queue.start()
+        queue.submit(job(0, "a"))
+        queue.submit(job(1, "a"))
+        await wait_until(lambda: queue.sent == 2)
+        await queue.stop()
+        return attempts
+
+    assert asyncio.run(run()) == [[0, 1], [1]]
+
+
+def test_zero_batch_window_sends_single_joins(monkeypatch):
+    monkeypatch.setenv("JOIN_BATCH_WINDOW_MS", "0")
+
+    async def send_batch(jobs):
+        raise AssertionError("batch sending is disabled")
+
+    async def run():
+        send = Recorder()
+        queue = JoinQueue.from_env(send, send_batch)
+        assert queue.send_batch is None
+        await queue.start()
+        queue.submit(job(1, "a"))
+        queue.submit(job(2, "b"))
+        await queue.stop()
+        return send.sent
+
+    assert sorted(asyncio.run(run())) == [(1, "a"), (2, "b")]
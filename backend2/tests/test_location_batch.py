@@ -0,0 +1,132 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from models import User
+
+UMEDA_YODOYABASHI = (34.6976, 135.4993)
+SHINSAIBASHI_HOMMACHI = (34.6773, 135.5001)
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    """server1 への通知の代わりに、通知した section_id を記録する"""
+    sections = []
+    monkeypatch.setattr(main, "notify_server1", lambda token, session, line, section_id: sections.append(section_id))
+    return sections
+
+
+@pytest.fixture
+def client(monkeypatch, submitted):
+    async def verify_user(db, token):
+        return User(id=int(token), email=f"{token}@example.com", token=token)
+
+    monkeypatch.setattr(main, "verify_user", verify_user)
+    return TestClient(main.app)
+
+
+SKEW = timedelta(hours=1)
+
+
+def iso(moment):
+    return moment.isoformat()
+
+
+def fix(timestamp, position):
+    return {"timestamp": timestamp, "latitude": position[0], "longitude": position[1]}
+
+
+def test_mixed_naive_and_aware_timestamps_are_sorted(client):
+    response = client.post("/api/set-location/batch", json={"token": "4001", "fixes": [
+        fix("2025-09-20T06:30:00Z", SHINSAIBASHI_HOMMACHI),
+        fix("2025-09-20T15:29:50+09:00", UMEDA_YODOYABASHI),
+    ]})
+    assert response.status_code == 200
+    body = response.json()
+    assert "梅田駅と淀屋橋駅" in body["results"][0]["description"]
+    assert "心斎橋駅と本町駅" in body["description"]
+
+    response = client.post("/api/set-location/batch", json={"token": "4002", "fixes": [
+        fix("2025-09-20T06:30:00Z", SHINSAIBASHI_HOMMACHI),
+        fix("2025-09-20T06:29:50", UMEDA_YODOYABASHI),
+    ]})
+    assert response.status_code == 200
+
+
+def test_fixes_older_than_the_last_live_fix_are_not_replayed(client, submitted):
+    response = client.post("/api/set-location", json={
+        "token": "4003", "latitude": SHINSAIBASHI_HOMMACHI[0], "longitude": SHINSAIBASHI_HOMMACHI[1],
+    })
+    assert "心斎橋駅と本町駅" in response.json()["description"]
+    assert submitted == ["御堂筋線_心斎橋_本町"]
+
+    # 端末でバッファしていた、ライブの位置より前の位置が遅れて届く（端末の時計は1時間進んでいる）
+    now = datetime.now(timezone.utc)
+    response = client.post("/api/set-location/batch", json={"token": "4003", "sent_at": iso(now + SKEW), "fixes": [
+        fix(iso(now + SKEW - timedelta(seconds=30)), UMEDA_YODOYABASHI),
+    ]})
+    body = response.json()
+    assert "梅田駅と淀屋橋駅" in body["results"][0]["description"]
+    assert "心斎橋駅と本町駅" in body["description"]
+    assert submitted == ["御堂筋線_心斎橋_本町"]
+    assert asyncio.run(main.session_store.get(4003)).section_id == "御堂筋線_心斎橋_本町"
+
+
+def test_fresh_fixes_from_a_slow_clock_are_replayed_after_a_live_fix(client, submitted):
+    client.post("/api/set-location", json={
+        "token": "4005", "latitude": UMEDA_YODOYABASHI[0], "longitude": UMEDA_YODOYABASHI[1],
+    })
+    assert submitted == ["御堂筋線_梅田_淀屋橋"]
+
+    # 端末の時計が1時間遅れていても、ライブの位置より後の位置として反映する
+    now = datetime.now(timezone.utc) - SKEW
+    for with_sent_at in (True, False):
+        submitted.clear()
+        response = client.post("/api/set-location/batch", json={
+            "token": "4005", "sent_at": iso(now) if with_sent_at else None,
+            "fixes": [fix(iso(now), SHINSAIBASHI_HOMMACHI)],
+        })
+        assert "心斎橋駅と本町駅" in response.json()["description"]
+        assert submitted == ["御堂筋線_心斎橋_本町"]
+        now += timedelta(seconds=10)
+
+
+def test_batches_are_ordered_by_the_client_clock(client, submitted):
+    now = datetime.now(timezone.utc) + SKEW
+    client.post("/api/set-location/batch", json={"token": "4006", "fixes": [
+        fix(iso(now), SHINSAIBASHI_HOMMACHI),
+    ]})
+    assert submitted == ["御堂筋線_心斎橋_本町"]
+
+    # 前のバッチより前の位置は、sent_at がなくても反映しない
+    response = client.post("/api/set-location/batch", json={"token": "4006", "fixes": [
+        fix(iso(now - timedelta(seconds=30)), UMEDA_YODOYABASHI),
+    ]})
+    assert "心斎橋駅と本町駅" in response.json()["description"]
+    assert submitted == ["御堂筋線_心斎橋_本町"]
+
+
+def test_each_fix_is_detected_once(client, monkeypatch):
+    calls = []
+    detector = main.train_detector
+    find_candidate_sections, detect_batch = detector.find_candidate_sections, detector.detect_batch
+
+    def counting_find(lat, lon):
+        calls.append((lat, lon))
+        return find_candidate_sections(lat, lon)
+
+    def counting_batch(lats, lons, *args):
+        calls.extend(zip(lats, lons))
+        return detect_batch(lats, lons, *args)
+
+    monkeypatch.setattr(detector, "find_candidate_sections", counting_find)
+    monkeypatch.setattr(detector, "detect_batch", counting_batch)
+    response = client.post("/api/set-location/batch", json={"token": "4004", "fixes": [
+        fix("2025-09-20T06:29:50Z", UMEDA_YODOYABASHI),
+        fix("2025-09-20T06:30:00Z", SHINSAIBASHI_HOMMACHI),
+    ]})
+    assert response.status_code == 200
+    assert len(calls) == 2
@@ -0,0 +1,41 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from models import User
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def verify_user(db, token):
+        return User(id=int(token), email=f"{token}@example.com", token=token)
+
+    monkeypatch.setattr(main, "verify_user", verify_user)
+    monkeypatch.setattr(main, "notify_server1", lambda token, session, line, section_id: None)
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("message", ["[NaN, 135.5]", '["nan", 135.5]', '[34.67, "inf"]', "[34.67, 135.5, Infinity]"])
+def test_parse_compact_fix_rejects_non_finite_values(message):
+    with pytest.raises(ValueError):
+        main.parse_compact_fix(message)
+
+
+def test_bad_fixes_get_an_error_frame_and_keep_the_connection(client, monkeypatch):
+    process_location = main.process_location
+    calls = []
+
+    async def failing_once(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return await process_location(*args)
+
+    monkeypatch.setattr(main, "process_location", failing_once)
+    with client.websocket_connect("/ws/location?token=5001") as websocket:
+        websocket.send_text('["nan", 135.5]')
+        assert "error" in websocket.receive_json()
+        websocket.send_text("[34.6697, 135.5015]")
+        assert "error" in websocket.receive_json()
+        websocket.send_text("[34.6697, 135.5015]")
+        assert websocket.receive_json()["line"] == "御堂筋線"
@@ -0,0 +1,64 @@
+import pytest
+
+from map_matcher import TrajectoryMatcher
+from session_store import RiderSession
+from train_detector import TrainDetector
+
+NAMBA_SHINSAIBASHI = "御堂筋線_なんば_心斎橋"
+SHINSAIBASHI_HOMMACHI = "御堂筋線_心斎橋_本町"
+
+
+@pytest.fixture(scope="module")
+def detector():
+    return TrainDetector(max_distance_from_line=1.0, cache_size=0)
+
+
+def stations(detector, *names):
+    by_name = {station["name"]: station for station in detector.get_line("御堂筋線")["stations"]}
+    return [(by_name[name]["lat"], by_name[name]["lon"]) for name in names]
+
+
+def along(detector, station, toward, km):
+    """station から toward の駅に向かって km 進んだ位置"""
+    length = detector._calculate_distance(*station, *toward)
+    t = km / length
+    return station[0] + (toward[0] - station[0]) * t, station[1] + (toward[1] - station[1]) * t
+
+
+def replay(matcher, positions):
+    session = RiderSession(1)
+    return [matcher.update(session, lat, lon, timestamp=5.0 * i)[1] for i, (lat, lon) in enumerate(positions)]
+
+
+def approach(detector):
+    """なんばから心斎橋の手前まで 100m おきに進む"""
+    namba, shinsaibashi = stations(detector, "なんば", "心斎橋")
+    length = detector._calculate_distance(*namba, *shinsaibashi)
+    return [along(detector, namba, shinsaibashi, 0.1 * k) for k in range(1, int(length / 0.1))]
+
+
+def test_jitter_around_a_station_does_not_flip_the_section(detector):
+    namba, shinsaibashi, hommachi = stations(detector, "なんば", "心斎橋", "本町")
+    # 心斎橋の前後30mでGPSが揺れる
+    jitter = [
+        along(detector, shinsaibashi, namba if k % 2 else hommachi, 0.03)
+        for k in range(10)
+    ]
+    # 1件ずつの判定では区間が入れ替わる揺れ
+    assert {detector.detect_train(*position)[1] for position in jitter} == {NAMBA_SHINSAIBASHI, SHINSAIBASHI_HOMMACHI}
+
+    matched = replay(TrajectoryMatcher(detector), approach(detector) + jitter)
+    assert set(matched) == {NAMBA_SHINSAIBASHI}
+
+
+def test_section_change_is_picked_up_within_three_fixes(detector):
+    shinsaibashi, hommachi = stations(detector, "心斎橋", "本町")
+    # 心斎橋を過ぎて 50m おきに本町へ進む
+    departure = [along(detector, shinsaibashi, hommachi, 0.05 * k) for k in range(1, 11)]
+
+    matched = replay(TrajectoryMatcher(detector), approach(detector) + departure)
+    after = matched[-len(departure):]
+    assert SHINSAIBASHI_HOMMACHI in after[:3]
+    # 一度切り替わったら戻らない
+    first = after.index(SHINSAIBASHI_HOMMACHI)
+    assert set(after[first:]) == {SHINSAIBASHI_HOMMACHI}
@@ -0,0 +1,90 @@
+from fastapi.testclient import TestClient
+
+import main
+from occupancy import SectionOccupancy
+from server1_client import room_partner
+
+LINE = "御堂筋線"
+UMEDA = "御堂筋線_梅田_淀屋橋"
+YODOYABASHI = "御堂筋線_本町_淀屋橋"
+
+
+def test_matched_state_is_kept_across_section_moves():
+    occupancy = SectionOccupancy()
+    occupancy.update(1, LINE, UMEDA, now=0)
+    occupancy.update(2, LINE, UMEDA, now=0)
+    occupancy.mark_matched(1)
+    occupancy.mark_matched(2)
+    assert occupancy.waiting_users(UMEDA) == []
+
+    # 次の駅間に移っても、ルームに入ったユーザーは相手待ちに戻らない
+    occupancy.update(1, LINE, YODOYABASHI, now=1)
+    occupancy.update(2, LINE, YODOYABASHI, now=1)
+    assert occupancy.section_count(YODOYABASHI) == 2
+    assert occupancy.waiting_users(YODOYABASHI) == []
+    assert occupancy.waiting_counts() == {}
+
+
+def test_matched_state_is_cleared_when_leaving_or_expiring():
+    occupancy = SectionOccupancy(ttl_seconds=10)
+    occupancy.update(1, LINE, UMEDA, now=0)
+    occupancy.update(2, LINE, UMEDA, now=0)
+    occupancy.mark_matched(1)
+    occupancy.mark_matched(2)
+
+    occupancy.update(1, None, None, now=1)
+    occupancy.update(1, LINE, UMEDA, now=2)
+    assert occupancy.waiting_users(UMEDA) == [1]
+
+    occupancy.update(3, LINE, YODOYABASHI, now=20)
+    occupancy.update(2, LINE, UMEDA, now=20)
+    assert sorted(occupancy.waiting_users(UMEDA)) == [2]
+
+
+def test_partner_from_the_room_in_server1_response_is_marked_matched():
+    occupancy = SectionOccupancy()
+    occupancy.update(1, LINE, UMEDA, now=0)
+    occupancy.update(2, LINE, UMEDA, now=0)
+    result = {
+        "message": "Successfully joined train and a room created",
+        "room": {"id": 5, "user_id_1": 2, "user_id_2": 1, "expired_at": "2025-01-02T00:00:00Z"},
+    }
+    assert room_partner(result, 2) == 1
+    occupancy.mark_matched(2)
+    occupancy.mark_matched(room_partner(result, 2))
+    assert occupancy.waiting_counts() == {}
+
+
+def test_room_partner_without_room_info():
+    assert room_partner({"message": "Successfully joined train and a room created"}, 2) is None
+    assert room_partner({"room": {"user_id_1": 3, "user_id_2": 4}}, 2) is None
+    assert room_partner({"room": "broken"}, 2) is None
+
+
+def test_join_response_marks_both_room_members(monkeypatch):
+    import asyncio
+
+    import main
+    from join_queue import JoinJob
+
+    occupancy = SectionOccupancy()
+    monkeypatch.setattr(main, "occupancy", occupancy)
+    occupancy.update(1, LINE, UMEDA)
+    occupancy.update(2, LINE, UMEDA)
+    result = {
+        "message": "Successfully joined train and a room created",
+        "section_id": UMEDA,
+        "room": {"id": 5, "user_id_1": 2, "user_id_2": 1, "expired_at": "2025-01-02T00:00:00Z"},
+    }
+    assert asyncio.run(main.joined(JoinJob(2, "token", LINE, UMEDA), result))
+    assert occupancy.waiting_counts() == {}
+
+
+def test_occupancy_endpoints_require_the_admin_token(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "admin-secret")
+    client = TestClient(main.app)
+
+    for path in ("/api/occupancy", f"/api/occupancy/{UMEDA}"):
+        assert client.get(path).status_code == 403
+        assert client.get(path, headers={"X-Admin-Token": "wrong"}).status_code == 403
+        assert client.get(path, headers={"X-Admin-Token": "admin-secret"}).status_code == 200
@@ -0,0 +1,131 @@
+import os
+import shutil
+import struct
+
+import pytest
+
+import railway_network
+from railway_network import RailwayNetwork, load_geojson, load_gtfs, load_network, split_shape
+from train_detector import TrainDetector
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+GTFS = os.path.join(FIXTURES, "gtfs")
+
+
+def segments(network):
+    return TrainDetector(network, cache_size=0)._segments
+
+
+def test_gtfs_stations_follow_stop_sequence():
+    train_lines = load_gtfs(GTFS)
+
+    # バス路線は読まない。停車駅の最も多い trip を代表とし、ホームは親駅にまとめる
+    assert list(train_lines) == ["R1"]
+    line = train_lines["R1"]
+    assert line["name"] == "テスト線"
+    assert line["stations"] == [
+        {"name": "A駅", "lat": 34.0, "lon": 135.0},
+        {"name": "B駅", "lat": 34.01, "lon": 135.0},
+        {"name": "C駅", "lat": 34.02, "lon": 135.01},
+    ]
+    # shapes.txt も shape_pt_sequence 順に並べてから駅で区切る
+    assert line["shapes"] == [[[34.005, 135.001]], [[34.015, 135.006]]]
+
+
+def test_split_shape_cuts_at_the_nearest_vertex_after_the_previous_station():
+    stations = [{"lat": 0.0, "lon": 0.0}, {"lat": 0.0, "lon": 2.0}, {"lat": 0.0, "lon": 0.1}]
+    # 折り返す路線で、3駅目は1駅目の近くにあるが、2駅目より先の頂点で区切る
+    points = [(0.0, 0.0), (0.1, 1.0), (0.0, 2.0), (0.1, 1.0), (0.0, 0.1)]
+
+    assert split_shape(points, stations) == [[[0.1, 1.0]], [[0.1, 1.0]]]
+
+
+def test_binary_round_trip_keeps_segments(tmp_path):
+    network = RailwayNetwork.from_train_lines(load_gtfs(GTFS))
+    path = str(tmp_path / "network.bin")
+    network.save(path)
+    loaded = RailwayNetwork.load(path)
+
+    assert loaded.line_ids == network.line_ids
+    assert loaded.station_names == network.station_names
+    assert loaded.to_train_lines() == network.to_train_lines()
+    assert segments(loaded) == segments(network)
+    assert [segment.section_id for segment in segments(loaded)] == [
+        "テスト線_A駅_B駅", "テスト線_A駅_B駅", "テスト線_B駅_C駅", "テスト線_B駅_C駅",
+    ]
+
+
+def test_load_rejects_another_format_version(tmp_path):
+    path = str(tmp_path / "network.bin")
+    RailwayNetwork.from_train_lines(load_gtfs(GTFS)).save(path)
+    with open(path, "r+b") as f:
+        f.seek(6)
+        f.write(struct.pack("<H", railway_network.FORMAT_VERSION + 1))
+
+    with pytest.raises(ValueError):
+        RailwayNetwork.load(path)
+    # キャッシュとして指定した古い形式のファイルは作り直す
+    network = load_network(GTFS, cache_path=path)
+    assert network.line_names == ["テスト線"]
+    assert RailwayNetwork.load(path).line_names == ["テスト線"]
+
+
+def test_stale_cache_is_recompiled(tmp_path):
+    source = str(tmp_path / "gtfs")
+    shutil.copytree(GTFS, source)
+    cache_path = str(tmp_path / "network.bin")
+    assert load_network(source, cache_path=cache_path).line_names == ["テスト線"]
+
+    # キャッシュより新しい元データは読み直す
+    routes = os.path.join(source, "routes.txt")
+    with open(routes, encoding="utf-8") as f:
+        text = f.read()
+    with open(routes, "w", encoding="utf-8") as f:
+        f.write(text.replace("テスト線", "新テスト線"))
+    cache_mtime = os.path.getmtime(cache_path)
+    os.utime(routes, (cache_mtime + 10, cache_mtime + 10))
+    assert load_network(source, cache_path=cache_path).line_names == ["新テスト線"]
+
+    # キャッシュの方が新しければ元データは読まない
+    with open(routes, "w", encoding="utf-8") as f:
+        f.write(text.replace("テスト線", "読まれない線"))
+    os.utime(routes, (cache_mtime - 10, cache_mtime - 10))
+    os.utime(cache_path, (cache_mtime + 20, cache_mtime + 20))
+    assert load_network(source, cache_path=cache_path).line_names == ["新テスト線"]
+
+
+def polyline(network):
+    """区間ごとの折れ線の頂点 (lat, lon)"""
+    vertices = {}
+    for segment in segments(network):
+        points = vertices.setdefault(segment.section_id, [(segment.lat1, segment.lon1)])
+        points.append((segment.lat2, segment.lon2))
+    return {section_id: [pytest.approx(point) for point in points] for section_id, points in vertices.items()}
+
+
+def test_geojson_with_line_name_seq_and_track():
+    network = load_network(os.path.join(FIXTURES, "custom_line.geojson"))
+
+    assert network.line_ids == ["テスト線"]
+    assert network.station_names == ["A駅", "B駅", "C駅"]
+    # 逆向きの断片もつなぎ、駅の並びの向きにそろえて駅ごとに分割する
+    assert polyline(network) == {
+        "テスト線_A駅_B駅": [(34.0, 135.0), (34.005, 135.001), (34.01, 135.0)],
+        "テスト線_B駅_C駅": [(34.01, 135.0), (34.015, 135.006), (34.02, 135.01)],
+    }
+
+
+def test_geojson_in_n02_format():
+    train_lines = load_geojson(os.path.join(FIXTURES, "n02_line.geojson"))
+
+    # 路線IDは運営会社と路線名から作り、駅の並びは端の駅から推定する
+    assert list(train_lines) == ["テスト鉄道_テスト線"]
+    stations = train_lines["テスト鉄道_テスト線"]["stations"]
+    assert [station["name"] for station in stations] == ["C駅", "B駅", "A駅"]
+    # 駅のジオメトリの頂点の平均を駅座標にする
+    assert (stations[2]["lat"], stations[2]["lon"]) == pytest.approx((34.0, 135.0))
+
+    assert polyline(RailwayNetwork.from_train_lines(train_lines)) == {
+        "テスト線_B駅_C駅": [(34.02, 135.01), (34.015, 135.006), (34.01, 135.0)],
+        "テスト線_A駅_B駅": [(34.01, 135.0), (34.005, 135.001), (34.0, 135.0)],
+    }
@@ -0,0 +1,70 @@
+import asyncio
+
+import httpx
+
+import main
+from join_queue import JoinJob
+from models import SectionQueueRequest
+from server1_client import Server1Client
+
+
+def joins(*user_ids):
+    return [SectionQueueRequest(user_id=user_id, line="御堂筋線", section_id="御堂筋線_なんば_心斎橋") for user_id in user_ids]
+
+
+def bulk_join(monkeypatch, body, requests):
+    client = Server1Client("http://server1.test", service_token="service-token")
+
+    async def post(path, token, payload):
+        return httpx.Response(200, json=body)
+
+    monkeypatch.setattr(client, "_post", post)
+    return asyncio.run(client.bulk_join(requests))
+
+
+def test_bulk_join_treats_non_dict_results_as_failures(monkeypatch):
+    ok = {"user_id": 3, "status": 200, "message": "Successfully joined train"}
+    results = bulk_join(monkeypatch, {"results": [None, "error", ok]}, joins(1, 2, 3))
+
+    assert results == [None, None, ok]
+
+
+def test_bulk_join_rejects_results_that_are_not_a_list(monkeypatch):
+    assert bulk_join(monkeypatch, {"results": {"user_id": 1, "status": 200}}, joins(1)) is None
+    assert bulk_join(monkeypatch, ["not", "an", "object"], joins(1)) is None
+
+
+def test_resent_requests_are_marked_as_retries():
+    seen = []
+
+    def handler(request):
+        seen.append(request.headers.get("X-Retry-Attempt"))
+        return httpx.Response(503 if len(seen) == 1 else 200, json={"message": "Successfully joined train"})
+
+    async def run():
+        client = Server1Client("http://server1.test", retry_backoff=0)
+        client._client = httpx.AsyncClient(base_url=client.base_url, transport=httpx.MockTransport(handler))
+        client._semaphore = asyncio.Semaphore(1)
+        try:
+            return await client.join("user-token", joins(1)[0])
+        finally:
+            await client.close()
+
+    assert asyncio.run(run()) == {"message": "Successfully joined train"}
+    assert seen == [None, "1"]
+
+
+def test_queued_resends_carry_the_retry_flag(monkeypatch):
+    sent = []
+
+    async def join(token, queue_data):
+        sent.append(queue_data.retry)
+        return None
+
+    monkeypatch.setattr(main.server1_client, "join", join)
+    job = JoinJob(1, "user-token", "御堂筋線", "御堂筋線_なんば_心斎橋")
+    asyncio.run(main.send_join(job))
+    job.attempts = 1
+    asyncio.run(main.send_join(job))
+
+    assert sent == [False, True]
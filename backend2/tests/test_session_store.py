@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from session_store import RedisSessionStore, SessionStore
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def redis_store():
+    store = RedisSessionStore("redis://localhost:6379/0")
+    store._redis = fakeredis.aioredis.FakeRedis()
+    return store
+
+
+@pytest.mark.parametrize("create_store", [SessionStore, redis_store])
+def test_stale_put_keeps_the_joined_section(create_store):
+    async def run():
+        store = create_store()
+        session = await store.get_or_create(1)
+        await store.put(session)
+
+        # 位置の処理がセッションを読んだ後に通知が終わり、その後で読んだときのセッションを書き戻す
+        stale = await store.get(1)
+        await store.mark_joined(1, "御堂筋線_梅田_淀屋橋", 100.0)
+        stale.section_id = "御堂筋線_梅田_淀屋橋"
+        await store.put(stale)
+
+        session = await store.get(1)
+        await store.close()
+        return session
+
+    session = asyncio.run(run())
+    assert session.section_id == "御堂筋線_梅田_淀屋橋"
+    assert (session.joined_section_id, session.joined_at) == ("御堂筋線_梅田_淀屋橋", 100.0)
+
+
+def test_delete_removes_the_joined_section():
+    async def run():
+        store = redis_store()
+        await store.put(await store.get_or_create(2))
+        await store.mark_joined(2, "御堂筋線_梅田_淀屋橋", 100.0)
+        await store.delete(2)
+        await store.put(await store.get_or_create(2))
+        session = await store.get(2)
+        await store.close()
+        return session
+
+    assert asyncio.run(run()).joined_section_id is None
@@ -0,0 +1,24 @@
+import time
+
+import jwt
+import pytest
+
+from token_cache import TokenVerifier
+
+
+@pytest.mark.parametrize("secret", ["", "your-secret-key"])
+def test_local_jwt_verification_is_disabled_without_a_real_secret(monkeypatch, secret):
+    monkeypatch.setenv("TOKEN_VERIFY_JWT_LOCALLY", "true")
+    monkeypatch.setenv("JWT_SECRET", secret)
+    assert TokenVerifier.from_env().jwt_secret is None
+
+
+def test_local_jwt_verification(monkeypatch):
+    monkeypatch.setenv("TOKEN_VERIFY_JWT_LOCALLY", "true")
+    monkeypatch.setenv("JWT_SECRET", "shared-with-server1")
+    verifier = TokenVerifier.from_env()
+
+    token = jwt.encode({"userId": 7, "exp": int(time.time()) + 60}, "shared-with-server1", algorithm="HS256")
+    assert verifier._verify_jwt(token).id == 7
+    forged = jwt.encode({"userId": 7, "exp": int(time.time()) + 60}, "your-secret-key", algorithm="HS256")
+    assert verifier._verify_jwt(forged) is None
@@ -0,0 +1,139 @@
+import math
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import train_detector
+from train_detector import KM_PER_DEG, TrainDetector
+
+# 御堂筋線 なんば〜心斎橋 の間
+NAMBA_SHINSAIBASHI = (34.6697, 135.5015)
+NON_FINITE = [math.nan, math.inf, -math.inf]
+
+
+@pytest.fixture(scope="module")
+def detector():
+    return TrainDetector(max_distance_from_line=1.0)
+
+
+def test_detects_section(detector):
+    assert detector.detect_train(*NAMBA_SHINSAIBASHI) == ("御堂筋線", "御堂筋線_なんば_心斎橋")
+
+
+@pytest.mark.parametrize("value", NON_FINITE)
+def test_non_finite_coordinates_are_not_on_a_line(detector, value):
+    lat, lon = NAMBA_SHINSAIBASHI
+    assert detector.detect_train(value, lon) == (None, None)
+    assert detector.detect_train(lat, value) == (None, None)
+    assert detector.find_candidate_sections(value, lon) == []
+    assert detector.find_candidate_sections(lat, value) == []
+
+
+def test_detect_batch_skips_non_finite_coordinates(detector):
+    lat, lon = NAMBA_SHINSAIBASHI
+    line_indices, section_indices = detector.detect_batch([lat] + NON_FINITE, [lon, lon, lon, lon])
+    assert line_indices.tolist() == [0, -1, -1, -1]
+    assert section_indices.tolist()[1:] == [-1, -1, -1]
+
+
+def random_points(detector, n, seed=0):
+    """線分の近く（判定距離の2倍以内）と、路線網から遠い位置を混ぜる"""
+    rng = np.random.default_rng(seed)
+    threshold = detector.max_distance_from_line
+    lats, lons = [], []
+    for i in range(n):
+        segment = detector._segments[rng.integers(len(detector._segments))]
+        t = rng.random()
+        lat = segment.lat1 + t * (segment.lat2 - segment.lat1)
+        lon = segment.lon1 + t * (segment.lon2 - segment.lon1)
+        offset = rng.uniform(0, 2 * threshold) if i % 4 else rng.uniform(5, 50)
+        angle = rng.uniform(0, 2 * math.pi)
+        lats.append(lat + offset * math.cos(angle) / KM_PER_DEG)
+        lons.append(lon + offset * math.sin(angle) / (KM_PER_DEG * math.cos(math.radians(lat))))
+    return lats, lons
+
+
+def batch_names(detector, line_indices, section_indices):
+    return [
+        (detector.line_names[line] if line >= 0 else None, detector.section_ids[section] if section >= 0 else None)
+        for line, section in zip(line_indices.tolist(), section_indices.tolist())
+    ]
+
+
+def scalar_names(detector, lats, lons):
+    names = []
+    for lat, lon in zip(lats, lons):
+        line, section_id = detector.detect_train(lat, lon)
+        # 閾値ちょうどの "<路線>_unknown" は detect_batch では区間なし（-1）
+        names.append((line, None if section_id == f"{line}_unknown" else section_id))
+    return names
+
+
+@pytest.mark.parametrize("chunk_points", [1, 7, None])
+def test_detect_batch_matches_detect_train(detector, monkeypatch, chunk_points):
+    if chunk_points is not None:
+        # 1回に処理する地点数を chunk_points にして、チャンクの境目をまたがせる
+        monkeypatch.setattr(train_detector, "BATCH_CHUNK_CELLS", chunk_points * len(detector._segments))
+    lats, lons = random_points(detector, 400)
+
+    assert batch_names(detector, *detector.detect_batch(lats, lons)) == scalar_names(detector, lats, lons)
+
+
+def test_detect_batch_matches_detect_train_exactly_at_the_threshold(detector):
+    lats, lons = random_points(detector, 40, seed=1)
+    for lat, lon in zip(lats, lons):
+        match = detector._find_nearest_segment(lat, lon)
+        if match is None:
+            continue
+        at_threshold = TrainDetector(max_distance_from_line=match.distance, cache_size=0)
+        line, section_id = at_threshold.detect_train(lat, lon)
+        assert section_id == f"{line}_unknown"
+        assert batch_names(at_threshold, *at_threshold.detect_batch([lat], [lon])) == [(line, None)]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import main
+    from models import User
+
+    async def verify_user(db, token):
+        return User(id=1, email="rider@example.com", token=token)
+
+    monkeypatch.setattr(main, "verify_user", verify_user)
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("value", ["NaN", "Infinity", "-Infinity"])
+def test_set_location_with_non_finite_coordinates_returns_no_line(client, value):
+    headers = {"Content-Type": "application/json"}
+    body = f'{{"token": "x", "latitude": {value}, "longitude": 135.5}}'
+    response = client.post("/api/set-location", content=body, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"line": None, "description": None}
+
+    body = f'{{"token": "x", "latitude": 34.6697, "longitude": {value}}}'
+    response = client.post("/api/set-location", content=body, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["line"] is None
+
+
+def test_grid_insert_many_matches_insert():
+    import random
+
+    import numpy as np
+
+    from spatial_index import SegmentGridIndex
+
+    random.seed(1)
+    segments = []
+    for _ in range(500):
+        lat, lon = random.uniform(-60, 60), random.uniform(-179, 179)
+        segments.append((lat, lon, lat + random.uniform(-0.05, 0.05), lon + random.uniform(-0.05, 0.05)))
+
+    one_by_one = SegmentGridIndex(1.0)
+    for segment_id, segment in enumerate(segments):
+        one_by_one.insert(segment_id, *segment)
+    bulk = SegmentGridIndex(1.0)
+    bulk.insert_many(*(np.array(column) for column in zip(*segments)))
+    assert bulk._cells == one_by_one._cells
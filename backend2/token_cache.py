@@ -0,0 +1,149 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Tuple
+
+import jwt
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import verify_token_async
+from models import User
+
+logger = logging.getLogger(__name__)
+
+# サンプルの設定（.env.example / server1 の既定値）のままの秘密鍵。誰でもJWTを偽造できるので使わない
+PLACEHOLDER_JWT_SECRETS = {"your-secret-key", "your-super-secret-jwt-key"}
+
+
+class TokenCache:
+    """トークン→ユーザーの検証結果を保持するLRUキャッシュ
+
+    有効なトークンはDBの token_expired_at（ただし最大 max_ttl_seconds）まで、
+    無効なトークンは negative_ttl_seconds の間だけ保持する。
+    max_ttl_seconds は再ログインで差し替えられた古いトークンを使い続けられる時間の上限になる。
+    """
+
+    def __init__(self, max_size: int = 10_000,
+                 max_ttl_seconds: float = 300,
+                 negative_ttl_seconds: float = 5):
+        self.max_size = max_size
+        self.max_ttl_seconds = max_ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        # token -> (user または None, 有効期限のUNIX時刻)
+        self._entries: "OrderedDict[str, Tuple[Optional[User], float]]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls) -> "TokenCache":
+        return cls(
+            max_size=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+            max_ttl_seconds=float(os.getenv("TOKEN_CACHE_MAX_TTL_SECONDS", "300")),
+            negative_ttl_seconds=float(os.getenv("TOKEN_CACHE_NEGATIVE_TTL_SECONDS", "5")),
+        )
+
+    def get(self, token: str) -> Tuple[bool, Optional[User]]:
+        """(キャッシュにあったか, ユーザー) を返す。無効なトークンのキャッシュは (True, None)"""
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        user, expires_at = entry
+        if time.time() >= expires_at:
+            del self._entries[token]
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(token)
+        if user is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, user
+
+    def put(self, token: str, user: Optional[User]):
+        now = time.time()
+        if user is None:
+            expires_at = now + self.negative_ttl_seconds
+        else:
+            expires_at = now + self.max_ttl_seconds
+            if user.token_expired_at is not None:
+                expires_at = min(expires_at, user.token_expired_at.timestamp())
+
+        self._entries[token] = (user, expires_at)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, token: str):
+        self._entries.pop(token, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+
+class TokenVerifier:
+    """キャッシュ→（任意で）JWT署名のローカル検証→DBの順でトークンを検証する
+
+    jwt_secret を指定するとserver1と同じ秘密鍵でJWTを検証し、DBを一切参照しない。
+    この場合、再ログインで無効化されたトークンもJWTの有効期限までは受け付ける。
+    """
+
+    def __init__(self, cache: TokenCache, jwt_secret: Optional[str] = None):
+        self.cache = cache
+        self.jwt_secret = jwt_secret
+
+    @classmethod
+    def from_env(cls) -> "TokenVerifier":
+        jwt_secret = None
+        if os.getenv("TOKEN_VERIFY_JWT_LOCALLY", "false").lower() in ("1", "true", "yes"):
+            jwt_secret = os.getenv("JWT_SECRET") or None
+            # 秘密鍵がなければJWTを検証せず、DBで検証する
+            if jwt_secret is None or jwt_secret in PLACEHOLDER_JWT_SECRETS:
+                logger.warning("TOKEN_VERIFY_JWT_LOCALLY is set but JWT_SECRET is empty or a placeholder; "
+                               "verifying tokens against the database instead")
+                jwt_secret = None
+        return cls(TokenCache.from_env(), jwt_secret)
+
+    def _verify_jwt(self, token: str) -> Optional[User]:
+        try:
+            payload = jwt.decode(token, self.jwt_secret, algorithms=["HS256"])
+        except jwt.PyJWTError:
+            return None
+
+        if "userId" not in payload or "exp" not in payload:
+            return None
+        return User(
+            id=payload["userId"],
+            email=payload.get("email", ""),
+            token=token,
+            token_expired_at=datetime.fromtimestamp(payload["exp"]),
+        )
+
+    async def verify(self, db: AsyncSession, token: str) -> Optional[User]:
+        found, user = self.cache.get(token)
+        if found:
+            return user
+
+        if self.jwt_secret:
+            user = self._verify_jwt(token)
+        else:
+            user_db = await verify_token_async(db, token)
+            user = User.model_validate(user_db) if user_db else None
+
+        self.cache.put(token, user)
+        return user
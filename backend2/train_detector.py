@@ -1,16 +1,117 @@
 import math
-from typing import Optional, Tuple
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 import json
 import logging
+import os
+
+import numpy as np
+
+from geocell_cache import GeocellCache
+from railway_network import RailwayNetwork, load_network
+from spatial_index import SegmentGridIndex
 
 logger = logging.getLogger(__name__)
 
+# detect_batchで一度に計算する 地点数×線分数 の上限（中間配列のメモリを抑える）
+BATCH_CHUNK_CELLS = 1_000_000
+
+# 地球半径6371km（_calculate_distance と同じ）での緯度1度あたりの距離
+KM_PER_DEG = 6371 * math.pi / 180
+# 平面近似の距離で判定距離の候補を絞るときの余裕（最後は必ずハバーサインで判定する）
+PLANAR_MARGIN = 1.01
+# geocellキャッシュで、セル中心で求めた距離をセル内の点に当てはめるときに足す余裕(km)。
+# 平面近似で選んだ線分が正確な最近傍とずれる分（1km先で1m程度）を吸収する
+CELL_SLACK_KM = 0.003
+
+
+class Segment(NamedTuple):
+    """駅間区間を構成する線分。線路形状があれば1つの区間が複数の線分からなる"""
+    line: str
+    index: int
+    lat1: float
+    lon1: float
+    lat2: float
+    lon2: float
+    section_id: str
+    # 線分の方位（北=0度、時計回り）
+    bearing: float
+
+
+class SegmentMatch(NamedTuple):
+    """1回の探索で得られる最近傍の駅間区間"""
+    line: str
+    segment_index: int
+    distance: float
+    section_id: str
+
+
+class SectionCandidate(NamedTuple):
+    """判定距離内にある駅間区間と、その区間で最も近い線分の方位"""
+    line: str
+    segment_index: int
+    distance: float
+    section_id: str
+    bearing: float
+
+
+class CachedCell(NamedTuple):
+    """geocellキャッシュに入れるセルの判定結果"""
+    # False ならセル内の位置によって結果が変わりうる（境界付近）ので、毎回そのまま計算する
+    uniform: bool
+    line: Optional[str] = None
+    section_id: Optional[str] = None
+    # セル内のどこでも判定距離内にある区間がこの区間だけのとき、その区間の線分。候補区間はこの中だけで計算する
+    segment_ids: Optional[Tuple[int, ...]] = None
+
+
+BOUNDARY_CELL = CachedCell(False)
+# 1回目に来たセルはこれだけを入れておき、2回目に来たときに判定する（1回しか来ないセルを判定する手間を省く）
+SEEN_CELL = CachedCell(False)
+
+
+def _bearing(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    dx = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    dy = lat2 - lat1
+    return math.degrees(math.atan2(dx, dy)) % 360
+
+
 class TrainDetector:
-    def __init__(self):
-        self.train_lines = self._load_train_data()
+    def __init__(self, network: Optional[RailwayNetwork] = None,
+                 max_distance_from_line: Optional[float] = None,
+                 cache_size: Optional[int] = None):
         self.speed_threshold = 10.0
-        self.max_distance_from_line = 1.0
+        # 線路形状のある路線網では小さくすると並行する路線を拾いにくくなる
+        if max_distance_from_line is None:
+            max_distance_from_line = float(os.getenv("TRAIN_MAX_DISTANCE_KM", "1.0"))
+        self.max_distance_from_line = max_distance_from_line
+        self._build(network if network is not None else self._load_network())
+        # 近い位置（同じセル）の判定結果を使い回すキャッシュ。cache_size=0 / DETECTION_CACHE_SIZE=0 で無効
+        reference_lat = float(self._seg_lat1.mean()) if len(self._segments) else 35.0
+        self.cell_cache: Optional[GeocellCache[CachedCell]] = GeocellCache.from_env(reference_lat, cache_size)
+
+    def _build(self, network: RailwayNetwork):
+        self.network = network
+        self.train_lines = self.network.to_train_lines()
+        self._lines_by_name = {data["name"]: data for data in self.train_lines.values()}
+        self._segments, self._segment_index = self._build_segment_index()
+        self._build_segment_arrays()
+
+    def reload(self, network: Optional[RailwayNetwork] = None):
+        """路線データを読み直して索引を作り直す。キャッシュした判定結果は捨てる"""
+        self._build(network if network is not None else self._load_network())
+        if self.cell_cache is not None:
+            self.cell_cache.clear()
     
+    def _load_network(self) -> RailwayNetwork:
+        """TRAIN_NETWORK_PATH があればそこから、なければ組み込みの路線データを読み込む"""
+        path = os.getenv("TRAIN_NETWORK_PATH")
+        if path:
+            network = load_network(path, cache_path=os.getenv("TRAIN_NETWORK_CACHE"))
+            logger.info(f"Loaded {len(network.line_ids)} lines from {path}")
+            return network
+
+        return RailwayNetwork.from_train_lines(self._load_train_data())
+
     def _load_train_data(self):
         train_lines = {
             "midosuji": {
@@ -46,6 +147,95 @@ class TrainDetector:
         }
 
         return train_lines
+
+    def _build_segment_index(self):
+        """全路線の線分とsection_idを列挙し、判定距離内の線分だけを引けるグリッドインデックスを構築
+
+        駅間に線路形状があれば、駅→途中の頂点→次の駅 の各線分をその区間の線分として登録する。
+        大きな路線網でも起動が遅くならないよう、線分の端点は RailwayNetwork の配列からNumPyでまとめて作る。
+        """
+        network = self.network
+        line_offsets = network.line_offsets.tolist()
+
+        # 駅間区間（路線の最後の駅以外の駅 j から j+1 まで）ごとの section_id・路線名・路線内の番号
+        starts, section_ids, section_lines, section_positions = [], [], [], []
+        for i, line_name in enumerate(network.line_names):
+            for j in range(line_offsets[i], line_offsets[i + 1] - 1):
+                # 駅名をソートして方向に依存しないsection_idを作成
+                station_names = sorted([network.station_names[j], network.station_names[j + 1]])
+                starts.append(j)
+                section_ids.append(f"{line_name}_{station_names[0]}_{station_names[1]}")
+                section_lines.append(line_name)
+                section_positions.append(j - line_offsets[i])
+
+        # 区間ごとの頂点の列（駅 j、途中の頂点、駅 j+1）を1つの配列につなげる
+        starts = np.array(starts, dtype=np.int64)
+        shape_offsets = network.shape_offsets.astype(np.int64)
+        vertex_counts = shape_offsets[starts + 1] - shape_offsets[starts] + 2
+        section_of_vertex = np.repeat(np.arange(len(starts)), vertex_counts)
+        position = np.arange(int(vertex_counts.sum())) - np.repeat(np.cumsum(vertex_counts) - vertex_counts, vertex_counts)
+        station = starts[section_of_vertex]
+        is_first = position == 0
+        is_last = position == vertex_counts[section_of_vertex] - 1
+        # 途中の頂点の位置（駅の頂点では使わない。形状がなくても添字が範囲内になるよう末尾に0を足す）
+        shape_index = np.where(is_first | is_last, 0, shape_offsets[station] + position - 1)
+        shape_lat = np.append(network.shape_lat, 0.0)[shape_index]
+        shape_lon = np.append(network.shape_lon, 0.0)[shape_index]
+        next_station = np.where(is_last, station + 1, station)
+        vertex_lat = np.where(is_first | is_last, network.station_lat[next_station], shape_lat)
+        vertex_lon = np.where(is_first | is_last, network.station_lon[next_station], shape_lon)
+
+        # 各区間の最後の頂点以外が線分の始点
+        first = np.flatnonzero(~is_last)
+        lat1, lon1 = vertex_lat[first], vertex_lon[first]
+        lat2, lon2 = vertex_lat[first + 1], vertex_lon[first + 1]
+        self._seg_lat1, self._seg_lon1 = lat1, lon1
+        self._seg_dlat, self._seg_dlon = lat2 - lat1, lon2 - lon1
+        self._segment_sections = section_of_vertex[first]
+        self._section_ids_by_section = section_ids
+        self._section_lines = section_lines
+
+        index = SegmentGridIndex(self.max_distance_from_line)
+        index.insert_many(lat1, lon1, lat2, lon2)
+
+        # 線分の方位（_bearing と同じ計算）
+        dx = (lon2 - lon1) * np.cos(np.radians((lat1 + lat2) / 2))
+        bearings = np.degrees(np.arctan2(dx, lat2 - lat1)) % 360
+        # 隣り合う線分の端点は同じfloatオブジェクトを共有させる
+        vertex_lat, vertex_lon = vertex_lat.tolist(), vertex_lon.tolist()
+        segments = [
+            Segment(section_lines[section], section_positions[section],
+                    vertex_lat[i], vertex_lon[i], vertex_lat[i + 1], vertex_lon[i + 1],
+                    section_ids[section], bearing)
+            for section, i, bearing in zip(self._segment_sections.tolist(), first.tolist(), bearings.tolist())
+        ]
+        return segments, index
+
+    def _build_segment_arrays(self):
+        """バッチ判定用に線分の端点と路線・区間の番号を連続したNumPy配列にまとめる"""
+        self.line_names = list(self._lines_by_name)
+        self.section_ids = list(dict.fromkeys(self._section_ids_by_section))
+        line_numbers = {name: i for i, name in enumerate(self.line_names)}
+        section_numbers = {section_id: i for i, section_id in enumerate(self.section_ids)}
+
+        # 線分の中点の緯度で経度1度あたりの距離を求めておき、線分の近くを平面（km単位）として扱う（正距円筒図法）
+        self._seg_kx = KM_PER_DEG * np.cos(np.radians(self._seg_lat1 + self._seg_dlat / 2))
+        self._seg_dx = self._seg_dlon * self._seg_kx
+        self._seg_dy = self._seg_dlat * KM_PER_DEG
+        self._seg_len_sq = self._seg_dx * self._seg_dx + self._seg_dy * self._seg_dy
+        # 1件ずつの判定ではNumPyのスカラーより速いPythonのfloatで使う
+        self._planar = list(zip(
+            self._seg_lat1.tolist(), self._seg_lon1.tolist(), self._seg_kx.tolist(),
+            self._seg_dx.tolist(), self._seg_dy.tolist(), self._seg_len_sq.tolist(),
+        ))
+
+        # 区間ごとの路線・区間の番号を線分に展開する
+        section_line_numbers = np.array([line_numbers[line] for line in self._section_lines], dtype=np.int32)
+        section_section_numbers = np.array(
+            [section_numbers[section_id] for section_id in self._section_ids_by_section], dtype=np.int32
+        )
+        self._seg_line = section_line_numbers[self._segment_sections]
+        self._seg_section = section_section_numbers[self._segment_sections]
     
     def _calculate_distance(self, lat1: float, lon1: float, lat2: float, lon2: float) -> float:
         R = 6371
@@ -55,100 +245,243 @@ class TrainDetector:
         c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
         return R * c
     
-    def _point_to_segment_distance(self, lat: float, lon: float, 
-                                   lat1: float, lon1: float, 
-                                   lat2: float, lon2: float) -> float:
-        A = lat - lat1
-        B = lon - lon1
-        C = lat2 - lat1
-        D = lon2 - lon1
-        
-        dot = A * C + B * D
-        len_sq = C * C + D * D
-        
-        if len_sq == 0:
-            return self._calculate_distance(lat, lon, lat1, lon1)
-        
-        t = max(0, min(1, dot / len_sq))
-        
-        proj_lat = lat1 + t * C
-        proj_lon = lon1 + t * D
-        
-        return self._calculate_distance(lat, lon, proj_lat, proj_lon)
-    
-    def _find_nearest_line(self, lat: float, lon: float) -> Tuple[Optional[str], float]:
-        min_distance = float('inf')
-        nearest_line = None
-        
-        for line_id, line_data in self.train_lines.items():
-            stations = line_data["stations"]
-            for i in range(len(stations) - 1):
-                dist = self._point_to_segment_distance(
-                    lat, lon,
-                    stations[i]["lat"], stations[i]["lon"],
-                    stations[i+1]["lat"], stations[i+1]["lon"]
-                )
-                if dist < min_distance:
-                    min_distance = dist
-                    nearest_line = line_data["name"]
-        
-        return nearest_line, min_distance
-    
-    def _find_section(self, line_name: str, lat: float, lon: float) -> Optional[str]:
-        """現在位置がどの駅間区間にあるかを判定"""
-        line_data = None
-        for line_id, data in self.train_lines.items():
-            if data["name"] == line_name:
-                line_data = data
-                break
-
-        if not line_data:
+    def _distance_to_segment_point(self, lat: float, lon: float, segment: Segment, t: float) -> float:
+        """線分上の位置 t の点までの正確な距離（ハバーサイン）"""
+        return self._calculate_distance(
+            lat, lon,
+            segment.lat1 + t * (segment.lat2 - segment.lat1),
+            segment.lon1 + t * (segment.lon2 - segment.lon1),
+        )
+
+    def _batch_nearest_segments(self, lats: np.ndarray, lons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """N地点それぞれの最も近い線分（平面近似）と、その線分までの正確な距離(km)"""
+        px = (lons[:, None] - self._seg_lon1) * self._seg_kx
+        py = (lats[:, None] - self._seg_lat1) * KM_PER_DEG
+
+        dot = px * self._seg_dx + py * self._seg_dy
+        # 長さ0の線分は始点との距離（t=0）になる
+        t = np.divide(dot, self._seg_len_sq, out=np.zeros_like(dot), where=self._seg_len_sq != 0)
+        np.clip(t, 0, 1, out=t)
+
+        px -= t * self._seg_dx
+        py -= t * self._seg_dy
+        nearest = (px * px + py * py).argmin(axis=1)
+        t = t[np.arange(len(lats)), nearest]
+
+        # 正確な距離は最も近い線分についてだけ求める
+        proj_lat = self._seg_lat1[nearest] + t * self._seg_dlat[nearest]
+        proj_lon = self._seg_lon1[nearest] + t * self._seg_dlon[nearest]
+        R = 6371
+        dlat = np.radians(proj_lat - lats)
+        dlon = np.radians(proj_lon - lons)
+        a = np.sin(dlat/2)**2 + np.cos(np.radians(lats)) * np.cos(np.radians(proj_lat)) * np.sin(dlon/2)**2
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+        return nearest, R * c
+
+    def _find_nearest_segment(self, lat: float, lon: float) -> Optional[SegmentMatch]:
+        """最も近い駅間区間を1回の探索で求める（路線・区間・距離・section_idをまとめて返す）
+
+        候補の比較は平面近似の距離で行い、ハバーサインは最も近い線分について1回だけ計算する。
+        """
+        min_distance_sq = float('inf')
+        nearest_id = None
+        nearest_t = 0.0
+        planar = self._planar
+
+        # 判定距離内にある可能性のある線分だけを調べる。
+        # 線分の始点からの点の位置をkmの平面座標にし、線分への射影から距離の2乗を求める（長さ0の線分は始点まで）
+        for segment_id in self._segment_index.query(lat, lon):
+            lat1, lon1, kx, dx, dy, len_sq = planar[segment_id]
+            px = (lon - lon1) * kx
+            py = (lat - lat1) * KM_PER_DEG
+            t = (px * dx + py * dy) / len_sq if len_sq > 0 else 0.0
+            if t < 0.0:
+                t = 0.0
+            elif t > 1.0:
+                t = 1.0
+            px -= t * dx
+            py -= t * dy
+            distance_sq = px * px + py * py
+            if distance_sq < min_distance_sq:
+                min_distance_sq = distance_sq
+                nearest_id = segment_id
+                nearest_t = t
+
+        if nearest_id is None:
             return None
 
-        stations = line_data["stations"]
-        min_distance = float('inf')
-        best_section = None
+        nearest = self._segments[nearest_id]
+        distance = self._distance_to_segment_point(lat, lon, nearest, nearest_t)
+        return SegmentMatch(nearest.line, nearest.index, distance, nearest.section_id)
 
-        # 各駅間区間をチェック
-        for i in range(len(stations) - 1):
-            dist = self._point_to_segment_distance(
-                lat, lon,
-                stations[i]["lat"], stations[i]["lon"],
-                stations[i+1]["lat"], stations[i+1]["lon"]
-            )
+    def _nearest_by_section(self, lat: float, lon: float, segment_ids: Iterable[int],
+                            limit_sq: float) -> Dict[str, Tuple[float, int, float]]:
+        """平面近似の距離の2乗が limit_sq 未満の線分から、区間ごとに最も近いもの (距離の2乗, 線分ID, t) を選ぶ"""
+        nearest_by_section = {}
+        planar = self._planar
 
-            if dist < min_distance:
-                min_distance = dist
-                # 駅名をソートして方向に依存しないsection_idを作成
-                station_names = sorted([stations[i]["name"], stations[i+1]["name"]])
-                best_section = f"{line_name}_{station_names[0]}_{station_names[1]}"
+        # _find_nearest_segment と同じ計算
+        for segment_id in segment_ids:
+            lat1, lon1, kx, dx, dy, len_sq = planar[segment_id]
+            px = (lon - lon1) * kx
+            py = (lat - lat1) * KM_PER_DEG
+            t = (px * dx + py * dy) / len_sq if len_sq > 0 else 0.0
+            if t < 0.0:
+                t = 0.0
+            elif t > 1.0:
+                t = 1.0
+            px -= t * dx
+            py -= t * dy
+            distance_sq = px * px + py * py
+            if distance_sq >= limit_sq:
+                continue
+            section_id = self._segments[segment_id].section_id
+            best = nearest_by_section.get(section_id)
+            if best is None or distance_sq < best[0]:
+                nearest_by_section[section_id] = (distance_sq, segment_id, t)
 
-        return best_section if min_distance < self.max_distance_from_line else None
+        return nearest_by_section
 
-    def _generate_section_id(self, line: str, lat: float, lon: float) -> str:
-        """駅間区間ベースのsection_idを生成（方向に依存しない）"""
-        section = self._find_section(line, lat, lon)
-        if section:
-            return section
+    def _candidate_sections(self, lat: float, lon: float, segment_ids: Iterable[int]) -> List[SectionCandidate]:
+        limit_sq = (self.max_distance_from_line * PLANAR_MARGIN) ** 2
+        candidates = []
+        for distance_sq, segment_id, t in self._nearest_by_section(lat, lon, segment_ids, limit_sq).values():
+            segment = self._segments[segment_id]
+            distance = self._distance_to_segment_point(lat, lon, segment, t)
+            if distance < self.max_distance_from_line:
+                candidates.append(SectionCandidate(
+                    segment.line, segment.index, distance, segment.section_id, segment.bearing
+                ))
+
+        return sorted(candidates, key=lambda candidate: candidate.distance)
+
+    def find_candidate_sections(self, lat: float, lon: float) -> List[SectionCandidate]:
+        """判定距離内にある駅間区間を、区間ごとの最短距離つきで近い順に返す（軌跡を使った判定用）"""
+        # NaN・無限大の位置はセルを求められないので、どの区間にもいないとする
+        if not (math.isfinite(lat) and math.isfinite(lon)):
+            return []
+        cell = self._cached_cell(lat, lon, need_segments=True)
+        if cell is not None:
+            if cell.line is None:
+                return []
+            return self._candidate_sections(lat, lon, cell.segment_ids)
+        return self._candidate_sections(lat, lon, self._segment_index.query(lat, lon))
+
+    def _cached_cell(self, lat: float, lon: float, need_segments: bool = False) -> Optional[CachedCell]:
+        """(lat, lon) を含むセルの、セル内のどこでも同じになる判定結果。なければ None（そのまま計算する）
+
+        need_segments なら、区間が決まっていても候補区間が1つに限られないセルは None にする。
+        """
+        cache = self.cell_cache
+        if cache is None:
+            return None
+        key = cache.cell(lat, lon)
+        cell = cache.get(key)
+        if cell is None:
+            cache.put(key, SEEN_CELL)
+            return None
+        if cell is SEEN_CELL:
+            cell = self._classify_cell(key)
+            cache.put(key, cell)
+        if not cell.uniform or (need_segments and cell.line is not None and cell.segment_ids is None):
+            cache.bypass()
+            return None
+        return cell
+
+    def _classify_cell(self, key: Tuple[int, int]) -> CachedCell:
+        """セル内のどの点でも detect_train の結果が同じになるかを、セル中心からの距離に余裕を持たせて判定する
+
+        セル中心からセル内の点までは高々 half（半対角線）なので、中心から距離 d の線分は
+        セル内のどの点からも d - half 以上 d + half 以下にある。
+        """
+        cache = self.cell_cache
+        threshold = self.max_distance_from_line
+        half = cache.half_diagonal_km(key) + CELL_SLACK_KM
+        south, west, north, east = cache.bounds(key)
+        lat, lon = (south + north) / 2, (west + east) / 2
+
+        # セルはグリッドインデックスのセルよりずっと小さいので、四隅で引いた線分にセル内のどの点で引く線分も含まれる
+        segment_ids = set()
+        for corner_lat, corner_lon in cache.corners(key):
+            segment_ids.update(self._segment_index.query(corner_lat, corner_lon))
+
+        limit_sq = ((threshold + half) * PLANAR_MARGIN) ** 2
+        distances = sorted(
+            (self._distance_to_segment_point(lat, lon, self._segments[segment_id], t), section_id)
+            for section_id, (_, segment_id, t) in self._nearest_by_section(lat, lon, segment_ids, limit_sq).items()
+        )
+        if not distances or distances[0][0] - half > threshold:
+            return CachedCell(True)
+
+        nearest, section_id = distances[0]
+        runner_up = distances[1][0] if len(distances) > 1 else math.inf
+        if nearest + half >= threshold or runner_up - half <= nearest + half:
+            return BOUNDARY_CELL
+
+        section_segments = tuple(i for i in segment_ids if self._segments[i].section_id == section_id)
+        line = self._segments[section_segments[0]].line
+        only_section = runner_up - half > threshold
+        return CachedCell(True, line, section_id, section_segments if only_section else None)
+
+    def get_line(self, line_name: str) -> Optional[dict]:
+        """路線名から路線データを引く（ロード時に作成したマップを使用）"""
+        return self._lines_by_name.get(line_name)
 
-        # フォールバック: 路線名のみ
-        return f"{line}_unknown"
-    
     def detect_train(self, latitude: float, longitude: float,
                     speed: Optional[float] = None,
                     direction: Optional[float] = None) -> Tuple[Optional[str], Optional[str]]:
 
         # 速度条件を撤廃 - 停車中や低速でも判定する
 
-        nearest_line, distance = self._find_nearest_line(latitude, longitude)
+        # NaN・無限大の位置はどの路線にも判定しない
+        if not (math.isfinite(latitude) and math.isfinite(longitude)):
+            return None, None
+
+        cell = self._cached_cell(latitude, longitude)
+        if cell is not None:
+            return cell.line, cell.section_id
+
+        match = self._find_nearest_segment(latitude, longitude)
 
-        if distance > self.max_distance_from_line:
-            logger.info(f"Distance {distance:.4f} km from nearest line exceeds threshold")
+        if match is None or match.distance > self.max_distance_from_line:
+            logger.debug("Nearest line is farther than threshold")
             return None, None
-        
-        if nearest_line:
-            section_id = self._generate_section_id(nearest_line, latitude, longitude)
-            logger.info(f"Detected train: {nearest_line}, section: {section_id}")
-            return nearest_line, section_id
-        
-        return None, None
\ No newline at end of file
+
+        section_id = match.section_id
+        if match.distance >= self.max_distance_from_line:
+            # フォールバック: 路線名のみ
+            section_id = f"{match.line}_unknown"
+
+        logger.debug(f"Detected train: {match.line}, section: {section_id}")
+        return match.line, section_id
+
+    def detect_batch(self, lats, lons, speeds=None, directions=None) -> Tuple[np.ndarray, np.ndarray]:
+        """複数地点をまとめて判定し、路線番号と区間番号の配列を返す
+
+        番号はそれぞれ self.line_names / self.section_ids の添字で、判定なしは -1。
+        結果は地点ごとに detect_train を呼んだ場合と一致する。speeds / directions は
+        detect_train と同様に現在は判定に使わない。
+        """
+        lats = np.ascontiguousarray(lats, dtype=np.float64)
+        lons = np.ascontiguousarray(lons, dtype=np.float64)
+        if lats.ndim != 1 or lats.shape != lons.shape:
+            raise ValueError("lats and lons must be 1-D arrays of the same length")
+
+        n = len(lats)
+        line_indices = np.full(n, -1, dtype=np.int32)
+        section_indices = np.full(n, -1, dtype=np.int32)
+        if n == 0 or len(self._segments) == 0:
+            return line_indices, section_indices
+
+        chunk = max(1, BATCH_CHUNK_CELLS // len(self._segments))
+        for start in range(0, n, chunk):
+            stop = min(start + chunk, n)
+            nearest, nearest_distance = self._batch_nearest_segments(lats[start:stop], lons[start:stop])
+
+            on_line = nearest_distance <= self.max_distance_from_line
+            # detect_trainで"_unknown"になる閾値ちょうどの場合は区間なしとする
+            in_section = nearest_distance < self.max_distance_from_line
+            line_indices[start:stop] = np.where(on_line, self._seg_line[nearest], -1)
+            section_indices[start:stop] = np.where(in_section, self._seg_section[nearest], -1)
+
+        return line_indices, section_indices
@@ -168,8 +168,10 @@ module.exports = (io) => {
 
   router.post('/train/join', authenticateToken, async (req, res) => {
     try {
-      const {section_id, duration_hours = 24} = req.body;
+      const {section_id, duration_hours = 24, retry = false} = req.body;
       const userId = req.user.userId;
+      // backend2 marks resends (after a failed or unanswered attempt) with retry / X-Retry-Attempt
+      const isRetry = retry === true || Number(req.get('X-Retry-Attempt') || 0) > 0;
 
       if (!section_id) {
         return res.status(400).json({ error: 'train_id is required' });
@@ -185,8 +187,16 @@ module.exports = (io) => {
         { where: { id: userId } }
       );
 
+      // a resent join must not create a second room when the first attempt already created one
+      const currentRoom = !isRetry ? null : await Room.findOne({
+        where: {
+          [Op.or]: [{user_id_1: userId}, {user_id_2: userId}],
+          expired_at: {[Op.gt]: literal('NOW()')}
+        }
+      });
+
       // finding other user
-      const userMatchingTo = await User.findOne({
+      const userMatchingTo = currentRoom !== null ? null : await User.findOne({
         where: {
           [Op.and]: [
             {id: {[Op.ne]: userId}}, // other user must not be himself
@@ -232,7 +242,13 @@ module.exports = (io) => {
       res.status(200).json({
         message: 'Successfully joined train and a room created',
         section_id,
-        expired_at: sectionIdExpiredAt
+        expired_at: sectionIdExpiredAt,
+        room: {
+          id: room.id,
+          user_id_1: userId,
+          user_id_2: userMatchingTo.id,
+          expired_at: roomExpiredAt
+        }
       });
     } catch (error) {
       console.error('Train join error:', error);